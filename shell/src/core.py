@@ -19,6 +19,7 @@ import apsw
 import cmd
 import traceback
 import sys
+import time
 
 import bayeslite
 import bayeslite.bql as bql
@@ -433,22 +434,31 @@ class Shell(cmd.Cmd):
 
     def dot_csv(self, line):
         '''create table from CSV file
-        <table> </path/to/data.csv>
+        <table> </path/to/data.csv> [-v]
 
         Create a SQL table named <table> from the data in
         </path/to/data.csv>.
+        Options:
+        -v : Verbose.  Report the number of rows read per second.
         '''
         # XXX Lousy, lousy tokenizer.
         tokens = line.split()
-        if len(tokens) != 2:
+        if len(tokens) not in (2, 3) or tokens[2:] not in ([], ['-v']):
             self.stdout.write('Usage: .csv <table> </path/to/data.csv>\n')
             return
         table = tokens[0]
         pathname = tokens[1]
+        verbose = len(tokens) == 3
         try:
+            start = time.time()
             with open(pathname, 'rU') as f:
-                bayeslite.bayesdb_read_csv(self._bdb, table, f, header=True,
-                                           create=True, ifnotexists=False)
+                nrows = bayeslite.bayesdb_read_csv(self._bdb, table, f,
+                    header=True, create=True, ifnotexists=False)
+            elapsed = time.time() - start
+            if verbose:
+                rate = nrows / elapsed if 0 < elapsed else float('inf')
+                self.stdout.write('Read %d rows in %.3f seconds'
+                    ' (%.0f rows/sec)\n' % (nrows, elapsed, rate))
         except IOError as e:
             self.stdout.write('%s\n' % (e,))
         except Exception:
@@ -142,6 +142,7 @@ AnalyzeModels = namedtuple('AnalyzeModels', [
     'ckpt_iterations',          # int
     'ckpt_seconds',             # int
     'program',                  # string to sub-parser
+    'background',               # boolean
 ])
 DropModels = namedtuple('DropModels', [
     'generator',                # XXX name
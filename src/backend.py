@@ -41,6 +41,7 @@ the table::
        print x
 """
 
+from bayeslite.stats import arithmetic_mean
 from bayeslite.util import cursor_value
 
 builtin_backends = []
@@ -201,11 +202,68 @@ class BayesDB_Backend(object):
         """
         raise NotImplementedError
 
+    def analyze_models_background(self, bdb, generator_id, modelnos=None,
+            iterations=1, max_seconds=None, ckpt_iterations=None,
+            ckpt_seconds=None, program=None):
+        """Start analyzing the specified models in the background.
+
+        Used for ``ANALYZE ... IN BACKGROUND``.  Takes the same
+        arguments as :meth:`analyze_models`, but returns as soon as the
+        analysis has started.  The results of analysis are committed to
+        the database at each checkpoint, and queries meanwhile see the
+        models as of the latest checkpoint.
+        """
+        raise NotImplementedError
+
+    def analysis_status(self, bdb, generator_id):
+        """Return the status of the background analysis of a generator.
+
+        Returns None if no analysis of the generator was started in the
+        background, or else a dict with the keys:
+
+        - ``running``: whether the analysis is still running,
+        - ``iterations``: number of iterations done,
+        - ``seconds``: number of seconds spent on analysis,
+        - ``logscores``: dict mapping each model number analyzed to
+          the log score of its latest state,
+        - ``error``: None, or a str explaining why the analysis stopped
+          early.
+        """
+        return None
+
+    def cancel_analysis(self, bdb, generator_id):
+        """Stop any background analysis of a generator.
+
+        Results already committed at checkpoints are kept.
+        """
+        pass
+
     def column_dependence_probability(self, bdb, generator_id, modelnos, colno0,
             colno1):
         """Compute ``DEPENDENCE PROBABILITY OF <col0> WITH <col1>``."""
         raise NotImplementedError
 
+    def column_dependence_probability_matrix(self, bdb, generator_id,
+            modelnos, colnos):
+        """Compute ``DEPENDENCE PROBABILITY`` of every pair of `colnos`.
+
+        Returns a square matrix, indexed as ``matrix[i][j]``, of the
+        dependence probability of ``colnos[i]`` with ``colnos[j]``
+        averaged over the models.
+
+        The default implementation calls
+        :meth:`column_dependence_probability` once per pair; backends
+        should override it when they can compute all pairs at once.
+        """
+        return [
+            [
+                arithmetic_mean(self.column_dependence_probability(
+                    bdb, generator_id, modelnos, colno0, colno1))
+                for colno1 in colnos
+            ]
+            for colno0 in colnos
+        ]
+
     def column_mutual_information(self, bdb, generator_id, modelnos, colnos0,
             colnos1, constraints=None, numsamples=100):
         """Compute ``MUTUAL INFORMATION OF (<cols0>) WITH (<cols1>)``."""
@@ -216,6 +274,27 @@ class BayesDB_Backend(object):
         """Compute ``SIMILARITY TO <target_row>`` for given `rowid`."""
         raise NotImplementedError
 
+    def row_similarity_matrix(self, bdb, generator_id, modelnos, rowids0,
+            rowids1, colno):
+        """Compute ``SIMILARITY IN THE CONTEXT OF <col>`` of many rows.
+
+        Returns a matrix, indexed as ``matrix[i][j]``, of the
+        similarity of ``rowids0[i]`` to ``rowids1[j]`` in the context
+        of `colno`, averaged over the models.
+
+        The default implementation calls :meth:`row_similarity` once
+        per pair; backends should override it when they can compute
+        all pairs at once.
+        """
+        return [
+            [
+                arithmetic_mean(self.row_similarity(
+                    bdb, generator_id, modelnos, rowid0, rowid1, [colno]))
+                for rowid1 in rowids1
+            ]
+            for rowid0 in rowids0
+        ]
+
     def predictive_relevance(self, bdb, generator_id, modelnos, rowid_target,
             rowid_query, hypotheticals, colno):
         """Compute predictive relevance, also known as relevance probability.
@@ -244,6 +323,23 @@ class BayesDB_Backend(object):
         """Predict a value for a column and return confidence."""
         raise NotImplementedError
 
+    def predict_confidence_batch(self, bdb, generator_id, modelnos, rowids,
+            colno, numsamples=None):
+        """Evaluate :meth:`predict_confidence` for each of many rows at once.
+
+        Returns a list of ``(value, confidence)`` pairs, one for each
+        element of `rowids`.
+
+        The default implementation calls :meth:`predict_confidence`
+        once per row; backends should override it when they can share
+        work, such as requests to a server, across rows.
+        """
+        return [
+            self.predict_confidence(bdb, generator_id, modelnos, rowid, colno,
+                numsamples=numsamples)
+            for rowid in rowids
+        ]
+
     def simulate_joint(self, bdb, generator_id, modelnos, rowid, targets,
             constraints, num_samples=1, accuracy=None):
         """Simulate `targets` from a generator, subject to `constraints`.
@@ -270,6 +366,26 @@ class BayesDB_Backend(object):
         """
         raise NotImplementedError
 
+    def simulate_joint_batch(self, bdb, generator_id, modelnos, rows,
+            num_samples=1, accuracy=None):
+        """Evaluate :meth:`simulate_joint` for each of many queries at once.
+
+        Returns a list, with an element for each element of `rows`, of
+        lists of `num_samples` lists of values for its targets.
+
+        `rows` is a list of ``(rowid, targets, constraints)`` triples,
+        each interpreted as for :meth:`simulate_joint`.
+
+        The default implementation calls :meth:`simulate_joint` once
+        per row; backends should override it when they can share work
+        across rows.
+        """
+        return [
+            self.simulate_joint(bdb, generator_id, modelnos, rowid, targets,
+                constraints, num_samples=num_samples, accuracy=accuracy)
+            for rowid, targets, constraints in rows
+        ]
+
     def logpdf_joint(self, bdb, generator_id, modelnos, rowid, targets,
             constraints):
         """Evalute the joint probability of `targets` subject to `constraints`.
@@ -285,3 +401,25 @@ class BayesDB_Backend(object):
         `modelno` is a model number or `None`, meaning all models.
         """
         raise NotImplementedError
+
+    def logpdf_joint_batch(self, bdb, generator_id, modelnos, rows):
+        """Evaluate :meth:`logpdf_joint` for each of many queries at once.
+
+        Returns a list of probability densities (in log domain), one
+        for each element of `rows`.
+
+        `rows` is a list of ``(rowid, targets, constraints)`` triples,
+        each interpreted as for :meth:`logpdf_joint`.
+
+        `modelnos` is a list of model numbers or `None`, meaning all
+        models.
+
+        The default implementation calls :meth:`logpdf_joint` once per
+        row; backends should override it when they can share work,
+        such as loading models, across rows.
+        """
+        return [
+            self.logpdf_joint(
+                bdb, generator_id, modelnos, rowid, targets, constraints)
+            for rowid, targets, constraints in rows
+        ]
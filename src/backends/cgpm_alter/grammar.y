@@ -29,6 +29,8 @@ phrases(many)       ::= phrases(ps) T_COMMA phrase(p).
 
 phrase(none)        ::= .
 
+phrase(incorporate_new_rows)    ::= K_INCORPORATE K_NEW K_ROWS.
+
 phrase(set_var_dependency)  ::= K_ENSURE variable_token_opt columns(cols)
                                     dependency(dep).
 
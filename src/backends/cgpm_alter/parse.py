@@ -39,7 +39,9 @@ KEYWORDS = {
     'dependent': grammar.K_DEPENDENT,
     'ensure': grammar.K_ENSURE,
     'in': grammar.K_IN,
+    'incorporate': grammar.K_INCORPORATE,
     'independent': grammar.K_INDEPENDENT,
+    'new': grammar.K_NEW,
     'of': grammar.K_OF,
     'parameter': grammar.K_PARAMETER,
     'row': grammar.K_ROW,
@@ -112,13 +114,16 @@ class CGpmAlterSemantics(object):
 
     def p_alter_start(self, ps):                self.phrases = ps
 
-    def p_phrases_one(self, p):                 return [p] if p else []
+    def p_phrases_one(self, p):                 return [p] if p is not None else []
     def p_phrases_many(self, ps, p):
-        if p: ps.append(p)
+        if p is not None: ps.append(p)
         return ps
 
     def p_phrase_none(self,):                   return None
 
+    def p_phrase_incorporate_new_rows(self):
+        return IncorporateNewRows()
+
     def p_phrase_set_var_dependency(self, cols, dep):
         return SetVarDependency(cols, dep)
 
@@ -164,6 +169,8 @@ class CGpmAlterSemantics(object):
     def p_concentration_c(self, n):             return n
 
 
+IncorporateNewRows = namedtuple('IncorporateNewRows', [])
+
 SetVarDependency = namedtuple('SetVarCluster', [
     'columns',          # columns to modify
     'dependency'        # INDEPENDENT or DEPENDENT
@@ -14,20 +14,31 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import apsw
 import itertools
 import json
 import math
+import multiprocessing
+import numpy
+import time
+import traceback
 
 from collections import Counter
 from collections import defaultdict
 
 from cgpm.crosscat.engine import Engine
+from cgpm.crosscat.state import State
 
 import bayeslite.core as core
 
 from bayeslite.exception import BQLError
 from bayeslite.backend import BayesDB_Backend
 from bayeslite.backend import bayesdb_backend_version
+from bayeslite.backends.cgpm_codec import decode_metadata
+from bayeslite.backends.cgpm_codec import encode_metadata
+from bayeslite.backends.cgpm_pool import StatePool
+from bayeslite.backends.engine_cache import shared_cache
+from bayeslite.math_util import logsumexp
 from bayeslite.sqlite3_util import sqlite3_quote_name
 from bayeslite.util import casefold
 from bayeslite.util import cursor_value
@@ -96,21 +107,66 @@ INSERT INTO bayesdb_cgpm_modelno (generator_id, modelno, cgpm_modelno)
     );
 '''
 
+# Version 4 stores the engine-wide metadata in engine_blob and each
+# state in its own row of bayesdb_cgpm_state, both encoded with
+# cgpm_codec.  engine_json is left NULL; see _upgrade_engine_json.
+CGPM_SCHEMA_4 = '''
+UPDATE bayesdb_backend SET version = 4 WHERE name = 'cgpm';
+
+ALTER TABLE bayesdb_cgpm_generator ADD COLUMN engine_blob BLOB;
+
+CREATE TABLE bayesdb_cgpm_state (
+    generator_id        INTEGER NOT NULL REFERENCES bayesdb_generator(id),
+    cgpm_modelno        INTEGER NOT NULL CHECK (0 <= cgpm_modelno),
+    state_blob          BLOB NOT NULL,
+    PRIMARY KEY(generator_id, cgpm_modelno)
+);
+'''
+
+# Version 5 records the engine stamp at which each state was last
+# written, so that checkpoints need only rewrite the states they touch.
+CGPM_SCHEMA_5 = '''
+UPDATE bayesdb_backend SET version = 5 WHERE name = 'cgpm';
+
+ALTER TABLE bayesdb_cgpm_state
+    ADD COLUMN state_stamp
+    INTEGER NOT NULL DEFAULT 0;
+'''
+
+# Version 6 records the last table rowid the generator has seen, so
+# that INCORPORATE NEW ROWS takes only rows appended since, even if the
+# individuals are a subsample of the table.  See _upgrade_last_rowid.
+CGPM_SCHEMA_6 = '''
+UPDATE bayesdb_backend SET version = 6 WHERE name = 'cgpm';
+
+ALTER TABLE bayesdb_cgpm_generator ADD COLUMN last_table_rowid INTEGER;
+'''
+
 
 class CGPM_Backend(BayesDB_Backend):
 
-    def __init__(self, cgpm_registry, multiprocess=None):
+    def __init__(self, cgpm_registry, multiprocess=None, engine_cache=None):
         self._cgpm_registry = cgpm_registry
         self._multiprocess = multiprocess
-        # The cache is a dictionary whose keys are bayeslite.BayesDB objects,
-        # and whose values are dictionaries (one cache per bdb). We need
-        # self._cache to have separate caches for each bdb because the same
-        # instance of CGPM_Backend may be used across multiple bdb instances.
-        # This situation occurs when CGPM_Backend is used as a default
-        # backend (refer to __init__.py, where the bayeslite module, upon
-        # import, creates a single CGPM_Backend object to be used throughout
-        # the python session).
-        self._cache = dict()
+        # The cache keeps objects per bdb and generator, since the same
+        # instance of CGPM_Backend may be used across multiple bdb
+        # instances.  This situation occurs when CGPM_Backend is used as
+        # a default backend (refer to __init__.py, where the bayeslite
+        # module, upon import, creates a single CGPM_Backend object to be
+        # used throughout the python session).  Its memory is bounded by
+        # the budget of `engine_cache`, shared by default with the other
+        # backends.
+        if engine_cache is None:
+            engine_cache = shared_cache
+        self._cache = engine_cache.namespace(
+            _cache_nbytes, self._cache_release, _cache_pinned)
+        # With multiprocessing on, queries evaluate the states in a
+        # pool of long-lived worker processes, started on first use
+        # and shared by all generators in all bdbs.  Each generator's
+        # states are loaded under a fresh key whenever its engine
+        # changes.
+        self._pool = None
+        self._pool_keys = itertools.count()
 
     def name(self):
         return 'cgpm'
@@ -133,7 +189,21 @@ class CGPM_Backend(BayesDB_Backend):
                 # Install CGPM version 3.
                 bdb.sql_execute(CGPM_SCHEMA_3)
                 version = 3
-            if version != 3:
+            if version == 3:
+                # Install CGPM version 4.
+                bdb.sql_execute(CGPM_SCHEMA_4)
+                _upgrade_engine_json(bdb)
+                version = 4
+            if version == 4:
+                # Install CGPM version 5.
+                bdb.sql_execute(CGPM_SCHEMA_5)
+                version = 5
+            if version == 5:
+                # Install CGPM version 6.
+                bdb.sql_execute(CGPM_SCHEMA_6)
+                _upgrade_last_rowid(bdb)
+                version = 6
+            if version != 6:
                 # Unrecognized version.
                 raise BQLError(bdb, 'CGPM already installed'
                     ' with unknown schema version: %d' % (version,))
@@ -141,6 +211,8 @@ class CGPM_Backend(BayesDB_Backend):
     def set_multiprocess(self, switch):
         old = self._multiprocess
         self._multiprocess = switch
+        if not switch and self._pool is not None:
+            self._pool.close()
         return old
 
     def create_generator(self, bdb, generator_id, schema_tokens, **kwargs):
@@ -150,7 +222,7 @@ class CGPM_Backend(BayesDB_Backend):
         # Store the schema.
         bdb.sql_execute('''
             INSERT INTO bayesdb_cgpm_generator
-                (generator_id, schema_json, engine_json) VALUES (?, ?, NULL)
+                (generator_id, schema_json) VALUES (?, ?)
         ''', (generator_id, json_dumps(schema)))
 
         # Get the underlying population and table.
@@ -169,19 +241,9 @@ class CGPM_Backend(BayesDB_Backend):
             SELECT colno, name, stattype FROM bayesdb_variable
                 WHERE population_id = ? AND 0 <= colno
         ''', (population_id,))
-        for colno, name, stattype in vars_cursor:
+        for colno, name, stattype in vars_cursor.fetchall():
             if _is_nominal(stattype):
-                qn = sqlite3_quote_name(name)
-                cursor = bdb.sql_execute('''
-                    SELECT DISTINCT %s
-                    FROM %s WHERE %s IS NOT NULL
-                ''' % (qn, qt, qn))
-                for code, (value,) in enumerate(cursor):
-                    bdb.sql_execute('''
-                        INSERT INTO bayesdb_cgpm_category
-                            (generator_id, colno, value, code)
-                            VALUES (?, ?, ?, ?)
-                    ''', (generator_id, colno, value, code))
+                _insert_categories(bdb, generator_id, table, colno, name)
 
         # Assign contiguous 0-indexed ids to the individuals in the
         # table.
@@ -204,15 +266,31 @@ class CGPM_Backend(BayesDB_Backend):
             cursor = samples
         else:
             cursor = bdb.sql_execute('SELECT _rowid_ FROM %s' % (qt,))
-        for cgpm_rowid, (table_rowid,) in enumerate(cursor):
-            bdb.sql_execute('''
-                INSERT INTO bayesdb_cgpm_individual
-                    (generator_id, table_rowid, cgpm_rowid)
-                    VALUES (?, ?, ?)
-            ''', (generator_id, table_rowid, cgpm_rowid))
+        bdb.sql_executemany('''
+            INSERT INTO bayesdb_cgpm_individual
+                (generator_id, table_rowid, cgpm_rowid)
+                VALUES (?, ?, ?)
+        ''', (
+            (generator_id, table_rowid, cgpm_rowid)
+            for cgpm_rowid, (table_rowid,) in enumerate(cursor)
+        ))
+        self._del_cache_entry(bdb, generator_id, 'rowids')
+
+        # Rows appended to the table from now on are new, whether or
+        # not the existing ones were all sampled.
+        bdb.sql_execute('''
+            UPDATE bayesdb_cgpm_generator
+                SET last_table_rowid = (SELECT MAX(_rowid_) FROM %s)
+                WHERE generator_id = ?
+        ''' % (qt,), (generator_id,))
 
     def drop_generator(self, bdb, generator_id):
-        # Remove the cache for this generator_id.
+        # Stop any background analysis, and remove the cache for this
+        # generator_id.
+        self.cancel_analysis(bdb, generator_id)
+        pooled = self._get_cache_entry(bdb, generator_id, 'pooled')
+        if pooled is not None:
+            self._pool.drop(pooled[2])
         self._del_cache_entry(bdb, generator_id, None)
 
         # Delete categories.
@@ -231,10 +309,16 @@ class CGPM_Backend(BayesDB_Backend):
             DELETE FROM bayesdb_cgpm_modelno WHERE generator_id = ?
         ''', (generator_id,))
 
+        # Delete states.
+        bdb.sql_execute('''
+            DELETE FROM bayesdb_cgpm_state WHERE generator_id = ?
+        ''', (generator_id,))
+
         # Delete generator.
         bdb.sql_execute('''
             DELETE FROM bayesdb_cgpm_generator WHERE generator_id = ?
         ''', (generator_id,))
+        self._memoize_engine_stamp(bdb, generator_id, None)
 
     def add_column(self, bdb, generator_id, colno):
 
@@ -252,24 +336,17 @@ class CGPM_Backend(BayesDB_Backend):
             raise BQLError(bdb, 'No distribution for stattype: %s' % (stattype))
         dist, params = _DEFAULT_DIST[stattype](bdb, generator_id, varname)
 
+        # Forget the category codes, which are about to change.
+        self._check_analysis(bdb, generator_id)
+        self._del_cache_entry(bdb, generator_id, 'categories')
+
         # Update variable value mapping if nominal.
         if _is_nominal(stattype):
             table_name = core.bayesdb_population_table(bdb, population_id)
-            qt = sqlite3_quote_name(table_name)
-            qv = sqlite3_quote_name(varname)
-            cursor = bdb.sql_execute('''
-                SELECT DISTINCT %s FROM %s WHERE %s IS NOT NULL
-            ''' % (qv, qt, qv))
-            for code, (value,) in enumerate(cursor):
-                bdb.sql_execute('''
-                    INSERT INTO bayesdb_cgpm_category
-                        (generator_id, colno, value, code)
-                        VALUES (?, ?, ?, ?)
-                ''', (generator_id, colno, value, code))
+            _insert_categories(bdb, generator_id, table_name, colno, varname)
 
         # Retrieve the rows from the table.
-        rows = list(itertools.chain.from_iterable(
-            self._data(bdb, generator_id, [varname])))
+        rows = self._data(bdb, generator_id, [varname])[:, 0].tolist()
 
         # Retrieve the engine.
         engine = self._engine(bdb, generator_id)
@@ -287,6 +364,9 @@ class CGPM_Backend(BayesDB_Backend):
         n = len(modelnos)
         assert 0 < n
 
+        # Only one analysis at a time.
+        self._check_analysis(bdb, generator_id)
+
         # Retrieve existing modelnos.
         existing = bdb.sql_execute('''
             SELECT modelno FROM bayesdb_cgpm_modelno WHERE generator_id = ?
@@ -316,6 +396,9 @@ class CGPM_Backend(BayesDB_Backend):
                 FROM bayesdb_generator_model
                 WHERE generator_id = ?
             ''', (generator_id,))
+
+            # Store the whole engine.
+            statenos = None
         # Appending models to an existing engine.
         else:
             # Retrieve the engine.
@@ -340,10 +423,16 @@ class CGPM_Backend(BayesDB_Backend):
                         VALUES (?, ?, ?)
                 ''', (generator_id, modelno, cgpm_modelno))
 
+            # Store only the new states.
+            statenos = cgpm_modelnos
+
         # Serialize the engine without caching.
-        self._serialize_engine(bdb, generator_id, engine, False)
+        self._serialize_engine(bdb, generator_id, engine, False, statenos)
 
     def drop_models(self, bdb, generator_id, modelnos=None):
+        # Only one analysis at a time.
+        self._check_analysis(bdb, generator_id)
+
         # Retrieve currently initialized modelnos.
         cursor = bdb.sql_execute('''
             SELECT modelno FROM bayesdb_cgpm_modelno
@@ -353,11 +442,14 @@ class CGPM_Backend(BayesDB_Backend):
 
         # Drop all models?
         if modelnos is None or sorted(modelnos_existing) == sorted(modelnos):
-            # Set engine JSON to null.
+            # Set engine metadata to null and delete the states.
             bdb.sql_execute('''
-                UPDATE bayesdb_cgpm_generator SET engine_json = NULL
+                UPDATE bayesdb_cgpm_generator SET engine_blob = NULL
                 WHERE generator_id = ?
             ''', (generator_id,))
+            bdb.sql_execute('''
+                DELETE FROM bayesdb_cgpm_state WHERE generator_id = ?
+            ''', (generator_id,))
             # Clear mapping of modelnos.
             bdb.sql_execute('''
                 DELETE FROM bayesdb_cgpm_modelno
@@ -389,10 +481,16 @@ class CGPM_Backend(BayesDB_Backend):
             ''', (generator_id,))
             modelnos_cgpm_new = [m[0] for m in cursor]
             assert modelnos_cgpm_new == range(engine.num_states())
+            # Delete the stored states and renumber the rest; none of
+            # the remaining states changed.
+            _drop_states(bdb, generator_id, cgpm_modelnos)
             # Serialize the engine.
-            self._serialize_engine(bdb, generator_id, engine, True)
+            self._serialize_engine(bdb, generator_id, engine, True, [])
 
     def alter(self, bdb, generator_id, modelnos, commands):
+        # Only one analysis at a time.
+        self._check_analysis(bdb, generator_id)
+
         # Get the population_id.
         population_id = core.bayesdb_generator_population(bdb, generator_id)
 
@@ -418,10 +516,19 @@ class CGPM_Backend(BayesDB_Backend):
             bdb, population_id, generator_id, variable)
 
         # Interpret the AST.
+        incorporate = False
         for clause in alter_ast:
 
+            # INCORPORATE NEW ROWS.
+            if isinstance(clause, cgpm_alter.parse.IncorporateNewRows):
+                # Every model must model the same individuals.
+                if modelnos is not None:
+                    raise BQLError(bdb,
+                        'New rows must be incorporated into all models.')
+                incorporate = True
+
             # ENSURE VARIABLES * DEPENDENT|INDEPENDENT.
-            if isinstance(clause, cgpm_alter.parse.SetVarDependency):
+            elif isinstance(clause, cgpm_alter.parse.SetVarDependency):
                 # Get the columns to migrate. Reject anything other than *.
                 if clause.columns != cgpm_alter.parse.SqlAll:
                     raise BQLError(bdb,
@@ -502,15 +609,13 @@ class CGPM_Backend(BayesDB_Backend):
                     ''', (generator_id,))
                     rows0 = [c[0] for c in cursor]
                 else:
-                    unknown_rowids = []
-                    def get_cgpm_rowid(rowid_user):
-                        try:
-                            return self._cgpm_rowid(
-                                bdb, generator_id, rowid_user, nullok=False)
-                        except ValueError:
-                            unknown_rowids.append(rowid_user)
-                            return None
-                    rows0 = map(get_cgpm_rowid, clause.rows0)
+                    rows0 = self._cgpm_rowids(
+                        bdb, generator_id, clause.rows0)
+                    unknown_rowids = [
+                        rowid_user
+                        for rowid_user, rowid in zip(clause.rows0, rows0)
+                        if rowid == -1
+                    ]
                     if unknown_rowids:
                         raise BQLError(bdb,
                             'Unknown rows: %s' % (unknown_rowids,))
@@ -547,24 +652,87 @@ class CGPM_Backend(BayesDB_Backend):
                     varno, clause.concentration)
                 alter_funcs.append(func)
 
+        # Incorporate new rows before altering the states.
+        if incorporate:
+            self._incorporate_new_rows(bdb, generator_id, engine)
+
         # Execute alteration functions.
         engine.alter(alter_funcs, statenos=cgpm_modelnos,
             multiprocess=self._multiprocess)
 
-        # Serialize the engine.
-        self._serialize_engine(bdb, generator_id, engine, True)
+        # Serialize the altered states, and the data too if it grew.
+        self._serialize_engine(bdb, generator_id, engine, True,
+            None if incorporate else cgpm_modelnos)
+
+    def _incorporate_new_rows(self, bdb, generator_id, engine):
+        # Incorporate the rows appended to the table since the
+        # individuals were chosen into every state, as new individuals,
+        # and let only their cluster assignments settle.
+        if any(state.hooked_cgpms for state in engine.states):
+            generator = core.bayesdb_generator_name(bdb, generator_id)
+            raise BQLError(bdb, 'Cannot incorporate new rows into generator'
+                ' with foreign cgpms: %r' % (generator,))
+        population_id = core.bayesdb_generator_population(bdb, generator_id)
+        outputs = engine.states[0].outputs
+        vars = [
+            core.bayesdb_variable_name(bdb, population_id, generator_id, colno)
+            for colno in outputs
+        ]
+        table_rowids, data = self._new_data(bdb, generator_id, vars)
+        if not table_rowids:
+            return
+        bdb.sql_execute('''
+            UPDATE bayesdb_cgpm_generator SET last_table_rowid = ?
+                WHERE generator_id = ?
+        ''', (table_rowids[-1], generator_id))
+        cgpm_rowid = cursor_value(bdb.sql_execute('''
+            SELECT COUNT(*) FROM bayesdb_cgpm_individual
+                WHERE generator_id = ?
+        ''', (generator_id,)))
+        individuals = []
+        for table_rowid, row in zip(table_rowids, data):
+            observation = {
+                colno: value
+                for colno, value in zip(outputs, row)
+                if not math.isnan(value)
+            }
+            # CGPM cannot incorporate a row with no values, and a row
+            # with no values has nothing to tell the models anyway.
+            if not observation:
+                continue
+            for state in engine.states:
+                state.incorporate(cgpm_rowid, observation)
+            individuals.append((table_rowid, cgpm_rowid))
+            cgpm_rowid += 1
+        if not individuals:
+            return
+        engine.transition(
+            N=1,
+            kernels=['rows'],
+            rowids=[rowid for _table_rowid, rowid in individuals],
+            progress=False,
+            multiprocess=self._multiprocess,
+        )
+        bdb.sql_executemany('''
+            INSERT INTO bayesdb_cgpm_individual
+                (generator_id, table_rowid, cgpm_rowid)
+                VALUES (?, ?, ?)
+        ''', (
+            (generator_id, table_rowid, rowid)
+            for table_rowid, rowid in individuals
+        ))
+        self._del_cache_entry(bdb, generator_id, 'rowids')
 
     def analyze_models(
             self, bdb, generator_id, modelnos=None, iterations=None,
             max_seconds=None, ckpt_iterations=None, ckpt_seconds=None,
-            program=None):
+            program=None, background=False):
         # No analysis specified.
         if not iterations and not max_seconds:
             return
 
-        # Checkpoint by seconds disabled.
-        if ckpt_seconds:
-            raise NotImplementedError('Checkpoint by seconds in CGPM analyze.')
+        # Only one analysis at a time.
+        self._check_analysis(bdb, generator_id)
 
         if program is None:
             program = []
@@ -603,16 +771,8 @@ class CGPM_Backend(BayesDB_Backend):
         # Convert the user rowids to cgpm rowids.
         rowids_cgpm = None
         if rowids_user:
-            unknown_rowids = []
-            def get_cgpm_rowid(rowid_user):
-                try:
-                    return self._cgpm_rowid(
-                        bdb, generator_id, rowid_user, nullok=False)
-                except ValueError:
-                    unknown_rowids.append(rowid_user)
-                    return None
-            rowids_cgpm = map(get_cgpm_rowid, rowids_user)
-            if unknown_rowids:
+            rowids_cgpm = self._cgpm_rowids(bdb, generator_id, rowids_user)
+            if -1 in rowids_cgpm:
                 raise BQLError(bdb, 'Unknown ROWS: %s' % (rowids_user,))
 
         # Convert the user subproblems into kernels.
@@ -633,56 +793,101 @@ class CGPM_Backend(BayesDB_Backend):
                 raise BQLError(bdb, 'No VARIABLES or SKIP in Loom.')
             if rowids_user:
                 raise BQLError(bdb, 'No ROWS in Loom.')
+            if ckpt_seconds:
+                raise BQLError(bdb, 'No CHECKPOINT SECONDS in Loom.')
+
+        # States transitioned, or None for all of them: Loom transitions
+        # every state.
+        if vars_target_baseline and optimized and optimized.backend == 'loom':
+            statenos = None
+        else:
+            statenos = cgpm_modelnos
+
+        # How to transition the engine, in foreground or background.
+        plan = {
+            'baseline': vars_target_baseline,
+            'foreign': vars_target_foreign,
+            'optimized': optimized.backend if optimized else None,
+            'kernels': kernels,
+            'rowids': rowids_cgpm,
+            'progress': progress,
+            'checkpoint': ckpt_iterations,
+            'statenos': cgpm_modelnos,
+        }
 
-        # Run transitions on baseline variables.
-        if vars_target_baseline:
+        if background:
             if optimized and optimized.backend == 'loom':
-                engine.transition_loom(
-                    N=iterations,
-                    S=max_seconds,
-                    progress=progress,
-                    checkpoint=ckpt_iterations,
-                    multiprocess=self._multiprocess,
-                )
-            elif optimized and optimized.backend == 'lovecat':
-                engine.transition_lovecat(
-                    N=iterations,
-                    S=max_seconds,
-                    kernels=kernels,
-                    cols=vars_target_baseline,
-                    rowids=rowids_cgpm,
-                    progress=progress,
-                    checkpoint=ckpt_iterations,
-                    statenos=cgpm_modelnos,
-                    multiprocess=self._multiprocess,
-                )
+                raise BQLError(bdb, 'No IN BACKGROUND in Loom.')
+            self._start_analysis(bdb, generator_id, engine, plan,
+                iterations, max_seconds, ckpt_iterations, ckpt_seconds)
+            return
+
+        def transition(N, S):
+            _transition(engine, plan, N, S, self._multiprocess)
+
+        if not ckpt_seconds:
+            transition(iterations, max_seconds)
+            # Serialize the transitioned states.
+            self._serialize_engine(bdb, generator_id, engine, True, statenos)
+            return
+
+        # Run the transitions in slices of about ckpt_seconds each, and
+        # save the transitioned states after every slice so that an
+        # interrupted analysis keeps what it has done so far.  Slices of
+        # timed analysis are timed; slices of analysis by iterations
+        # run as many iterations as we expect to fit in ckpt_seconds,
+        # judging by the previous slice.
+        start = time.time()
+        remaining = iterations
+        slice_iterations = 1
+        while True:
+            slice_start = time.time()
+            if max_seconds:
+                seconds_left = max_seconds - (slice_start - start)
+                if seconds_left <= 0:
+                    break
+            if iterations:
+                N = min(slice_iterations, remaining)
+                S = seconds_left if max_seconds else None
             else:
-                engine.transition(
-                    N=iterations,
-                    S=max_seconds,
-                    kernels=kernels,
-                    cols=vars_target_baseline,
-                    rowids=rowids_cgpm,
-                    progress=progress,
-                    checkpoint=ckpt_iterations,
-                    statenos=cgpm_modelnos,
-                    multiprocess=self._multiprocess,
-                )
+                N = None
+                S = min(ckpt_seconds, seconds_left)
+            transition(N, S)
+            with bdb.savepoint():
+                self._serialize_engine(
+                    bdb, generator_id, engine, True, statenos)
+            if iterations:
+                remaining -= N
+                if remaining <= 0:
+                    break
+                elapsed = time.time() - slice_start
+                if 0 < elapsed:
+                    slice_iterations = int(N * ckpt_seconds / elapsed)
+                    slice_iterations = max(1, min(2*N, slice_iterations))
+                else:
+                    slice_iterations = 2*N
 
-        # Run transitions on foreign variables.
-        if vars_target_foreign:
-            engine.transition_foreign(
-                N=iterations,
-                S=max_seconds,
-                cols=vars_target_foreign,
-                progress=progress,
-                statenos=cgpm_modelnos,
-                multiprocess=self._multiprocess,
-            )
 
-        # Serialize the engine.
-        self._serialize_engine(bdb, generator_id, engine, True)
+    def analyze_models_background(
+            self, bdb, generator_id, modelnos=None, iterations=None,
+            max_seconds=None, ckpt_iterations=None, ckpt_seconds=None,
+            program=None):
+        self.analyze_models(bdb, generator_id, modelnos=modelnos,
+            iterations=iterations, max_seconds=max_seconds,
+            ckpt_iterations=ckpt_iterations, ckpt_seconds=ckpt_seconds,
+            program=program, background=True)
+
+    def analysis_status(self, bdb, generator_id):
+        analysis = self._get_cache_entry(bdb, generator_id, 'analysis')
+        if analysis is None:
+            return None
+        analysis.poll()
+        return analysis.status()
 
+    def cancel_analysis(self, bdb, generator_id):
+        analysis = self._get_cache_entry(bdb, generator_id, 'analysis')
+        if analysis is not None:
+            analysis.cancel()
 
     def column_dependence_probability(
             self, bdb, generator_id, modelnos, colno0, colno1):
@@ -696,7 +901,7 @@ class CGPM_Backend(BayesDB_Backend):
         cgpm_modelnos = self._get_modelnos(bdb, generator_id, modelnos)
 
         # Get the engine.
-        engine = self._engine(bdb, generator_id)
+        engine = self._query_engine(bdb, generator_id)
 
         # Engine gives us a list of dependence probabilities which it is our
         # responsibility to integrate over.
@@ -706,6 +911,33 @@ class CGPM_Backend(BayesDB_Backend):
 
         return depprob_list
 
+    def column_dependence_probability_matrix(
+            self, bdb, generator_id, modelnos, colnos):
+        cgpm_modelnos = self._get_modelnos(bdb, generator_id, modelnos)
+        engine = self._engine(bdb, generator_id)
+        statenos = range(engine.num_states()) if cgpm_modelnos is None \
+            else cgpm_modelnos
+        states = [engine.states[s] for s in statenos]
+
+        # Dependence among variables modelled by crosscat alone is
+        # whether they share a view.  Variables of foreign cgpms depend
+        # on the network, so ask the engine about them pair by pair.
+        if any(state.hooked_cgpms for state in states) or \
+                any(colno not in state.outputs
+                    for state in states for colno in colnos):
+            return super(CGPM_Backend, self)\
+                .column_dependence_probability_matrix(
+                    bdb, generator_id, modelnos, colnos)
+
+        # Count, for each pair, the states in which the two variables
+        # are assigned to the same view.
+        counts = numpy.zeros((len(colnos), len(colnos)))
+        for state in states:
+            Zv = state.Zv()
+            views = numpy.array([Zv[colno] for colno in colnos])
+            counts += views[:, numpy.newaxis] == views[numpy.newaxis, :]
+        return counts / len(states)
+
     def column_mutual_information(
             self, bdb, generator_id, modelnos, colnos0, colnos1,
             constraints=None, numsamples=None):
@@ -742,15 +974,15 @@ class CGPM_Backend(BayesDB_Backend):
         cgpm_modelnos = self._get_modelnos(bdb, generator_id, modelnos)
 
         # Map the variable and individual indexing.
-        cgpm_rowid = self._cgpm_rowid(bdb, generator_id, rowid)
-        cgpm_target_rowid = self._cgpm_rowid(bdb, generator_id, target_rowid)
+        cgpm_rowid, cgpm_target_rowid = self._cgpm_rowids(
+            bdb, generator_id, [rowid, target_rowid])
 
         # XXX TODO: If neither rowids are incorporated, return None.
         if cgpm_rowid == -1 or cgpm_target_rowid == -1:
             return [float('nan')]
 
         # Get the engine.
-        engine = self._engine(bdb, generator_id)
+        engine = self._query_engine(bdb, generator_id)
 
         # Engine gives us a list of similarities which it is our
         # responsibility to integrate over.
@@ -760,6 +992,44 @@ class CGPM_Backend(BayesDB_Backend):
 
         return similarity_list
 
+    def row_similarity_matrix(
+            self, bdb, generator_id, modelnos, rowids0, rowids1, colno):
+        cgpm_modelnos = self._get_modelnos(bdb, generator_id, modelnos)
+        engine = self._engine(bdb, generator_id)
+        statenos = range(engine.num_states()) if cgpm_modelnos is None \
+            else cgpm_modelnos
+        states = [engine.states[s] for s in statenos]
+
+        # Only variables modelled by crosscat have a view whose row
+        # clusters determine similarity.
+        if any(colno not in state.outputs for state in states):
+            return super(CGPM_Backend, self).row_similarity_matrix(
+                bdb, generator_id, modelnos, rowids0, rowids1, colno)
+
+        # Map the individual indexing once for all distinct rows.
+        cgpm_rowids0 = self._cgpm_rowids(bdb, generator_id, rowids0)
+        cgpm_rowids1 = self._cgpm_rowids(bdb, generator_id, rowids1)
+        # Rows not incorporated have no similarity, as in row_similarity.
+        missing0 = numpy.array([r == -1 for r in cgpm_rowids0], dtype=bool)
+        missing1 = numpy.array([r == -1 for r in cgpm_rowids1], dtype=bool)
+
+        # Count, for each pair, the states in which the two rows are
+        # assigned to the same cluster of the view of colno.
+        counts = numpy.zeros((len(rowids0), len(rowids1)))
+        for state in states:
+            view = state.views[state.Zv()[colno]]
+            clusters = {
+                r: view.Zr(r) for r in set(cgpm_rowids0) | set(cgpm_rowids1)
+                if r != -1
+            }
+            z0 = numpy.array([clusters.get(r, -1) for r in cgpm_rowids0])
+            z1 = numpy.array([clusters.get(r, -1) for r in cgpm_rowids1])
+            counts += z0[:, numpy.newaxis] == z1[numpy.newaxis, :]
+        similarities = counts / len(states)
+        similarities[missing0, :] = float('nan')
+        similarities[:, missing1] = float('nan')
+        return similarities
+
     def predictive_relevance(
             self, bdb, generator_id, modelnos, rowid_target, rowid_query,
             hypotheticals, colno):
@@ -779,7 +1049,7 @@ class CGPM_Backend(BayesDB_Backend):
         # drop any rowids which are not incorporated.
         cgpm_rowid_query = filter(
             lambda r: r != -1,
-            [self._cgpm_rowid(bdb, generator_id, r) for r in rowid_query]
+            self._cgpm_rowids(bdb, generator_id, rowid_query)
         )
 
         # If the query rowids are all not incorporated and no hypotheticals,
@@ -861,7 +1131,7 @@ class CGPM_Backend(BayesDB_Backend):
             if not math.isnan(value_numeric):
                 cgpm_constraints.update({colno: value_numeric})
         # Retrieve the engine.
-        engine = self._engine(bdb, generator_id)
+        engine = self._query_engine(bdb, generator_id)
         samples = engine.simulate(
             rowid=cgpm_rowid,
             targets=cgpm_targets,
@@ -880,12 +1150,14 @@ class CGPM_Backend(BayesDB_Backend):
             statenos=cgpm_modelnos,
             multiprocess=self._multiprocess
         )
-        def map_value(colno, value):
-            return self._from_numeric(bdb, generator_id, colno, value)
-        return [
-            [map_value(colno, row[colno]) for colno in cgpm_targets]
-            for row in weighted_samples
+        if not cgpm_targets:
+            return [[] for _row in weighted_samples]
+        columns = [
+            self._from_numeric_many(bdb, generator_id, colno,
+                [row[colno] for row in weighted_samples])
+            for colno in cgpm_targets
         ]
+        return map(list, zip(*columns))
 
     def logpdf_joint(
             self, bdb, generator_id, modelnos, rowid, targets, constraints):
@@ -903,7 +1175,7 @@ class CGPM_Backend(BayesDB_Backend):
             if not math.isnan(value_numeric):
                 cgpm_constraints.update({colno: value_numeric})
         # Retrieve the engine.
-        engine = self._engine(bdb, generator_id)
+        engine = self._query_engine(bdb, generator_id)
         logpdfs = engine.logpdf(
             rowid=cgpm_rowid,
             targets=cgpm_targets,
@@ -922,12 +1194,161 @@ class CGPM_Backend(BayesDB_Backend):
             multiprocess=self._multiprocess,
         )
 
+    def logpdf_joint_batch(self, bdb, generator_id, modelnos, rows):
+        # Evaluate each state once over the whole batch: one bulk call
+        # for the densities of the targets of every distinct query, and
+        # one for the likelihood of every distinct (rowid, constraints)
+        # pair, which weights the states, rather than two engine calls
+        # per row as logpdf_joint would make.
+        if not rows:
+            return []
+        cgpm_modelnos = self._get_modelnos(bdb, generator_id, modelnos)
+        engine = self._query_engine(bdb, generator_id)
+        cgpm_rowids = self._cgpm_rowids(
+            bdb, generator_id, [rowid for rowid, _targets, _constraints in rows])
+        numerics = {}
+        def to_numeric(colno, value):
+            key = (colno, value)
+            if key not in numerics:
+                numerics[key] = self._to_numeric(
+                    bdb, generator_id, colno, value)
+            return numerics[key]
+        queries = []            # distinct (rowid, targets, constraints)
+        query_index = {}
+        evidence = []           # distinct (rowid, constraints), if any
+        evidence_index = {}
+        row_indices = []        # (query index, evidence index or None)
+        for cgpm_rowid, (_rowid, targets, constraints) in \
+                zip(cgpm_rowids, rows):
+            cgpm_targets = tuple(sorted(
+                (colno, to_numeric(colno, value))
+                for colno, value in targets))
+            # Build the evidence, ignoring nan values.
+            cgpm_constraints = []
+            for colno, value in constraints:
+                value_numeric = to_numeric(colno, value)
+                if not math.isnan(value_numeric):
+                    cgpm_constraints.append((colno, value_numeric))
+            cgpm_constraints = tuple(sorted(cgpm_constraints))
+            query = (cgpm_rowid, cgpm_targets, cgpm_constraints)
+            if query not in query_index:
+                query_index[query] = len(queries)
+                queries.append(query)
+            e = None
+            if cgpm_constraints:
+                key = (cgpm_rowid, cgpm_constraints)
+                if key not in evidence_index:
+                    evidence_index[key] = len(evidence)
+                    evidence.append(key)
+                e = evidence_index[key]
+            row_indices.append((query_index[query], e))
+        # Each is a list, per state, of a list, per query, of logpdfs.
+        logpdfs = engine.logpdf_bulk(
+            rowids=[rowid for rowid, _targets, _constraints in queries],
+            targets_list=[dict(targets) for _r, targets, _c in queries],
+            constraints_list=[
+                dict(constraints) for _r, _t, constraints in queries
+            ],
+            inputs_list=None,
+            statenos=cgpm_modelnos,
+            multiprocess=self._multiprocess
+        )
+        weights = engine.logpdf_bulk(
+            rowids=[rowid for rowid, _constraints in evidence],
+            targets_list=[dict(constraints) for _r, constraints in evidence],
+            constraints_list=None,
+            inputs_list=None,
+            statenos=cgpm_modelnos,
+            multiprocess=self._multiprocess
+        ) if evidence else None
+        # Average the densities of the states, weighted by the
+        # likelihood of the constraints under each, as
+        # engine._likelihood_weighted_integrate does for one query.
+        results = []
+        for q, e in row_indices:
+            state_logpdfs = [state[q] for state in logpdfs]
+            if e is None:
+                results.append(logsumexp(state_logpdfs)
+                    - math.log(len(state_logpdfs)))
+            else:
+                state_weights = [state[e] for state in weights]
+                results.append(logsumexp([w + l
+                        for w, l in zip(state_weights, state_logpdfs)])
+                    - logsumexp(state_weights))
+        return results
+
     def _unique_rowid(self, rowids):
         if len(set(rowids)) != 1:
             raise ValueError('Multiple-row query: %r' % (list(set(rowids)),))
         return rowids[0]
 
     def _data(self, bdb, generator_id, vars):
+        # Returns a float64 matrix with a row for each individual and a
+        # column for each of `vars`, with NaN for missing values.
+        qt, qexpressions = self._data_expressions(bdb, generator_id, vars)
+
+        # Get a cursor.
+        cursor = bdb.sql_execute('''
+            SELECT %s FROM %s AS t, bayesdb_cgpm_individual AS ci
+                WHERE ci.generator_id = :generator_id
+                    AND ci.table_rowid = t._rowid_
+            ORDER BY t._rowid_ ASC
+        ''' % (qexpressions, qt), {'generator_id': generator_id})
+
+        # Convert the rows to floats in one go, with NULL as NaN.
+        rows = cursor.fetchall()
+        return numpy.array(rows, dtype=float).reshape((len(rows), len(vars)))
+
+    def _new_data(self, bdb, generator_id, vars):
+        # Returns the rowids of the rows appended to the table since the
+        # generator last saw it, and their matrix as _data would give
+        # it.  The models cannot represent nominal values that have no
+        # code, so fail if there are any.
+        qt, qexpressions = self._data_expressions(bdb, generator_id, vars)
+        new = '''
+            t._rowid_ > (
+                SELECT COALESCE(last_table_rowid, 0)
+                    FROM bayesdb_cgpm_generator
+                    WHERE generator_id = :generator_id
+            )
+        '''
+        population_id = core.bayesdb_generator_population(bdb, generator_id)
+        for var in vars:
+            colno = core.bayesdb_variable_number(
+                bdb, population_id, generator_id, var)
+            if colno < 0 or not _is_nominal(core.bayesdb_variable_stattype(
+                    bdb, population_id, generator_id, colno)):
+                continue
+            qv = 't.%s' % (sqlite3_quote_name(var),)
+            cursor = bdb.sql_execute('''
+                SELECT %s FROM %s AS t
+                    WHERE %s AND %s IS NOT NULL
+                        AND NOT EXISTS (
+                            SELECT 1 FROM bayesdb_cgpm_category AS cc
+                                WHERE cc.generator_id = :generator_id
+                                    AND cc.colno = :colno
+                                    AND cc.value = CAST(%s AS TEXT)
+                        )
+                    LIMIT 1
+            ''' % (qv, qt, new, qv, qv),
+                {'generator_id': generator_id, 'colno': colno})
+            for (value,) in cursor:
+                raise BQLError(bdb, 'Cannot incorporate new category'
+                    ' of variable %r: %r' % (var, value))
+        cursor = bdb.sql_execute('''
+            SELECT t._rowid_, %s FROM %s AS t
+                WHERE %s
+            ORDER BY t._rowid_ ASC
+        ''' % (qexpressions, qt, new), {'generator_id': generator_id})
+        rows = cursor.fetchall()
+        rowids = [row[0] for row in rows]
+        data = numpy.array([row[1:] for row in rows], dtype=float)
+        return rowids, data.reshape((len(rows), len(vars)))
+
+    def _data_expressions(self, bdb, generator_id, vars):
+        # Returns the quoted table name, and the SQL expressions for the
+        # numerical values of `vars` in a row t of it.
+
         # Get the column numbers.
         population_id = core.bayesdb_generator_population(bdb, generator_id)
         colnos = [
@@ -939,26 +1360,26 @@ class CGPM_Backend(BayesDB_Backend):
         table_name = core.bayesdb_generator_table(bdb, generator_id)
         qt = sqlite3_quote_name(table_name)
 
-        # Get the variable names, treating latents as NULL.
+        # Get the variable names, treating latents as NULL, and let
+        # SQLite map the values of nominal variables to their codes,
+        # looking them up by text as _CategoryCodes.code does.
+        def qexpression(var, colno):
+            if colno < 0:
+                return 'NULL'
+            qv = 't.%s' % (sqlite3_quote_name(var),)
+            stattype = core.bayesdb_variable_stattype(
+                bdb, population_id, generator_id, colno)
+            if not _is_nominal(stattype):
+                return qv
+            return '''(
+                SELECT cc.code FROM bayesdb_cgpm_category AS cc
+                    WHERE cc.generator_id = :generator_id
+                        AND cc.colno = %d
+                        AND cc.value = CAST(%s AS TEXT)
+            )''' % (colno, qv)
         qexpressions = ','.join(
-            't.%s' % (sqlite3_quote_name(v),) if (0 <= colno) else 'NULL'
-            for v, colno in zip(vars, colnos))
-
-        # Get a cursor.
-        cursor = bdb.sql_execute('''
-            SELECT %s FROM %s AS t, bayesdb_cgpm_individual AS ci
-                WHERE ci.generator_id = ?
-                    AND ci.table_rowid = t._rowid_
-            ORDER BY t._rowid_ ASC
-        ''' % (qexpressions, qt), (generator_id,))
-
-        # Map values to codes.
-        def map_value(colno, value):
-            return self._to_numeric(bdb, generator_id, colno, value)
-        return [
-            tuple(map_value(colno, x) for colno, x in zip(colnos, row))
-            for row in cursor
-        ]
+            qexpression(var, colno) for var, colno in zip(vars, colnos))
+        return qt, qexpressions
 
     def _initialize_engine(self, bdb, generator_id, n, variables):
         population_id = core.bayesdb_generator_population(bdb, generator_id)
@@ -980,11 +1401,8 @@ class CGPM_Backend(BayesDB_Backend):
             gpmcc_data = self._data(bdb, generator_id, gpmcc_vars)
             # If gpmcc_data has any column which is all null, then crash early
             # and notify the user of all offending column names.
-            n_rows = len(gpmcc_data)
-            nulls = [
-                v for i, v in enumerate(gpmcc_vars)
-                if all(math.isnan(gpmcc_data[r][i]) for r in xrange(n_rows))
-            ]
+            all_null = numpy.all(numpy.isnan(gpmcc_data), axis=0)
+            nulls = [v for v, null in zip(gpmcc_vars, all_null) if null]
             if nulls:
                 raise BQLError(bdb, 'Failed to initialize, '
                     'columns have all null values: %s' % repr(nulls))
@@ -1066,21 +1484,35 @@ class CGPM_Backend(BayesDB_Backend):
 
         # Not cached or mismatched stamps. Load the engine from the database.
         cursor = bdb.sql_execute('''
-            SELECT engine_json, engine_stamp FROM bayesdb_cgpm_generator
+            SELECT engine_blob, engine_stamp FROM bayesdb_cgpm_generator
                 WHERE generator_id = ?
         ''', (generator_id,)).fetchall()
-        engine_json, engine_stamp = cursor[0]
+        engine_blob, engine_stamp = cursor[0]
+        self._memoize_engine_stamp(bdb, generator_id, engine_stamp)
 
         # Check if the generator has an initialized engine.
-        if not engine_json:
+        if not engine_blob:
             generator = core.bayesdb_generator_name(bdb, generator_id)
             raise BQLError(bdb, 'No models initialized for generator: %r'
                 % (generator,))
 
-        # Deserialize the engine.
+        # Another connection may have changed the generator since we
+        # last loaded it, so forget the category codes too.
+        self._del_cache_entry(bdb, generator_id, 'categories')
+
+        # Deserialize the engine, but leave its states encoded until a
+        # query uses them.
+        metadata = decode_metadata(engine_blob)
+        cursor = bdb.sql_execute('''
+            SELECT state_blob FROM bayesdb_cgpm_state
+                WHERE generator_id = ?
+                ORDER BY cgpm_modelno ASC
+        ''', (generator_id,))
+        blobs = [blob for (blob,) in cursor]
+        metadata['states'] = []
         engine = Engine.from_metadata(
-            json.loads(engine_json), rng=bdb.np_prng,
-            multiprocess=self._multiprocess)
+            metadata, rng=bdb.np_prng, multiprocess=self._multiprocess)
+        engine.states = _LazyStates(blobs, metadata.get('X'), bdb.np_prng)
 
         # Cache the engine with its stamp.
         self._set_cache_entry(bdb, generator_id, 'engine', engine)
@@ -1088,6 +1520,29 @@ class CGPM_Backend(BayesDB_Backend):
 
         return engine
 
+    def _query_engine(self, bdb, generator_id):
+        # Return the engine, or, with multiprocessing on, a stand-in
+        # for it that evaluates the states resident in the pool.
+        engine = self._engine(bdb, generator_id)
+        if not self._multiprocess:
+            return engine
+        if self._pool is None:
+            self._pool = StatePool(_decode_state)
+        # Reload the states if the engine has changed since we last
+        # loaded them, or if the pool has since lost them.
+        stamp = self._get_cache_entry(bdb, generator_id, 'stamp')
+        pooled = self._get_cache_entry(bdb, generator_id, 'pooled')
+        if pooled is None or pooled[0] is not engine or \
+                pooled[1] != stamp or not self._pool.loaded(pooled[2]):
+            if pooled is not None:
+                self._pool.drop(pooled[2])
+            key = next(self._pool_keys)
+            X, blobs, seeds = _encode_states(engine, bdb.np_prng)
+            self._pool.load(key, X, blobs, seeds)
+            pooled = (engine, stamp, key)
+            self._set_cache_entry(bdb, generator_id, 'pooled', pooled)
+        return _PooledEngine(engine, self._pool, pooled[2], bdb.np_prng)
+
     def _engine_latest(self, bdb, generator_id):
         # Check whether there is a cached_engine.
         cached_engine = self._get_cache_entry(bdb, generator_id, 'engine')
@@ -1105,31 +1560,77 @@ class CGPM_Backend(BayesDB_Backend):
         return cached_engine if cached_stamp == latest_stamp else None
 
     def _engine_stamp(self, bdb, generator_id):
+        # Nobody else can change the stamp in the middle of a statement
+        # or transaction, so look it up only once in each, rather than
+        # for every row of a query.
+        stamps = self._engine_stamps(bdb)
+        if stamps is not None and generator_id in stamps:
+            return stamps[generator_id]
         cursor = bdb.sql_execute('''
             SELECT engine_stamp FROM bayesdb_cgpm_generator
                 WHERE generator_id = ?
         ''', (generator_id,))
-        return cursor_value(cursor)
+        engine_stamp = cursor_value(cursor)
+        self._memoize_engine_stamp(bdb, generator_id, engine_stamp)
+        return engine_stamp
+
+    def _engine_stamps(self, bdb):
+        # Engine stamps memoized in the transaction cache, if any.
+        if bdb.cache is None:
+            return None
+        return bdb.cache.setdefault('cgpm_engine_stamps', {})
 
-    def _serialize_engine(self, bdb, generator_id, engine, cache):
-        # Write the engine to JSON.
-        engine_json = json_dumps(engine.to_metadata())
+    def _memoize_engine_stamp(self, bdb, generator_id, engine_stamp):
+        stamps = self._engine_stamps(bdb)
+        if stamps is not None:
+            if engine_stamp is None:
+                stamps.pop(generator_id, None)
+            else:
+                stamps[generator_id] = engine_stamp
 
+    def _serialize_engine(self, bdb, generator_id, engine, cache,
+            statenos=None):
         # Increment the stamp.
         engine_stamp_old = self._engine_stamp(bdb, generator_id)
         engine_stamp_new = engine_stamp_old + 1
 
-        # Update the engine and stamp.
+        if statenos is None:
+            # Encode the engine-wide metadata and every state.
+            metadata = engine.to_metadata()
+            states = enumerate(metadata.pop('states'))
+            bdb.sql_execute('''
+                UPDATE bayesdb_cgpm_generator
+                    SET engine_blob = :engine_blob,
+                        engine_stamp = :engine_stamp
+                    WHERE generator_id = :generator_id
+            ''', {
+                'engine_blob': buffer(encode_metadata(metadata)),
+                'engine_stamp': engine_stamp_new,
+                'generator_id': generator_id,
+            })
+        else:
+            # Encode only the given states; the rest are unchanged.
+            states = (
+                (stateno, engine.states[stateno].to_metadata())
+                for stateno in statenos
+            )
+            bdb.sql_execute('''
+                UPDATE bayesdb_cgpm_generator
+                    SET engine_stamp = :engine_stamp
+                    WHERE generator_id = :generator_id
+            ''', {
+                'engine_stamp': engine_stamp_new,
+                'generator_id': generator_id,
+            })
+
+        self._memoize_engine_stamp(bdb, generator_id, engine_stamp_new)
+
+        # Update the states, and delete any left over from dropped models.
+        _store_states(bdb, generator_id, states, engine_stamp_new)
         bdb.sql_execute('''
-            UPDATE bayesdb_cgpm_generator
-                SET engine_json = :engine_json,
-                    engine_stamp = :engine_stamp
-                WHERE generator_id = :generator_id
-        ''', {
-            'engine_json': engine_json,
-            'engine_stamp': engine_stamp_new,
-            'generator_id': generator_id,
-        })
+            DELETE FROM bayesdb_cgpm_state
+                WHERE generator_id = ? AND cgpm_modelno >= ?
+        ''', (generator_id, engine.num_states()))
 
         # Add it to the cache.
         if cache:
@@ -1137,43 +1638,116 @@ class CGPM_Backend(BayesDB_Backend):
             self._set_cache_entry(bdb, generator_id, 'stamp', engine_stamp_new)
 
 
-    def _retrieve_cache(self, bdb,):
-        if bdb in self._cache:
-            return self._cache[bdb]
-        self._cache[bdb] = dict()
-        return self._cache[bdb]
+    def _start_analysis(self, bdb, generator_id, engine, plan, iterations,
+            max_seconds, ckpt_iterations, ckpt_seconds):
+        # The worker commits its results to the database file on its
+        # own connection, so it needs a file, and the main connection
+        # must not hold uncommitted changes it cannot see.
+        if bdb.pathname in ('', ':memory:'):
+            raise BQLError(bdb,
+                'Background analysis needs a database on disk.')
+        if not bdb._sqlite3.getautocommit():
+            raise BQLError(bdb,
+                'Background analysis cannot start in a transaction.')
+        # Under the rollback journal, the worker cannot commit while we
+        # have a statement open, and we cannot read while it commits.
+        # With a write-ahead log, readers and the writer do not block
+        # one another.  The journal mode persists in the file.
+        journal_mode = bdb.sql_execute('PRAGMA journal_mode=WAL').fetchall()
+        if journal_mode != [('wal',)]:
+            raise BQLError(bdb, 'Background analysis needs a database'
+                ' that can use a write-ahead log: %r' % (journal_mode,))
+        statenos = plan['statenos']
+        if statenos is None:
+            statenos = range(engine.num_states())
+        cursor = bdb.sql_execute('''
+            SELECT cgpm_modelno, modelno FROM bayesdb_cgpm_modelno
+                WHERE generator_id = ?
+        ''', (generator_id,))
+        modelnos = dict(cursor.fetchall())
+        # The worker is a daemon, so that it dies with us, and daemons
+        # cannot have children, so it transitions its states serially.
+        # Progress bars and diagnostics by iteration are of no use there.
+        plan = dict(plan, statenos=statenos, progress=False, checkpoint=1)
+        reader, writer = multiprocessing.Pipe(False)
+        progress = multiprocessing.Array('d', 2 + len(statenos))
+        process = multiprocessing.Process(
+            target=_analyze_in_background,
+            args=(writer, progress, bdb.pathname, generator_id,
+                self._engine_stamp(bdb, generator_id), engine, plan,
+                iterations, max_seconds, ckpt_iterations, ckpt_seconds))
+        process.daemon = True
+        process.start()
+        writer.close()
+        # Wait for the worker, rather than fail, if a query finds the
+        # database locked meanwhile.
+        bdb._sqlite3.setbusytimeout(_BUSY_TIMEOUT_MS)
+        analysis = _BackgroundAnalysis(process, reader, progress,
+            [modelnos[stateno] for stateno in statenos])
+        self._set_cache_entry(bdb, generator_id, 'analysis', analysis)
+
+    def _check_analysis(self, bdb, generator_id):
+        # Refuse to change the models under a running background
+        # analysis.
+        analysis = self._get_cache_entry(bdb, generator_id, 'analysis')
+        if analysis is None:
+            return
+        analysis.poll()
+        if analysis.running:
+            generator = core.bayesdb_generator_name(bdb, generator_id)
+            raise BQLError(bdb, 'Generator is being analyzed in the'
+                ' background: %r' % (generator,))
 
     def _set_cache_entry(self, bdb, generator_id, key, value):
-        cache = self._retrieve_cache(bdb)
-        if generator_id not in cache:
-            cache[generator_id] = dict()
-        cache[generator_id][key] = value
+        self._cache.set(bdb, generator_id, key, value)
 
     def _get_cache_entry(self, bdb, generator_id, key):
         # Returns None if the generator_id or key do not exist.
-        cache = self._retrieve_cache(bdb)
-        if generator_id not in cache:
-            return None
-        if key not in cache[generator_id]:
-            return None
-        return cache[generator_id][key]
+        return self._cache.get(bdb, generator_id, key)
 
     def _del_cache_entry(self, bdb, generator_id, key):
         # If key is None, wipes bdb[generator_id] in its entirety.
-        cache = self._retrieve_cache(bdb)
-        if generator_id in cache:
-            if key is None:
-                del cache[generator_id]
-            elif key in cache[generator_id]:
-                del cache[generator_id][key]
+        self._cache.delete(bdb, generator_id, key)
+
+    def _cache_release(self, entries):
+        # The engine cache has evicted a generator, or its bdb is gone:
+        # free its states in the pool, and stop any background analysis.
+        if 'pooled' in entries and self._pool is not None:
+            self._pool.drop(entries['pooled'][2])
+        if 'analysis' in entries:
+            entries['analysis'].cancel()
 
     def _cgpm_rowid(self, bdb, generator_id, table_rowid, nullok=True):
+        [cgpm_rowid] = self._cgpm_rowids(bdb, generator_id, [table_rowid])
+        if cgpm_rowid == -1 and not nullok:
+            raise ValueError('Row not incorporated: %r' % (table_rowid,))
+        return cgpm_rowid
+
+    def _cgpm_rowids(self, bdb, generator_id, table_rowids):
+        """Return the list of cgpm rowids of `table_rowids`.
+
+        Rows not incorporated into the generator map to -1.
+        """
+        return self._rowid_map(bdb, generator_id).cgpm_rowids(table_rowids)
+
+    def _rowid_map(self, bdb, generator_id):
+        """Return the :class:`_RowidMap` of a generator.
+
+        The map is read from the database once and kept until the
+        engine stamp changes or individuals are added.
+        """
+        stamp = self._engine_stamp(bdb, generator_id)
+        cached = self._get_cache_entry(bdb, generator_id, 'rowids')
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
         cursor = bdb.sql_execute('''
-            SELECT cgpm_rowid FROM bayesdb_cgpm_individual
-                WHERE generator_id = ? AND table_rowid = ?
-        ''', (generator_id, table_rowid))
-        cgpm_rowid = cursor_value(cursor, nullok=nullok)
-        return cgpm_rowid if cgpm_rowid is not None else -1
+            SELECT table_rowid, cgpm_rowid FROM bayesdb_cgpm_individual
+                WHERE generator_id = ?
+                ORDER BY table_rowid ASC
+        ''', (generator_id,))
+        rowid_map = _RowidMap(cursor.fetchall())
+        self._set_cache_entry(bdb, generator_id, 'rowids', (stamp, rowid_map))
+        return rowid_map
 
     def _to_numeric(self, bdb, generator_id, colno, value):
         """Convert value in bayeslite to equivalent cgpm format."""
@@ -1184,15 +1758,9 @@ class CGPM_Backend(BayesDB_Backend):
         # the user supplied, as a float.
         if colno < 0:
             return float(value)
-        population_id = core.bayesdb_generator_population(bdb, generator_id)
-        stattype = core.bayesdb_variable_stattype(
-            bdb, population_id, generator_id, colno)
-        if _is_nominal(stattype):
-            cursor = bdb.sql_execute('''
-                SELECT code FROM bayesdb_cgpm_category
-                    WHERE generator_id = ? AND colno = ? AND value = ?
-            ''', (generator_id, colno, value))
-            integer = cursor_value(cursor, nullok=True)
+        categories = self._category_codes(bdb, generator_id, colno)
+        if categories is not None:
+            integer = categories.code(bdb, value)
             if integer is None:
                 return float('NaN')
                 # raise BQLError('Invalid category: %r' % (value,))
@@ -1200,30 +1768,96 @@ class CGPM_Backend(BayesDB_Backend):
         else:
             return value
 
+    def _to_numeric_many(self, bdb, generator_id, colno, values):
+        """Convert a column of bayeslite values to a cgpm float64 array."""
+        nan = float('NaN')
+        if colno < 0:
+            converted = (nan if v is None else float(v) for v in values)
+        else:
+            categories = self._category_codes(bdb, generator_id, colno)
+            if categories is not None:
+                def code(v):
+                    if v is None:
+                        return nan
+                    integer = categories.code(bdb, v)
+                    return nan if integer is None else integer
+                converted = (code(v) for v in values)
+            else:
+                converted = (nan if v is None else v for v in values)
+        return numpy.fromiter(converted, dtype=float, count=len(values))
+
     def _from_numeric(self, bdb, generator_id, colno, value):
         """Convert value in cgpm to equivalent bayeslite format."""
         if math.isnan(value):
             return None
-        population_id = core.bayesdb_generator_population(bdb, generator_id)
-        stattype = core.bayesdb_variable_stattype(
-            bdb, population_id, generator_id, colno)
-        if _is_nominal(stattype):
-            # XXX Latent variables are not associated with an entry in
-            # bayesdb_cgpm_category, so just pass through whatever value cgpm
-            # returns as a string.
-            if colno < 0:
-                return str(value)
-            cursor = bdb.sql_execute('''
-                SELECT value FROM bayesdb_cgpm_category
-                    WHERE generator_id = ? AND colno = ? AND code = ?
-            ''', (generator_id, colno, value))
-            text = cursor_value(cursor, nullok=True)
+        # XXX Latent variables are not associated with an entry in
+        # bayesdb_cgpm_category, so just pass through whatever value cgpm
+        # returns as a string.
+        if colno < 0:
+            population_id = core.bayesdb_generator_population(
+                bdb, generator_id)
+            stattype = core.bayesdb_variable_stattype(
+                bdb, population_id, generator_id, colno)
+            return str(value) if _is_nominal(stattype) else value
+        categories = self._category_codes(bdb, generator_id, colno)
+        if categories is not None:
+            text = categories.value(value)
             if text is None:
-                raise BQLError('Invalid category: %r' % (value,))
+                raise BQLError(bdb, 'Invalid category: %r' % (value,))
             return text
         else:
             return value
 
+    def _from_numeric_many(self, bdb, generator_id, colno, values):
+        """Convert a column of cgpm values to a list of bayeslite values."""
+        if colno < 0:
+            return [
+                self._from_numeric(bdb, generator_id, colno, value)
+                for value in values
+            ]
+        values = numpy.asarray(values, dtype=float)
+        missing = numpy.isnan(values)
+        categories = self._category_codes(bdb, generator_id, colno)
+        if categories is None:
+            return [
+                None if missing_i else value
+                for value, missing_i in zip(values.tolist(), missing)
+            ]
+        result = numpy.empty(len(values), dtype=object)
+        codes = values[~missing]
+        texts = categories.values(codes)
+        if texts is None:
+            invalid = [c for c in codes if categories.value(c) is None]
+            raise BQLError(bdb, 'Invalid category: %r' % (invalid[0],))
+        result[~missing] = texts
+        return result.tolist()
+
+    def _category_codes(self, bdb, generator_id, colno):
+        """Return the :class:`_CategoryCodes` of a nominal `colno`.
+
+        Returns None if `colno` is not nominal.  The codes of each
+        column are read from the database only once until they are
+        invalidated by adding a column or reloading the engine.
+        """
+        cache = self._get_cache_entry(bdb, generator_id, 'categories')
+        if cache is None:
+            cache = {}
+            self._set_cache_entry(bdb, generator_id, 'categories', cache)
+        if colno not in cache:
+            population_id = core.bayesdb_generator_population(
+                bdb, generator_id)
+            stattype = core.bayesdb_variable_stattype(
+                bdb, population_id, generator_id, colno)
+            if _is_nominal(stattype):
+                cursor = bdb.sql_execute('''
+                    SELECT value, code FROM bayesdb_cgpm_category
+                        WHERE generator_id = ? AND colno = ?
+                ''', (generator_id, colno))
+                cache[colno] = _CategoryCodes(cursor)
+            else:
+                cache[colno] = None
+        return cache[colno]
+
     def _retrieve_baseline_variables(self, bdb, generator_id):
         # XXX Store this data in the bdb.
         engine = self._engine(bdb, generator_id)
@@ -1284,11 +1918,7 @@ class CGPM_Backend(BayesDB_Backend):
             SELECT 1 FROM %s WHERE oid = ?
         ''' % (qt,), (rowid,)).fetchall()
         # Is the rowid incorporated into the cgpm?
-        incorporated = bdb.sql_execute('''
-            SELECT 1 FROM bayesdb_cgpm_individual
-            WHERE generator_id = ? AND table_rowid = ?
-            LIMIT 1
-        ''', (generator_id, rowid,)).fetchall()
+        incorporated = self._cgpm_rowid(bdb, generator_id, rowid) != -1
         # Populate values if necessary.
         table_constraints = []
         if exists and (not incorporated):
@@ -1379,6 +2009,649 @@ class CGPM_Backend(BayesDB_Backend):
         return kernels
 
 
+class _BackgroundAnalysis(object):
+    """Handle on an analysis running in a worker process.
+
+    The worker keeps its latest progress in a shared array -- the
+    iterations, the seconds, and the score of each state -- and sends
+    only its final report over a pipe, which we read when asked for
+    the status.  A pipe filling up with reports no one reads would
+    block the worker.
+    """
+
+    def __init__(self, process, conn, progress, modelnos):
+        self._process = process
+        self._conn = conn
+        self._progress = progress
+        self._modelnos = modelnos
+        self.running = True
+        self._error = None
+        self._report = {'iterations': 0, 'seconds': 0., 'logscores': []}
+
+    def poll(self):
+        """Read the worker's progress, and its final report if any."""
+        if not self.running:
+            return
+        with self._progress.get_lock():
+            progress = self._progress[:]
+        iterations = int(progress[0])
+        if iterations:
+            self._report = {
+                'iterations': iterations,
+                'seconds': progress[1],
+                'logscores': progress[2:],
+            }
+        if self._conn.poll():
+            try:
+                kind, report = self._conn.recv()
+            except EOFError:
+                self._stop('Background analysis exited unexpectedly.')
+                return
+            if kind == 'error':
+                self._stop(report)
+            else:
+                self._report = report
+                self._stop(None)
+
+    def cancel(self):
+        """Kill the worker, if it is still running."""
+        self.poll()
+        if self.running:
+            self._process.terminate()
+            self._stop('Background analysis cancelled.')
+
+    def status(self):
+        return {
+            'running': self.running,
+            'iterations': self._report['iterations'],
+            'seconds': self._report['seconds'],
+            'logscores': dict(zip(self._modelnos, self._report['logscores'])),
+            'error': self._error,
+        }
+
+    def _stop(self, error):
+        self.running = False
+        self._error = error
+        self._process.join()
+        self._conn.close()
+
+class _CategoryCodes(object):
+    """Codes of the values of one nominal column of a CGPM generator.
+
+    Values are stored in ``bayesdb_cgpm_category`` as text, so a
+    number is looked up by its text, as SQLite would convert it when
+    comparing it with the ``value`` column.
+    """
+
+    def __init__(self, pairs):
+        self._codes = {}
+        self._values = {}
+        for value, code in pairs:
+            self._codes[value] = code
+            self._values[code] = value
+        self._keys = {}
+        # Codes are normally 0, 1, ..., n - 1, so that an array indexed
+        # by code converts many codes at once.
+        n = len(self._values)
+        if sorted(self._values) == range(n):
+            self._table = numpy.array(
+                [self._values[code] for code in xrange(n)], dtype=object)
+        else:
+            self._table = None
+
+    def code(self, bdb, value):
+        """Return the code of `value`, or None if it has none."""
+        if isinstance(value, basestring):
+            return self._codes.get(value)
+        if isinstance(value, (int, long)):
+            return self._codes.get(unicode(int(value)))
+        try:
+            key = self._keys[value]
+        except (KeyError, TypeError):
+            key = cursor_value(
+                bdb.sql_execute('SELECT CAST(? AS TEXT)', (value,)))
+            try:
+                self._keys[value] = key
+            except TypeError:
+                pass
+        return self._codes.get(key)
+
+    def value(self, code):
+        """Return the value with `code`, or None if there is none."""
+        return self._values.get(code)
+
+    def values(self, codes):
+        """Return an array of the values of the array `codes`.
+
+        Returns None if any code has no value.
+        """
+        if self._table is None:
+            values = [self._values.get(code) for code in codes]
+            if any(value is None for value in values):
+                return None
+            return values
+        integers = codes.astype(int)
+        if len(codes) and (numpy.any(integers != codes) or
+                numpy.any(integers < 0) or
+                numpy.any(len(self._table) <= integers)):
+            return None
+        return self._table[integers]
+
+class _RowidMap(object):
+    """Map from table rowids to cgpm rowids of one CGPM generator.
+
+    The pairs are kept in two NumPy arrays sorted by table rowid, so
+    that many rowids are looked up at once with a binary search.
+    """
+
+    def __init__(self, pairs):
+        pairs = numpy.array(pairs, dtype=numpy.int64).reshape((-1, 2))
+        order = numpy.argsort(pairs[:, 0], kind='mergesort')
+        self._table_rowids = pairs[order, 0]
+        self._cgpm_rowids = pairs[order, 1]
+
+    def nbytes(self):
+        return self._table_rowids.nbytes + self._cgpm_rowids.nbytes
+
+    def cgpm_rowids(self, table_rowids):
+        """Return the list of cgpm rowids of `table_rowids`.
+
+        Rows not in the map, and values that are not integral, such
+        as None, map to -1.
+        """
+        keys = [_integral_rowid(rowid) for rowid in table_rowids]
+        result = numpy.empty(len(keys), dtype=numpy.int64)
+        result.fill(-1)
+        if len(self._table_rowids) == 0:
+            return result.tolist()
+        valid = numpy.array([key is not None for key in keys], dtype=bool)
+        valid_keys = numpy.array(
+            [key for key in keys if key is not None], dtype=numpy.int64)
+        i = numpy.searchsorted(self._table_rowids, valid_keys)
+        i = numpy.minimum(i, len(self._table_rowids) - 1)
+        found = self._table_rowids[i] == valid_keys
+        result[valid] = numpy.where(found, self._cgpm_rowids[i], -1)
+        return result.tolist()
+
+def _integral_rowid(rowid):
+    # SQLite compares the integer table rowids equal to integral
+    # floats too, but to nothing else.
+    if isinstance(rowid, (int, long)):
+        return rowid if -2**63 <= rowid < 2**63 else None
+    if isinstance(rowid, float) and rowid.is_integer() and \
+            -2**63 <= rowid < 2**63:
+        return int(rowid)
+    return None
+
+class _EncodedState(object):
+    """Placeholder in :class:`_LazyStates` for a state not yet decoded."""
+
+    def __init__(self, blob, seed):
+        self.blob = blob
+        self.seed = seed
+
+class _LazyStates(list):
+    """List of CGPM states that decodes each state on first access.
+
+    Queries using only some models decode only those states; the rest
+    remain as encoded blobs in memory.  Each state gets its own
+    generator, seeded when the list is made, so that the order in
+    which states are decoded does not matter.
+    """
+
+    def __init__(self, blobs, X, prng):
+        seeds = prng.randint(low=1, high=2**32 - 1, size=len(blobs))
+        super(_LazyStates, self).__init__(
+            _EncodedState(blob, seed) for blob, seed in zip(blobs, seeds))
+        self._X = X
+
+    def _decode(self, i):
+        state = super(_LazyStates, self).__getitem__(i)
+        if isinstance(state, _EncodedState):
+            state = _decode_state(state.blob, self._X, state.seed)
+            super(_LazyStates, self).__setitem__(i, state)
+        return state
+
+    def is_decoded(self, i):
+        state = super(_LazyStates, self).__getitem__(i)
+        return not isinstance(state, _EncodedState)
+
+    def encoded(self, i):
+        """Return the placeholder for state `i`, or None if decoded."""
+        state = super(_LazyStates, self).__getitem__(i)
+        return state if isinstance(state, _EncodedState) else None
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._decode(j) for j in xrange(*i.indices(len(self)))]
+        return self._decode(i)
+
+    def __getslice__(self, i, j):
+        return self[max(0, i):max(0, j):]
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self._decode(i)
+
+    def __reversed__(self):
+        for i in reversed(xrange(len(self))):
+            yield self._decode(i)
+
+    def pop(self, i=-1):
+        state = self._decode(i)
+        super(_LazyStates, self).pop(i)
+        return state
+
+def _decode_state(blob, X, seed):
+    metadata = decode_metadata(blob)
+    if X is not None:
+        # States are stored without the data shared by the engine.
+        metadata.setdefault('X', X)
+    rng = numpy.random.RandomState(seed)
+    return State.from_metadata(metadata, rng=rng)
+
+def _encode_states(engine, prng):
+    """Return the shared data, blobs, and seeds of `engine`'s states.
+
+    States not yet decoded keep their blobs and seeds; the rest are
+    encoded afresh, with their data, and get new seeds from `prng`.
+    The blobs are strs, since buffers cannot be pickled.
+    """
+    states = engine.states
+    lazy = isinstance(states, _LazyStates)
+    X = states._X if lazy else None
+    blobs = []
+    seeds = []
+    for stateno in xrange(engine.num_states()):
+        encoded = states.encoded(stateno) if lazy else None
+        if encoded is None:
+            metadata = states[stateno].to_metadata()
+            blobs.append(encode_metadata(metadata))
+            seeds.append(prng.randint(low=1, high=2**32 - 1))
+        else:
+            blobs.append(str(encoded.blob))
+            seeds.append(encoded.seed)
+    return X, blobs, seeds
+
+class _PooledEngine(object):
+    """Stand-in for a CGPM engine whose states are in a worker pool.
+
+    Provides the engine methods that queries use, with the same
+    arguments, evaluating each state in the worker holding it.  The
+    `multiprocess` arguments are ignored.
+    """
+
+    def __init__(self, engine, pool, key, rng):
+        self._engine = engine
+        self._pool = pool
+        self._key = key
+        self._rng = rng
+
+    def num_states(self):
+        return self._engine.num_states()
+
+    def logpdf(self, rowid, targets, constraints=None, inputs=None,
+            accuracy=None, statenos=None, multiprocess=None):
+        return self._map('logpdf', statenos,
+            (rowid, targets, constraints, inputs, accuracy))
+
+    def simulate(self, rowid, targets, constraints=None, inputs=None,
+            N=None, accuracy=None, statenos=None, multiprocess=None):
+        return self._map('simulate', statenos,
+            (rowid, targets, constraints, inputs, N, accuracy))
+
+    def logpdf_bulk(self, rowids, targets_list, constraints_list=None,
+            inputs_list=None, statenos=None, multiprocess=None):
+        return self._map('logpdf_bulk', statenos,
+            (rowids, targets_list, constraints_list, inputs_list))
+
+    def dependence_probability(self, col0, col1, statenos=None,
+            multiprocess=None):
+        return self._map('dependence_probability', statenos, (col0, col1))
+
+    def row_similarity(self, row0, row1, cols=None, statenos=None,
+            multiprocess=None):
+        return self._map('row_similarity', statenos, (row0, row1, cols))
+
+    def _likelihood_weighted_integrate(self, logpdfs, rowid,
+            constraints=None, inputs=None, statenos=None, multiprocess=None):
+        # Average the densities of the states, weighted by the
+        # likelihood of the constraints under each.
+        if not constraints:
+            return logsumexp(logpdfs) - math.log(len(logpdfs))
+        weights = self.logpdf(rowid, constraints, None, inputs,
+            statenos=statenos)
+        return logsumexp([w + l for w, l in zip(weights, logpdfs)]) \
+            - logsumexp(weights)
+
+    def _likelihood_weighted_resample(self, samples, rowid,
+            constraints=None, inputs=None, statenos=None, multiprocess=None):
+        # Choose, for each sample, the state to take it from, weighted
+        # by the likelihood of the constraints under each.
+        if constraints:
+            weights = self.logpdf(rowid, constraints, None, inputs,
+                statenos=statenos)
+        else:
+            weights = [0.] * len(samples)
+        p = numpy.exp(numpy.array(weights) - logsumexp(weights))
+        choices = self._rng.choice(len(samples), size=len(samples[0]),
+            p=p / numpy.sum(p))
+        return [samples[s][i] for i, s in enumerate(choices)]
+
+    def _map(self, method, statenos, args):
+        if statenos is None:
+            statenos = range(self.num_states())
+        return self._pool.map(self._key, method, statenos, args)
+
+#: Rough memory of a decoded state per cell of data, in bytes.  The
+#: data, the latent assignments of each row, and the sufficient
+#: statistics of each cluster are all Python objects.
+_DECODED_STATE_BYTES_PER_CELL = 64
+
+def _cache_nbytes(entries):
+    """Estimate the memory of a generator's cached objects."""
+    nbytes = 0
+    if 'engine' in entries:
+        nbytes += _engine_nbytes(entries['engine'])
+    if 'rowids' in entries:
+        _stamp, rowid_map = entries['rowids']
+        nbytes += rowid_map.nbytes()
+    return nbytes
+
+def _cache_pinned(entries):
+    # Keep the handle on a running background analysis.
+    analysis = entries.get('analysis')
+    if analysis is None:
+        return False
+    analysis.poll()
+    return analysis.running
+
+def _engine_nbytes(engine):
+    # States not yet decoded take the size of their blobs.
+    states = engine.states
+    lazy = isinstance(states, _LazyStates)
+    nbytes = 0
+    for stateno in xrange(len(states)):
+        encoded = states.encoded(stateno) if lazy else None
+        if encoded is None:
+            X = states[stateno].X
+            cells = sum(len(column) for column in X.itervalues())
+            nbytes += _DECODED_STATE_BYTES_PER_CELL * cells
+        else:
+            nbytes += len(encoded.blob)
+    return nbytes
+
+def _insert_categories(bdb, generator_id, table, colno, name):
+    # Assign the codes 0, 1, 2, ... to the distinct values of a nominal
+    # column in the order SQLite finds them.
+    qt = sqlite3_quote_name(table)
+    qn = sqlite3_quote_name(name)
+    cursor = bdb.sql_execute('''
+        SELECT DISTINCT %s FROM %s WHERE %s IS NOT NULL
+    ''' % (qn, qt, qn))
+    bdb.sql_executemany('''
+        INSERT INTO bayesdb_cgpm_category (generator_id, colno, value, code)
+            VALUES (?, ?, ?, ?)
+    ''', (
+        (generator_id, colno, value, code)
+        for code, (value,) in enumerate(cursor)
+    ))
+
+def _store_states(bdb, generator_id, states, stamp):
+    """Store the metadata of each ``(cgpm_modelno, state)`` in `states`.
+
+    The data matrix shared by all states is stored once with the
+    engine, not with each state.
+    """
+    bdb.sql_executemany('''
+        INSERT OR REPLACE INTO bayesdb_cgpm_state
+            (generator_id, cgpm_modelno, state_blob, state_stamp)
+            VALUES (?, ?, ?, ?)
+    ''', (
+        (generator_id, cgpm_modelno, _encode_state(state), stamp)
+        for cgpm_modelno, state in states
+    ))
+
+def _encode_state(state):
+    state.pop('X', None)
+    return buffer(encode_metadata(state))
+
+def _transition(engine, plan, N, S, multiprocess):
+    """Transition `engine` for `N` iterations or `S` seconds.
+
+    `plan` is a dict saying which variables, rows, and states to
+    transition, and how, as assembled by ``analyze_models``.
+    """
+    statenos = plan['statenos']
+
+    # Run transitions on baseline variables.
+    if plan['baseline']:
+        if plan['optimized'] == 'loom':
+            engine.transition_loom(
+                N=N,
+                S=S,
+                progress=plan['progress'],
+                checkpoint=plan['checkpoint'],
+                multiprocess=multiprocess,
+            )
+        elif plan['optimized'] == 'lovecat':
+            engine.transition_lovecat(
+                N=N,
+                S=S,
+                kernels=plan['kernels'],
+                cols=plan['baseline'],
+                rowids=plan['rowids'],
+                progress=plan['progress'],
+                checkpoint=plan['checkpoint'],
+                statenos=statenos,
+                multiprocess=multiprocess,
+            )
+        else:
+            engine.transition(
+                N=N,
+                S=S,
+                kernels=plan['kernels'],
+                cols=plan['baseline'],
+                rowids=plan['rowids'],
+                progress=plan['progress'],
+                checkpoint=plan['checkpoint'],
+                statenos=statenos,
+                multiprocess=multiprocess,
+            )
+
+    # Run transitions on foreign variables.
+    if plan['foreign']:
+        engine.transition_foreign(
+            N=N,
+            S=S,
+            cols=plan['foreign'],
+            progress=plan['progress'],
+            statenos=statenos,
+            multiprocess=multiprocess,
+        )
+
+# How long a background analysis waits for a lock before giving up on a
+# checkpoint, to try again after the next iteration.
+_BUSY_TIMEOUT_MS = 1000
+
+class _GeneratorChanged(Exception):
+    pass
+
+def _analyze_in_background(conn, progress, pathname, generator_id, stamp,
+        engine, plan, iterations, max_seconds, ckpt_iterations, ckpt_seconds):
+    """Analyze `engine` in a worker process.
+
+    Transitions the engine one iteration at a time, and at each
+    checkpoint commits the states in ``plan['statenos']`` to the
+    database at `pathname` under the next engine stamp, as long as no
+    one else has changed the generator since `stamp`.  If the database
+    is busy, keeps transitioning and tries again after each iteration
+    until the commit goes through.  Stores the
+    iterations, seconds, and state scores so far in the shared array
+    `progress` after every iteration, and finally sends
+    ``('done', status)`` or ``('error', message)`` to `conn`.
+    """
+    statenos = plan['statenos']
+    status = {
+        'iterations': 0,
+        'seconds': 0.,
+        'logscores': [],
+    }
+    try:
+        db = apsw.Connection(pathname)
+        db.setbusytimeout(_BUSY_TIMEOUT_MS)
+        start = time.time()
+        last_checkpoint = start
+        published = 0
+        pending = False
+        while True:
+            elapsed = time.time() - start
+            if max_seconds and max_seconds <= elapsed:
+                break
+            if iterations and iterations <= status['iterations']:
+                break
+            S = max_seconds - elapsed if max_seconds else None
+            _transition(engine, plan, 1, S, False)
+            now = time.time()
+            status['iterations'] += 1
+            status['seconds'] = now - start
+            status['logscores'] = [
+                engine.states[stateno].logpdf_score() for stateno in statenos
+            ]
+            if (ckpt_iterations and
+                        status['iterations'] % ckpt_iterations == 0) or \
+                    (ckpt_seconds and ckpt_seconds <= now - last_checkpoint):
+                pending = True
+                last_checkpoint = now
+            if pending:
+                new_stamp = _publish_states(db, generator_id, stamp, engine,
+                    statenos)
+                if new_stamp is not None:
+                    stamp = new_stamp
+                    published = status['iterations']
+                    pending = False
+            with progress.get_lock():
+                progress[:] = \
+                    [status['iterations'], status['seconds']] + \
+                    status['logscores']
+        while published < status['iterations']:
+            if _publish_states(db, generator_id, stamp, engine, statenos) \
+                    is not None:
+                published = status['iterations']
+        conn.send(('done', status))
+    except _GeneratorChanged:
+        conn.send(('error', 'Generator changed during background analysis.'))
+    except Exception:
+        conn.send(('error', traceback.format_exc()))
+    finally:
+        conn.close()
+
+def _publish_states(db, generator_id, stamp, engine, statenos):
+    # Commit the states under the next engine stamp after `stamp`, and
+    # return it.  Returns None, having committed nothing, if other
+    # connections hold locks for longer than the busy timeout.
+    blobs = [
+        (stateno, _encode_state(engine.states[stateno].to_metadata()))
+        for stateno in statenos
+    ]
+    try:
+        with db:
+            cursor = db.cursor()
+            current = cursor.execute('''
+                SELECT engine_stamp FROM bayesdb_cgpm_generator
+                    WHERE generator_id = ?
+            ''', (generator_id,)).fetchall()
+            if current != [(stamp,)]:
+                raise _GeneratorChanged
+            cursor.execute('''
+                UPDATE bayesdb_cgpm_generator SET engine_stamp = ?
+                    WHERE generator_id = ?
+            ''', (stamp + 1, generator_id))
+            cursor.executemany('''
+                INSERT OR REPLACE INTO bayesdb_cgpm_state
+                    (generator_id, cgpm_modelno, state_blob, state_stamp)
+                    VALUES (?, ?, ?, ?)
+            ''', [
+                (generator_id, stateno, blob, stamp + 1)
+                for stateno, blob in blobs
+            ])
+        return stamp + 1
+    except apsw.BusyError:
+        # A failed commit leaves the transaction open, holding its
+        # locks; drop it so as not to block the others meanwhile.
+        if not db.getautocommit():
+            db.cursor().execute('ROLLBACK')
+        return None
+
+def _drop_states(bdb, generator_id, cgpm_modelnos):
+    """Delete the stored states `cgpm_modelnos` and renumber the rest.
+
+    The remaining states are numbered consecutively from 0 in their
+    original order, as in the engine after deleting the states.
+    """
+    for cgpm_modelno in cgpm_modelnos:
+        bdb.sql_execute('''
+            DELETE FROM bayesdb_cgpm_state
+                WHERE generator_id = ? AND cgpm_modelno = ?
+        ''', (generator_id, cgpm_modelno))
+    cursor = bdb.sql_execute('''
+        SELECT cgpm_modelno FROM bayesdb_cgpm_state
+            WHERE generator_id = ?
+            ORDER BY cgpm_modelno ASC
+    ''', (generator_id,)).fetchall()
+    # Moving in ascending order, each new number is already free.
+    for new, (old,) in enumerate(cursor):
+        if new != old:
+            bdb.sql_execute('''
+                UPDATE bayesdb_cgpm_state SET cgpm_modelno = ?
+                    WHERE generator_id = ? AND cgpm_modelno = ?
+            ''', (new, generator_id, old))
+
+def _upgrade_engine_json(bdb):
+    """Move engines stored as JSON into the binary per-state encoding."""
+    cursor = bdb.sql_execute('''
+        SELECT generator_id, engine_json FROM bayesdb_cgpm_generator
+            WHERE engine_json IS NOT NULL
+    ''').fetchall()
+    for generator_id, engine_json in cursor:
+        metadata = json.loads(engine_json)
+        states = metadata.pop('states')
+        bdb.sql_execute('''
+            UPDATE bayesdb_cgpm_generator
+                SET engine_blob = ?, engine_json = NULL
+                WHERE generator_id = ?
+        ''', (buffer(encode_metadata(metadata)), generator_id))
+        bdb.sql_executemany('''
+            INSERT INTO bayesdb_cgpm_state
+                (generator_id, cgpm_modelno, state_blob)
+                VALUES (?, ?, ?)
+        ''', (
+            (generator_id, cgpm_modelno, buffer(encode_metadata(state)))
+            for cgpm_modelno, state in enumerate(states)
+        ))
+
+def _upgrade_last_rowid(bdb):
+    """Record the last table rowid seen by generators made before it was."""
+    cursor = bdb.sql_execute('''
+        SELECT generator_id, schema_json FROM bayesdb_cgpm_generator
+    ''').fetchall()
+    for generator_id, schema_json in cursor:
+        if json.loads(schema_json).get('subsample'):
+            # The individuals are only a sample, so assume no rows
+            # have been appended since.
+            table = core.bayesdb_generator_table(bdb, generator_id)
+            last_rowid = cursor_value(bdb.sql_execute(
+                'SELECT MAX(_rowid_) FROM %s' % (sqlite3_quote_name(table),)))
+        else:
+            last_rowid = cursor_value(bdb.sql_execute('''
+                SELECT MAX(table_rowid) FROM bayesdb_cgpm_individual
+                    WHERE generator_id = ?
+            ''', (generator_id,)))
+        bdb.sql_execute('''
+            UPDATE bayesdb_cgpm_generator SET last_table_rowid = ?
+                WHERE generator_id = ?
+        ''', (last_rowid, generator_id))
+
 def _create_schema(bdb, generator_id, schema_ast):
     # Get some parameters.
     population_id = core.bayesdb_generator_population(bdb, generator_id)
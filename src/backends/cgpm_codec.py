@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Compact binary encoding of CGPM metadata.
+
+CGPM engines and states serialize themselves with ``to_metadata`` as
+trees of dicts and lists suitable for JSON.  Most of the bulk is in
+long lists of numbers -- the data matrix, cluster assignments,
+sufficient statistics -- which are slow to print and parse as JSON.
+
+:func:`encode_metadata` stores every sufficiently large, rectangular
+list of numbers of a single type as a raw NumPy buffer, and the rest
+of the tree as JSON with references to the buffers.  The layout of an
+encoded blob is:
+
+- a 4-byte big-endian length n of the JSON header,
+- n bytes of UTF-8 JSON header,
+- the array buffers, each aligned to 8 bytes from the end of the header.
+
+The header is a JSON object ``{"arrays": [...], "metadata": ...}``
+where each array is described by ``[dtype, shape, offset]`` and each
+occurrence of an array in the metadata is replaced by
+``{"__array__": i}``.
+
+:func:`decode_metadata` inverts :func:`encode_metadata`, giving the
+same result as a round trip through JSON.
+"""
+
+import json
+import numpy
+import struct
+
+#: Lists with fewer elements than this are left in the JSON header.
+MIN_ARRAY_SIZE = 16
+
+_ARRAY_KEY = '__array__'
+_HEADER_LENGTH = struct.Struct('>I')
+_ALIGNMENT = 8
+
+def encode_metadata(metadata):
+    """Encode a JSON-compatible tree `metadata` as a binary str."""
+    arrays = []
+    buffers = []
+    offset = [0]
+    def encode(x):
+        if isinstance(x, dict):
+            return {k: encode(v) for k, v in x.iteritems()}
+        if isinstance(x, (list, tuple)):
+            array = _numeric_array(x)
+            if array is None:
+                return [encode(y) for y in x]
+            data = array.tobytes()
+            padding = -len(data) % _ALIGNMENT
+            arrays.append([array.dtype.str, list(array.shape), offset[0]])
+            buffers.append(data + '\0'*padding)
+            offset[0] += len(data) + padding
+            return {_ARRAY_KEY: len(arrays) - 1}
+        return x
+    header = json.dumps({
+        'arrays': arrays,
+        'metadata': encode(metadata),
+    }, sort_keys=True)
+    header += ' '*(-len(header) % _ALIGNMENT)
+    return ''.join([_HEADER_LENGTH.pack(len(header)), header] + buffers)
+
+def decode_metadata(blob):
+    """Decode a str or buffer `blob` made by :func:`encode_metadata`."""
+    (n,) = _HEADER_LENGTH.unpack_from(blob, 0)
+    start = _HEADER_LENGTH.size + n
+    header = json.loads(str(blob[_HEADER_LENGTH.size:start]))
+    arrays = header['arrays']
+    def decode(x):
+        if isinstance(x, dict):
+            if len(x) == 1 and _ARRAY_KEY in x:
+                dtype, shape, offset = arrays[x[_ARRAY_KEY]]
+                dtype = numpy.dtype(str(dtype))
+                count = int(numpy.prod(shape))
+                array = numpy.frombuffer(blob, dtype=dtype, count=count,
+                    offset=start + offset)
+                return array.reshape(shape).tolist()
+            return {k: decode(v) for k, v in x.iteritems()}
+        if isinstance(x, list):
+            return [decode(y) for y in x]
+        return x
+    return decode(header['metadata'])
+
+def _numeric_array(x):
+    """Return `x` as a numeric NumPy array, or None if it should stay JSON.
+
+    `x` must be a rectangular nest of lists whose leaves all have the
+    same type, one of bool, int, or float, so that ``tolist`` gives
+    back what a JSON round trip would.
+    """
+    if len(x) < MIN_ARRAY_SIZE:
+        return None
+    leaf_type = None
+    stack = [x]
+    while stack:
+        y = stack.pop()
+        for z in y:
+            if isinstance(z, (list, tuple)):
+                stack.append(z)
+                continue
+            z_type = _leaf_type(z)
+            if z_type is None:
+                return None
+            elif leaf_type is None:
+                leaf_type = z_type
+            elif z_type is not leaf_type:
+                return None
+    if leaf_type is None:
+        return None
+    try:
+        array = numpy.array(x, dtype=leaf_type)
+    except (ValueError, OverflowError):
+        # Ragged nesting, or ints too large for int64.
+        return None
+    if array.dtype.kind not in 'biuf':
+        return None
+    return array
+
+def _leaf_type(z):
+    # NumPy's float64 and (on LP64 platforms) int64 scalars are
+    # subclasses of float and int, and JSON prints them the same way.
+    if type(z) is bool:
+        return bool
+    elif isinstance(z, float):
+        return float
+    elif isinstance(z, int) and not isinstance(z, bool):
+        return int
+    else:
+        return None
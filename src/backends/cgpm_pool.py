@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Long-lived worker processes holding CGPM states.
+
+With multiprocessing on, a CGPM engine starts fresh processes and
+pickles every state to them on each query, which for small queries
+costs more than the computation.  A :class:`StatePool` instead keeps
+its workers, and the states loaded into them, across queries.  Each
+worker holds a shard of the states loaded under each key, and only
+the method name, arguments, and results of a query cross the process
+boundary.
+"""
+
+import multiprocessing
+import traceback
+
+class StatePool(object):
+    """Pool of worker processes with resident states.
+
+    `decode` is a function of an encoded state, data shared by all
+    the states loaded under a key, and a seed, returning a state.  The
+    workers inherit it when they are forked, so it need not be
+    picklable.  The workers are started on first use.
+    """
+
+    def __init__(self, decode, nworkers=None):
+        if nworkers is None:
+            nworkers = multiprocessing.cpu_count()
+        assert 0 < nworkers
+        self._decode = decode
+        self._nworkers = nworkers
+        self._workers = None
+        self._keys = set()
+
+    def loaded(self, key):
+        """True if states are loaded under `key`."""
+        return key in self._keys
+
+    def load(self, key, shared, blobs, seeds):
+        """Load the states encoded in `blobs` under `key`.
+
+        State i is decoded from ``blobs[i]`` with `shared` and
+        ``seeds[i]``, replacing any states already loaded under `key`.
+        """
+        assert len(blobs) == len(seeds)
+        self._start()
+        n = self._nworkers
+        self._request([
+            ('load', key, shared, [
+                (stateno, blobs[stateno], seeds[stateno])
+                for stateno in xrange(i, len(blobs), n)
+            ])
+            for i in xrange(n)
+        ])
+        self._keys.add(key)
+
+    def drop(self, key):
+        """Forget the states loaded under `key`."""
+        if key not in self._keys:
+            return
+        self._keys.remove(key)
+        self._request([('drop', key)] * self._nworkers)
+
+    def map(self, key, method, statenos, args):
+        """Call `method` with `args` on each of the states `statenos`.
+
+        Returns the list of results, in the order of `statenos`.
+        """
+        assert key in self._keys
+        n = self._nworkers
+        shards = [[] for _i in xrange(n)]
+        for stateno in statenos:
+            shards[stateno % n].append(stateno)
+        replies = self._request([
+            ('call', key, method, shard, args) if shard else None
+            for shard in shards
+        ])
+        results = {}
+        for shard, reply in zip(shards, replies):
+            if shard:
+                results.update(zip(shard, reply))
+        return [results[stateno] for stateno in statenos]
+
+    def close(self):
+        """Stop the workers, forgetting all loaded states."""
+        self._keys.clear()
+        if self._workers is None:
+            return
+        workers = self._workers
+        self._workers = None
+        for process, conn in workers:
+            # Ask the worker to stop rather than close the pipe: the
+            # workers forked later hold copies of its end too.
+            try:
+                conn.send(None)
+            except Exception:
+                pass
+            conn.close()
+        for process, _conn in workers:
+            process.join(1)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+
+    def _start(self):
+        if self._workers is not None:
+            return
+        self._workers = []
+        for _i in xrange(self._nworkers):
+            conn, worker_conn = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=_work, args=(worker_conn, self._decode))
+            # Don't keep the interpreter waiting for idle workers at exit.
+            process.daemon = True
+            process.start()
+            worker_conn.close()
+            self._workers.append((process, conn))
+
+    def _request(self, messages):
+        # Send each worker its message, if any, and wait for all the
+        # replies before raising the first error, so that the next
+        # request does not read a stale reply.
+        assert len(messages) == self._nworkers
+        try:
+            for (_process, conn), message in zip(self._workers, messages):
+                if message is not None:
+                    conn.send(message)
+            replies = []
+            for (_process, conn), message in zip(self._workers, messages):
+                replies.append(conn.recv() if message is not None else None)
+        except Exception:
+            # A worker died, taking its states with it, or we lost
+            # track of which reply is which.
+            self.close()
+            raise
+        results = []
+        for reply in replies:
+            if reply is None:
+                results.append(None)
+                continue
+            ok, value = reply
+            if not ok:
+                raise value
+            results.append(value)
+        return results
+
+def _work(conn, decode):
+    states = {}
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        except Exception as e:
+            # Arguments that cannot be unpickled.
+            conn.send((False, e))
+            continue
+        if message is None:
+            break
+        try:
+            if message[0] == 'load':
+                _load, key, shared, shard = message
+                states[key] = {
+                    stateno: decode(blob, shared, seed)
+                    for stateno, blob, seed in shard
+                }
+                reply = (True, None)
+            elif message[0] == 'drop':
+                _drop, key = message
+                states.pop(key, None)
+                reply = (True, None)
+            elif message[0] == 'call':
+                _call, key, method, statenos, args = message
+                reply = (True, [
+                    getattr(states[key][stateno], method)(*args)
+                    for stateno in statenos
+                ])
+            else:
+                raise ValueError('Unknown request: %r' % (message[0],))
+        except Exception as e:
+            reply = (False, e)
+        try:
+            conn.send(reply)
+        except Exception:
+            # Exceptions and results that cannot be pickled.
+            conn.send((False, RuntimeError(traceback.format_exc())))
+    conn.close()
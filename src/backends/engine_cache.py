@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Memory-bounded cache of backends' per-generator objects.
+
+Backends keep objects derived from a generator in the database --
+deserialized engines, lookup tables -- in a cache keyed by the
+BayesDB handle and generator id.  An :class:`EngineCache`
+bounds the memory of these objects across generators and handles:
+when the estimated total exceeds its budget, it evicts the objects of
+the least recently used generators.  It holds the handles by weak
+reference, and releases their objects when they are collected.
+
+All backends share :data:`shared_cache` unless given their own.
+"""
+
+import itertools
+import weakref
+
+from collections import OrderedDict
+
+#: Default budget of an :class:`EngineCache`, in bytes.
+DEFAULT_MAX_BYTES = 2**30
+
+class EngineCache(object):
+    """LRU cache of backends' per-generator objects, bounded in bytes.
+
+    Each backend stores its objects in its own namespace, made by
+    :meth:`namespace`.  `max_bytes` may be changed at any time, and
+    None means no bound.  `hits`, `misses`, and `evictions` count
+    lookups that found an object, lookups that did not, and
+    generators evicted to stay within the budget.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # (namespace, handle number, generator id) -> {key: value},
+        # least recently used first.
+        self._entries = OrderedDict()
+        self._handles = weakref.WeakKeyDictionary()
+        self._refs = {}
+        self._handle_numbers = itertools.count()
+        self._collected = []
+
+    def namespace(self, nbytes=None, release=None, pinned=None):
+        """Return a new namespace for a backend's objects.
+
+        The functions `nbytes`, `release`, and `pinned` are applied
+        to the dict of one generator's objects in the namespace:
+        `nbytes` estimates their memory, `release` frees any
+        resources they hold when they are evicted or their handle is
+        collected, and `pinned` tells whether they must not be
+        evicted.
+        """
+        return CacheNamespace(self, nbytes, release, pinned)
+
+    def nbytes(self):
+        """Return the estimated memory of all cached objects."""
+        self._release_collected()
+        return sum(
+            namespace._nbytes(objects)
+            for (namespace, _h, _g), objects in self._entries.iteritems())
+
+    def stats(self):
+        """Return a dict of statistics about the cache."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'generators': len(self._entries),
+            'bytes': self.nbytes(),
+            'max_bytes': self.max_bytes,
+        }
+
+    def clear(self):
+        """Evict everything, whether pinned or not."""
+        self._release_collected()
+        while self._entries:
+            (namespace, _h, _g), objects = self._entries.popitem(last=False)
+            namespace._release(objects)
+
+    def _handle(self, bdb, create):
+        handle = self._handles.get(bdb)
+        if handle is None and create:
+            handle = next(self._handle_numbers)
+            # Keep the weak reference so that its callback fires.
+            self._refs[handle] = weakref.ref(
+                bdb, lambda _ref: self._collected.append(handle))
+            self._handles[bdb] = handle
+        return handle
+
+    def _release_collected(self):
+        # Release the objects of handles that have been collected.  The
+        # weak reference callbacks only note the handles, since they
+        # may run in the middle of any other operation on the cache.
+        while self._collected:
+            handle = self._collected.pop()
+            del self._refs[handle]
+            for key in [key for key in self._entries if key[1] == handle]:
+                key[0]._release(self._entries.pop(key))
+
+    def _lookup(self, namespace, bdb, generator_id, create):
+        self._release_collected()
+        handle = self._handle(bdb, create)
+        if handle is None:
+            return None
+        key = (namespace, handle, generator_id)
+        objects = self._entries.pop(key, None)
+        if objects is None:
+            if not create:
+                return None
+            objects = {}
+        # Mark it most recently used.
+        self._entries[key] = objects
+        return objects
+
+    def _evict(self, keep):
+        if self.max_bytes is None:
+            return
+        sizes = [
+            (key, key[0]._nbytes(objects))
+            for key, objects in self._entries.iteritems()
+        ]
+        total = sum(size for _key, size in sizes)
+        for key, size in sizes:
+            if total <= self.max_bytes:
+                break
+            namespace = key[0]
+            objects = self._entries[key]
+            if size == 0 or objects is keep or namespace._pinned(objects):
+                # Evicting it would not help, or is not allowed.
+                continue
+            del self._entries[key]
+            namespace._release(objects)
+            self.evictions += 1
+            total -= size
+
+class CacheNamespace(object):
+    """One backend's objects in an :class:`EngineCache`."""
+
+    def __init__(self, cache, nbytes, release, pinned):
+        self.cache = cache
+        self._nbytes_fn = nbytes
+        self._release_fn = release
+        self._pinned_fn = pinned
+
+    def get(self, bdb, generator_id, key):
+        """Return the object under `key`, or None if there is none."""
+        objects = self.cache._lookup(self, bdb, generator_id, False)
+        if objects is None or key not in objects:
+            self.cache.misses += 1
+            return None
+        self.cache.hits += 1
+        return objects[key]
+
+    def set(self, bdb, generator_id, key, value):
+        """Store `value` under `key`, evicting others if need be."""
+        objects = self.cache._lookup(self, bdb, generator_id, True)
+        objects[key] = value
+        self.cache._evict(objects)
+
+    def delete(self, bdb, generator_id, key):
+        """Forget the object under `key`, or all if `key` is None.
+
+        Unlike eviction, this does not release the objects.
+        """
+        objects = self.cache._lookup(self, bdb, generator_id, False)
+        if objects is None:
+            return
+        if key is None:
+            objects.clear()
+        else:
+            objects.pop(key, None)
+        if not objects:
+            handle = self.cache._handle(bdb, False)
+            del self.cache._entries[(self, handle, generator_id)]
+
+    def _nbytes(self, objects):
+        return 0 if self._nbytes_fn is None else self._nbytes_fn(objects)
+
+    def _release(self, objects):
+        if self._release_fn is not None:
+            self._release_fn(objects)
+
+    def _pinned(self, objects):
+        return self._pinned_fn is not None and self._pinned_fn(objects)
+
+#: The cache shared by backends by default.
+shared_cache = EngineCache()
@@ -24,14 +24,16 @@ import csv
 import gzip
 import itertools
 import json
+import numpy
 import os
+import shutil
 import tempfile
 
-from StringIO import StringIO
 from collections import Counter
 from collections import OrderedDict
 from datetime import datetime
 
+import loom.query
 import loom.tasks
 
 from distributions.io.stream import open_compressed
@@ -49,6 +51,7 @@ from bayeslite.core import bayesdb_variable_stattype
 
 from bayeslite.backend import BayesDB_Backend
 from bayeslite.backend import bayesdb_backend_version
+from bayeslite.backends.server_pool import shared_servers
 
 from bayeslite.exception import BQLError
 from bayeslite.sqlite3_util import sqlite3_quote_name
@@ -123,6 +126,14 @@ CREATE TABLE bayesdb_loom_row_kind_partition (
 );
 '''
 
+LOOM_SCHEMA_2 = '''
+UPDATE bayesdb_backend SET version = 2 WHERE name = 'loom';
+
+CREATE INDEX bayesdb_loom_row_kind_partition_kind_idx
+    ON bayesdb_loom_row_kind_partition
+        (generator_id, modelno, kind_id, table_rowid, partition_id);
+'''
+
 CSV_DELIMITER = ','
 
 STATTYPE_TO_LOOMTYPE = {
@@ -146,11 +157,16 @@ class LoomBackend(BayesDB_Backend):
     begin with ``bayesdb_loom``.
     """
 
-    def __init__(self, loom_store_path):
+    def __init__(self, loom_store_path, server_pool=None, prewarm=None):
         """Initialize the Loom backend.
 
         `loom_store_path` is the absolute path at which loom stores its
-        auxiliary data files.
+        auxiliary data files.  Query servers are kept in `server_pool`,
+        by default the pool shared with the other backends, and shared
+        by all BayesDB instances using the same Loom project.  The
+        servers for the generators named in `prewarm` are started as
+        soon as the backend is registered with a BayesDB instance that
+        has them.
         """
         if not os.path.isabs(loom_store_path):
             raise ValueError('Loom store path must be an absolute path.')
@@ -158,11 +174,10 @@ class LoomBackend(BayesDB_Backend):
         os.environ['LOOM_STORE'] = self.loom_store_path
         if not os.path.isdir(self.loom_store_path):
             os.makedirs(self.loom_store_path)
-        # The cache is a dictionary whose keys are bayeslite.BayesDB objects,
-        # and whose values are dictionaries (one cache per bdb). We need
-        # self._cache to have separate caches for each bdb because the same
-        # instance of LoomBackend may be used across multiple bdb instances.
-        self._cache = dict()
+        if server_pool is None:
+            server_pool = shared_servers
+        self._servers = server_pool
+        self._prewarm = [] if prewarm is None else list(prewarm)
 
 
     def name(self):
@@ -174,6 +189,14 @@ class LoomBackend(BayesDB_Backend):
             if version is None:
                 bdb.sql_execute(LOOM_SCHEMA_1, (self.name(),))
                 version = 1
+            if version == 1:
+                # Index the row partitions by kind.
+                bdb.sql_execute(LOOM_SCHEMA_2)
+                version = 2
+            if version != 2:
+                raise BQLError(bdb, 'Loom already installed'
+                    ' with unknown schema version: %d' % (version,))
+        self._warm_servers(bdb)
 
     def create_generator(self, bdb, generator_id, schema, **kwargs):
         population_id = bayesdb_generator_population(bdb, generator_id)
@@ -187,42 +210,37 @@ class LoomBackend(BayesDB_Backend):
             VALUES (?, ?, ?)
         ''', (generator_id, name, self.loom_store_path))
 
-        headers = []
-        data = []
-        data_by_column = {}
-        for colno in bayesdb_variable_numbers(bdb, population_id, None):
-            column_name = bayesdb_variable_name(bdb, population_id, None, colno)
-            headers.append(column_name)
-            qt = sqlite3_quote_name(table)
-            qcn = sqlite3_quote_name(column_name)
-            cursor = bdb.sql_execute('SELECT %s FROM %s' % (qcn, qt))
-            col_data = [item for (item,) in cursor.fetchall()]
-            data.append(col_data)
-            data_by_column[column_name] = col_data
-        data = [list(i) for i in zip(*data)]
-
-        # Ingest data into loom.
-        schema_file = self._data_to_schema(bdb, population_id, data_by_column)
-        csv_file = self._data_to_csv(bdb, headers, data)
+        # Ingest data into loom, through files in a scratch directory
+        # that is removed whether or not the ingestion succeeds.
         project_path = self._get_loom_project_path(bdb, generator_id)
-        loom.tasks.ingest(project_path, rows_csv=csv_file.name,
-            schema=schema_file.name)
+        scratch = tempfile.mkdtemp(
+            prefix='bayeslite-loom-', dir=self.loom_store_path)
+        try:
+            schema_path = os.path.join(scratch, 'schema.json')
+            rows_path = os.path.join(scratch, 'rows.csv.gz')
+            self._write_schema(bdb, population_id, schema_path)
+            self._write_rows(bdb, population_id, rows_path)
+            loom.tasks.ingest(project_path, rows_csv=rows_path,
+                schema=schema_path)
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
 
         # Store encoding info in bdb.
         self._store_encoding_info(bdb, generator_id)
 
-        # Store rowid mapping in the bdb.
+        # Store rowid mapping in the bdb, numbering the rows in the
+        # order they were written for loom.
         qt = sqlite3_quote_name(table)
-        rowids = bdb.sql_execute('SELECT oid FROM %s' % (qt,)).fetchall()
-        insertions = ','.join(
-            str((generator_id, table_rowid, loom_rowid))
-            for loom_rowid, (table_rowid,) in enumerate(rowids)
-        )
-        bdb.sql_execute('''
+        cursor = bdb.sql_execute(
+            'SELECT _rowid_ FROM %s ORDER BY _rowid_ ASC' % (qt,))
+        bdb.sql_executemany('''
             INSERT INTO bayesdb_loom_rowid_mapping
                 (generator_id, table_rowid, loom_rowid)
-                VALUES %s
-        ''' % (insertions,))
+                VALUES (?, ?, ?)
+        ''', (
+            (generator_id, table_rowid, loom_rowid)
+            for loom_rowid, (table_rowid,) in enumerate(cursor)
+        ))
 
     def _store_encoding_info(self, bdb, generator_id):
         encoding_path = os.path.join(
@@ -248,7 +266,8 @@ class LoomBackend(BayesDB_Backend):
                     bdb.sql_execute(insert_string_encoding, {
                         'generator_id': generator_id,
                         'colno': colno,
-                        'string_form': string_form,
+                        # Undo the escaping of _csv_value.
+                        'string_form': string_form.decode('unicode_escape'),
                         'integer_form': integer_form
                     })
 
@@ -285,36 +304,45 @@ class LoomBackend(BayesDB_Backend):
             raise BQLError(bdb, 'Analyze must be run before any BQL'\
                 ' queries when using loom.')
 
-    def _data_to_csv(self, bdb, headers, data):
-        # TODO: Fix the use of delete=False so loom doesn't litter
-        #   the filesystem with the files used to communicate with loom.
-        with tempfile.NamedTemporaryFile(delete=False) as csv_file:
+    def _write_rows(self, bdb, population_id, path):
+        """Write the rows of the population's table to a gzipped CSV file.
+
+        The rows are streamed from the table in rowid order, with NULL
+        as the empty string, and text escaped as by :func:`_csv_value`.
+        """
+        table = bayesdb_population_table(bdb, population_id)
+        column_names = [
+            bayesdb_variable_name(bdb, population_id, None, colno)
+            for colno in bayesdb_variable_numbers(bdb, population_id, None)
+        ]
+        cursor = bdb.sql_execute('SELECT %s FROM %s ORDER BY _rowid_ ASC' % (
+            ','.join(map(sqlite3_quote_name, column_names)),
+            sqlite3_quote_name(table),
+        ))
+        with gzip.open(path, 'wb') as csv_file:
             csv_writer = csv.writer(csv_file, delimiter=CSV_DELIMITER)
-            csv_writer.writerow(headers)
-            for row in data:
-                processed_row = []
-                for elem in row:
-                    if elem is None:
-                        processed_row.append('')
-                    elif isinstance(elem, unicode):
-                        processed_row.append(elem.encode('ascii', 'ignore'))
-                    else:
-                        processed_row.append(elem)
-                csv_writer.writerow(processed_row)
-        return csv_file
-
-    def _data_to_schema(self, bdb, population_id, data_by_column):
+            csv_writer.writerow(column_names)
+            for row in cursor:
+                csv_writer.writerow([_csv_value(value) for value in row])
+
+    def _write_schema(self, bdb, population_id, path):
+        """Write the loom schema of the population to a JSON file."""
+        table = bayesdb_population_table(bdb, population_id)
         json_dict = {}
         for colno in bayesdb_variable_numbers(bdb, population_id, None):
             column_name = bayesdb_variable_name(bdb, population_id, None, colno)
             stattype = bayesdb_variable_stattype(bdb, population_id, None, colno)
-            if stattype == 'nominal' \
-                    and len(set(data_by_column[column_name])) > 256:
-                stattype = 'unbounded_nominal'
+            if stattype == 'nominal':
+                num_values = cursor_value(bdb.sql_execute(
+                    'SELECT COUNT(DISTINCT %s) FROM %s' % (
+                        sqlite3_quote_name(column_name),
+                        sqlite3_quote_name(table),
+                    )))
+                if num_values > 256:
+                    stattype = 'unbounded_nominal'
             json_dict[column_name] = STATTYPE_TO_LOOMTYPE[stattype]
-        with tempfile.NamedTemporaryFile(delete=False) as schema_file:
+        with open(path, 'w') as schema_file:
             schema_file.write(json.dumps(json_dict))
-        return schema_file
 
     def _generate_name(self, bdb, generator_id):
         generator_name = bayesdb_generator_name(bdb, generator_id)
@@ -365,7 +393,6 @@ class LoomBackend(BayesDB_Backend):
     def drop_generator(self, bdb, generator_id):
         self._close_query_server(bdb, generator_id)
         self._close_preql_server(bdb, generator_id)
-        self._del_cache_entry(bdb, generator_id, None)
         with bdb.savepoint():
             self.drop_models(bdb, generator_id)
             bdb.sql_execute('''
@@ -447,77 +474,64 @@ class LoomBackend(BayesDB_Backend):
         self._close_preql_server(bdb, generator_id)
 
     def _store_kind_partition(self, bdb, generator_id, modelnos):
-        population_id = bayesdb_generator_population(bdb, generator_id)
         if modelnos is None:
             modelnos = range(self._get_num_models(bdb, generator_id))
+        # Map loom ranks back to column numbers once for all the models.
+        colnos = dict(bdb.sql_execute('''
+            SELECT rank, colno
+            FROM bayesdb_loom_column_ordering
+            WHERE generator_id = ?
+        ''', (generator_id,)))
         with bdb.savepoint():
             for modelno in modelnos:
-                column_partition = self._retrieve_column_partition(
-                    bdb, generator_id, modelno)
-                # Bulk insertion of mapping from colno to kind_id.
-                colnos = bayesdb_variable_numbers(bdb, population_id, None)
-                ranks = [self._get_loom_rank(bdb, generator_id, colno)
-                    for colno in colnos]
-                insertions = ','.join(
-                    str((generator_id, modelno, colno, column_partition[rank]))
-                    for colno, rank in zip(colnos, ranks)
-                )
-                bdb.sql_execute('''
+                cross_cat = self._get_cross_cat(bdb, generator_id, modelno)
+                # Mapping from colno to kind_id.
+                bdb.sql_executemany('''
                     INSERT OR REPLACE INTO bayesdb_loom_column_kind_partition
                     (generator_id, modelno, colno, kind_id)
-                    VALUES %s
-                ''' % (insertions,))
-                # Bulk insertion of mapping from (kind_id, rowid) to cluster_id.
-                row_partition = self._retrieve_row_partition(
-                    bdb, generator_id, modelno)
-                rowids = bdb.sql_execute('''
-                    SELECT table_rowid, loom_rowid
-                        FROM bayesdb_loom_rowid_mapping
-                ''').fetchall()
-                insertions = ','.join(
-                    str((generator_id, modelno, rowid[0], rowid[1],
-                            kind_id, partition_id))
-                    for kind_id in row_partition
-                    for rowid, partition_id
-                        in zip(rowids, row_partition[kind_id]))
-                bdb.sql_execute('''
-                    INSERT OR REPLACE INTO
-                        bayesdb_loom_row_kind_partition
+                    VALUES (?, ?, ?, ?)
+                ''', (
+                    (generator_id, modelno, colnos[loom_rank], kind_id)
+                    for kind_id, kind in enumerate(cross_cat.kinds)
+                    for loom_rank in kind.featureids
+                ))
+                # Mapping from (kind_id, rowid) to cluster_id, streamed
+                # from the assignments, with the table rowid looked up
+                # by loom rowid in SQL so that memory stays flat.
+                bdb.sql_executemany('''
+                    INSERT OR REPLACE INTO bayesdb_loom_row_kind_partition
                     (generator_id, modelno, table_rowid, loom_rowid,
                         kind_id, partition_id)
-                    VALUES %s
-                ''' % (insertions,))
-
-    def _retrieve_column_partition(self, bdb, generator_id, modelno):
-        """Return column partition from a CrossCat model.
-
-        The returned structure is of the form `cgpm.crosscat.state.State.Zv`.
-        """
-        cross_cat = self._get_cross_cat(bdb, generator_id, modelno)
-        return dict(itertools.chain.from_iterable([
-            [(loom_rank, k) for loom_rank in kind.featureids]
-            for k, kind in enumerate(cross_cat.kinds)
-        ]))
-
-    def _retrieve_row_partition(self, bdb, generator_id, modelno):
-        """Return row partition from a CrossCat model.
-
-        The returned structure is of the form `cgpm.crosscat.state.State.Zv`.
+                    SELECT generator_id, :modelno, table_rowid, loom_rowid,
+                            :kind_id, :partition_id
+                        FROM bayesdb_loom_rowid_mapping
+                        WHERE generator_id = :generator_id
+                            AND loom_rowid = :loom_rowid
+                ''', (
+                    {
+                        'generator_id': generator_id,
+                        'modelno': modelno,
+                        'loom_rowid': loom_rowid,
+                        'kind_id': kind_id,
+                        'partition_id': partition_id,
+                    }
+                    for loom_rowid, partition_ids in self._iter_row_partition(
+                        bdb, generator_id, modelno, len(cross_cat.kinds))
+                    for kind_id, partition_id in enumerate(partition_ids)
+                ))
+
+    def _iter_row_partition(self, bdb, generator_id, modelno, num_kinds):
+        """Yield the row partition of a CrossCat model row by row.
+
+        Each item is a loom rowid and the list of its cluster ids in
+        each of the `num_kinds` kinds, read lazily from the model's
+        assignments.
         """
-        cross_cat = self._get_cross_cat(bdb, generator_id, modelno)
-        num_kinds = len(cross_cat.kinds)
         assign_in = os.path.join(
             self._get_loom_project_path(bdb, generator_id),
             'samples', 'sample.%d' % (modelno,), 'assign.pbs.gz')
-        assignments = {
-            a.rowid: [a.groupids(k) for k in xrange(num_kinds)]
-            for a in assignment_stream_load(assign_in)
-        }
-        rowids = sorted(assignments)
-        return {
-            k: [assignments[rowid][k] for rowid in rowids]
-            for k in xrange(num_kinds)
-        }
+        for a in assignment_stream_load(assign_in):
+            yield a.rowid, [a.groupids(k) for k in xrange(num_kinds)]
 
     def _get_cross_cat(self, bdb, generator_id, modelno):
         """Return the loom CrossCat structure whose id is `modelno`."""
@@ -548,28 +562,32 @@ class LoomBackend(BayesDB_Backend):
         ''' % (','.join(map(str, modelnos)),), (generator_id, colno0, colno1))
         return [c for (c,) in cursor]
 
-    def _get_kind_id(self, bdb, generator_id, modelno, colno):
-        """Return kind_id (view assignment) of colno in modelno."""
+    def column_dependence_probability_matrix(self,
+            bdb, generator_id, modelnos, colnos):
+        if modelnos is None:
+            modelnos = range(self._get_num_models(bdb, generator_id))
+        # Read the kind assignments of all the models at once.
         cursor = bdb.sql_execute('''
-            SELECT kind_id
+            SELECT modelno, colno, kind_id
             FROM bayesdb_loom_column_kind_partition
             WHERE generator_id = ?
-                AND modelno = ?
-                AND colno = ?
-        ''', (generator_id, modelno, colno,))
-        return cursor_value(cursor)
-
-    def _get_partition_id(self, bdb, generator_id, modelno, kind_id, rowid):
-        """Return row partition_id of given rowid, within kind_id of modelno."""
-        cursor = bdb.sql_execute('''
-            SELECT partition_id
-            FROM bayesdb_loom_row_kind_partition
-            WHERE generator_id = ?
-                AND modelno = ?
-                AND kind_id = ?
-                AND table_rowid = ?
-        ''', (generator_id, modelno, kind_id, rowid))
-        return cursor_value(cursor)
+                AND modelno in (%s)
+        ''' % (','.join(map(str, modelnos)),), (generator_id,))
+        kinds = {}
+        for modelno, colno, kind_id in cursor:
+            kinds[modelno, colno] = kind_id
+        if any((modelno, colno) not in kinds
+                for modelno in modelnos for colno in colnos):
+            return super(LoomBackend, self)\
+                .column_dependence_probability_matrix(
+                    bdb, generator_id, modelnos, colnos)
+        # Count, for each pair, the models in which the two columns
+        # are assigned to the same kind.
+        counts = numpy.zeros((len(colnos), len(colnos)))
+        for modelno in modelnos:
+            kind_ids = numpy.array([kinds[modelno, colno] for colno in colnos])
+            counts += kind_ids[:, numpy.newaxis] == kind_ids[numpy.newaxis, :]
+        return counts / len(modelnos)
 
     def _get_constraint_row(self, constraints, bdb, generator_id, population_id,
             server):
@@ -583,7 +601,10 @@ class LoomBackend(BayesDB_Backend):
                 for colno, value in constraints
             }
             csv_headers_str = map(str, row_constraints.iterkeys())
-            csv_values_str  = map(str, row_constraints.itervalues())
+            csv_values_str  = [
+                str(_csv_value(value))
+                for value in row_constraints.itervalues()
+            ]
             return server.encode_row(csv_values_str, csv_headers_str)
 
     def _simulate_constraints(self, bdb, generator_id, modelnos, constraints,
@@ -685,6 +706,38 @@ class LoomBackend(BayesDB_Backend):
             generator_id, colnos[0], rowid, target_rowid))
         return [c for (c,) in cursor]
 
+    def row_similarity_matrix(self, bdb, generator_id, modelnos, rowids0,
+            rowids1, colno):
+        if modelnos is None:
+            modelnos = range(self._get_num_models(bdb, generator_id))
+        # Read the row partitions of the kind of colno in all the
+        # models at once.
+        cursor = bdb.sql_execute('''
+            SELECT r.modelno, r.table_rowid, r.partition_id
+            FROM bayesdb_loom_row_kind_partition AS r
+                JOIN bayesdb_loom_column_kind_partition AS c
+                USING (generator_id, modelno, kind_id)
+            WHERE r.generator_id = ?
+                AND r.modelno in (%s)
+                AND c.colno = ?
+        ''' % (','.join(map(str, modelnos)),), (generator_id, colno))
+        partitions = {}
+        for modelno, rowid, partition_id in cursor:
+            partitions[modelno, rowid] = partition_id
+        if any((modelno, rowid) not in partitions
+                for modelno in modelnos
+                for rowid in itertools.chain(rowids0, rowids1)):
+            return super(LoomBackend, self).row_similarity_matrix(
+                bdb, generator_id, modelnos, rowids0, rowids1, colno)
+        # Count, for each pair, the models in which the two rows are
+        # in the same partition.
+        counts = numpy.zeros((len(rowids0), len(rowids1)))
+        for modelno in modelnos:
+            p0 = numpy.array([partitions[modelno, r] for r in rowids0])
+            p1 = numpy.array([partitions[modelno, r] for r in rowids1])
+            counts += p0[:, numpy.newaxis] == p1[numpy.newaxis, :]
+        return counts / len(modelnos)
+
     def predictive_relevance(self, bdb, generator_id, modelnos, rowid_target,
             rowid_queries, hypotheticals, colno):
         if len(hypotheticals) > 0:
@@ -692,22 +745,36 @@ class LoomBackend(BayesDB_Backend):
                 ' because it is unable to insert rows into CrossCat')
         if modelnos is None:
             modelnos = range(self._get_num_models(bdb, generator_id))
-        relevances = [0] * len(rowid_queries)
-        for modelno in modelnos:
-            kind_id_context = self._get_kind_id(
-                bdb, generator_id, modelno, colno)
-            partition_id_target = self._get_partition_id(bdb,
-                generator_id, modelno, kind_id_context, rowid_target)
-            for idx, rowid in enumerate(rowid_queries):
-                partition_id_query = self._get_partition_id(
-                    bdb, generator_id, modelno, kind_id_context, rowid)
-                if partition_id_target == partition_id_query:
-                    relevances[idx] += 1
+        # Count, for each row, the models in which it is in the same
+        # partition as the target within the kind of colno.
+        cursor = bdb.sql_execute('''
+            SELECT q.table_rowid, COUNT(*)
+            FROM bayesdb_loom_row_kind_partition AS t
+                JOIN bayesdb_loom_column_kind_partition AS c
+                USING (generator_id, modelno, kind_id)
+                JOIN bayesdb_loom_row_kind_partition AS q
+                USING (generator_id, modelno, kind_id, partition_id)
+            WHERE t.generator_id = ?
+                AND t.modelno in (%s)
+                AND c.colno = ?
+                AND t.table_rowid = ?
+            GROUP BY q.table_rowid
+        ''' % (','.join(map(str, modelnos)),),
+            (generator_id, colno, rowid_target))
+        counts = dict(cursor)
         # XXX This procedure appears to be computing the wrong thing.
-        return [xsum/float(len(modelnos)) for xsum in relevances]
+        return [
+            counts.get(rowid, 0)/float(len(modelnos))
+            for rowid in rowid_queries
+        ]
 
     def predict_confidence(self, bdb, generator_id, modelnos, rowid, colno,
             numsamples=None):
+        return self.predict_confidence_batch(bdb, generator_id, modelnos,
+            [rowid], colno, numsamples=numsamples)[0]
+
+    def predict_confidence_batch(self, bdb, generator_id, modelnos, rowids,
+            colno, numsamples=None):
         if not numsamples:
             numsamples = 2
         assert numsamples > 0
@@ -726,8 +793,8 @@ class LoomBackend(BayesDB_Backend):
 
         # Retrieve the samples: specifying rowid suffices to ensures that
         # relevant constraints are retrieved by simulat_joint.
-        sample = self.simulate_joint(
-            bdb, generator_id, modelnos, rowid, [colno], [], numsamples)
+        samples = self.simulate_joint_batch(bdb, generator_id, modelnos,
+            [(rowid, [colno], []) for rowid in rowids], numsamples)
 
         # Determine the imputation strategy (mode or mean).
         population_id = bayesdb_generator_population(bdb, generator_id)
@@ -735,134 +802,146 @@ class LoomBackend(BayesDB_Backend):
 
         # Run the imputation.
         if _is_nominal(stattype):
-            return _impute_categorical(sample)
+            return map(_impute_categorical, samples)
         else:
-            return _impute_numerical(sample)
+            return map(_impute_numerical, samples)
 
     def simulate_joint(self, bdb, generator_id, modelnos, rowid, targets,
             constraints, num_samples=1, accuracy=None):
-        # Retrieve the population id.
+        return self.simulate_joint_batch(bdb, generator_id, modelnos,
+            [(rowid, targets, constraints)], num_samples=num_samples,
+            accuracy=accuracy)[0]
+
+    def simulate_joint_batch(self, bdb, generator_id, modelnos, rows,
+            num_samples=1, accuracy=None):
+        # Retrieve the population id, its variables, and loom's column
+        # order once for the whole batch.
         population_id = bayesdb_generator_population(bdb, generator_id)
         table = bayesdb_population_table(bdb, population_id)
-
-        # Prepare list of full constraints, potentially adding data from table.
-        constraints_full = constraints
-
-        # If rowid exist in base table, retrieve conditioning data.
-        # Conditioning values are fetched for any rowid that exists in the base
-        # table irrespective of whether the rowid is incorporated in the Loom
-        # model or whether it was added after creation.
-        if bayesdb_table_has_rowid(bdb, table, rowid):
-            # Fetch population column numbers and row values.
-            colnos = bayesdb_variable_numbers(bdb, population_id, generator_id)
-            rowvals = bayesdb_population_row_values(bdb, population_id, rowid)
-            observations = [
-                (colno, rowval)
-                for colno, rowval in zip(colnos, rowvals)
-                if rowval is not None and colno not in targets
-            ]
-            # Raise error if a constraint overrides an observed cell.
-            colnos_constrained = [constraint[0] for constraint in constraints]
-            colnos_observed = [observation[0] for observation in observations]
-            if set.intersection(set(colnos_constrained), set(colnos_observed)):
-                raise BQLError(bdb, 'Overlap between constraints and'
-                    ' target row in simulate.')
-            # Update the constraints.
-            constraints_full = constraints + observations
-
-        # Store mapping from target column name to column number and stattype.
-        target_colno_to_name = {
-            colno: bayesdb_variable_name(bdb, generator_id, None, colno)
-            for colno in targets
-        }
-        target_colno_to_stattype = {
-            colno: bayesdb_variable_stattype(bdb, population_id, None, colno)
-            for colno in targets
-        }
-
-        # Construct the CSV row for targets.
-        row_targets = {target_colno_to_name[colno] : '' for colno in targets}
-        row_constraints = {
-            bayesdb_variable_name(bdb, generator_id, None, colno) : value
-            for colno, value in constraints_full
+        colnos = bayesdb_variable_numbers(bdb, population_id, generator_id)
+        ranks = {
+            colno: rank for rank, colno
+            in enumerate(self._get_ordered_column_numbers(bdb, generator_id))
         }
-        row = dict(itertools.chain(
-            row_targets.iteritems(), row_constraints.iteritems()))
 
         # Fetch the server.
         server = self._get_preql_server(bdb, generator_id)
 
-        # Prepare the csv header and values.
-        csv_headers = map(str, row.iterkeys())
-        csv_values = map(str, row.itervalues())
-
-        # Prepare streams for the server.
-        outfile = StringIO()
-        writer = loom.preql.CsvWriter(outfile, returns=outfile.getvalue)
-        reader = iter([csv_headers]+[csv_values])
-
-        # Obtain the prediction.
-        server._predict(reader, num_samples, writer, False)
-
-        # Parse the CSV output.
-        output_csv = writer.result()
-        output_rows = output_csv.strip().split('\r\n')
-
-        # Extract the header of the CSV file.
-        header = output_rows[0].split(CSV_DELIMITER)
-
-        # Extract list of simulated rows. Each simulated row is represented
-        # as a dictionary mapping column name to its simulated value.
-        simulated_rows = [
-            dict(zip(header, row.split(CSV_DELIMITER)))
-            for row in output_rows[1:]
-        ]
-
-        # Prepare the return list of simulated_rows.
-        def _extract_simulated_value(row, colno):
-            colname = target_colno_to_name[colno]
-            stattype = target_colno_to_stattype[colno]
-            value = row[colname]
-            return value if _is_nominal(stattype) else float(value)
-
-        # Return the list of samples.
+        requests = []
+        for rowid, targets, constraints in rows:
+            # Prepare list of full constraints, potentially adding data
+            # from table.
+            constraints_full = constraints
+
+            # If rowid exist in base table, retrieve conditioning data.
+            # Conditioning values are fetched for any rowid that exists
+            # in the base table irrespective of whether the rowid is
+            # incorporated in the Loom model or whether it was added
+            # after creation.
+            if bayesdb_table_has_rowid(bdb, table, rowid):
+                # Fetch population row values.
+                rowvals = bayesdb_population_row_values(
+                    bdb, population_id, rowid)
+                observations = [
+                    (colno, rowval)
+                    for colno, rowval in zip(colnos, rowvals)
+                    if rowval is not None and colno not in targets
+                ]
+                # Raise error if a constraint overrides an observed cell.
+                colnos_constrained = [constraint[0]
+                    for constraint in constraints]
+                colnos_observed = [observation[0]
+                    for observation in observations]
+                if set.intersection(
+                        set(colnos_constrained), set(colnos_observed)):
+                    raise BQLError(bdb, 'Overlap between constraints and'
+                        ' target row in simulate.')
+                # Update the constraints.
+                constraints_full = constraints + observations
+
+            # Encode the conditioning row, in loom's column order, and
+            # mark the targets to sample.
+            conditioning_row = self._get_constraint_row(
+                constraints_full, bdb, generator_id, population_id, server)
+            to_sample = [False] * len(ranks)
+            for colno in targets:
+                to_sample[ranks[colno]] = True
+            requests.append((to_sample, conditioning_row))
+
+        # Obtain the samples, encoded, pipelining the requests to the
+        # server.
+        samples = _batch_sample(server._query_server, requests, num_samples)
+
+        # Decode the targets: nominal values from their integer codes,
+        # and all others as floats.
+        decoders = {}
+        def decoder(colno):
+            if colno not in decoders:
+                stattype = bayesdb_variable_stattype(
+                    bdb, population_id, None, colno)
+                if _is_nominal(stattype):
+                    decoders[colno] = \
+                        self._get_string_forms(bdb, generator_id, colno).get
+                else:
+                    decoders[colno] = float
+            return decoders[colno]
+
+        # Return the list of samples for each row.
         return [
-            [_extract_simulated_value(row, colno) for colno in targets]
-            for row in simulated_rows
+            [
+                [decoder(colno)(sample[ranks[colno]]) for colno in targets]
+                for sample in row_samples
+            ]
+            for (_rowid, targets, _constraints), row_samples
+            in zip(rows, samples)
         ]
 
     def logpdf_joint(self, bdb, generator_id, modelnos, rowid, targets,
             constraints):
-        population_id = bayesdb_generator_population(bdb, generator_id)
-        ordered_column_names = self._get_ordered_column_names(bdb, generator_id)
+        return self.logpdf_joint_batch(
+            bdb, generator_id, modelnos, [(rowid, targets, constraints)])[0]
 
+    def logpdf_joint_batch(self, bdb, generator_id, modelnos, rows):
         # Pr[targets|constraints] = Pr[targets, constraints] / Pr[constraints]
-        # The numerator is and_case; denominator is conditional_case.
-        and_case = OrderedDict(
-            [(a, None) for a in ordered_column_names])
-        conditional_case = OrderedDict(
-            [(a, None) for a in ordered_column_names])
-
-        for (colno, value) in targets:
-            column_name = bayesdb_variable_name(bdb, population_id, None, colno)
-            and_case[column_name] = self._convert_to_proper_stattype(
-                bdb, generator_id, colno, value)
-            conditional_case[column_name] = None
-        for (colno, value) in constraints:
-            column_name = bayesdb_variable_name(bdb, population_id, None, colno)
-            processed_value = self._convert_to_proper_stattype(
-                bdb, generator_id, colno, value)
-
-            and_case[column_name] = processed_value
-            conditional_case[column_name] = processed_value
-
-        and_case = and_case.values()
-        conditional_case = conditional_case.values()
-
+        # The numerator is the and case; the denominator is the
+        # conditional case.  Encode both for every row, in loom's column
+        # order, converting each distinct value once.
+        ranks = {
+            colno: rank for rank, colno
+            in enumerate(self._get_ordered_column_numbers(bdb, generator_id))
+        }
+        converted = {}
+        def convert(colno, value):
+            key = (colno, value)
+            if key not in converted:
+                converted[key] = self._convert_to_proper_stattype(
+                    bdb, generator_id, colno, value)
+            return converted[key]
+        and_cases = []
+        conditional_cases = []
+        for _rowid, targets, constraints in rows:
+            and_case = [None] * len(ranks)
+            conditional_case = [None] * len(ranks)
+            for colno, value in targets:
+                and_case[ranks[colno]] = convert(colno, value)
+                conditional_case[ranks[colno]] = None
+            for colno, value in constraints:
+                and_case[ranks[colno]] = convert(colno, value)
+                conditional_case[ranks[colno]] = convert(colno, value)
+            and_cases.append(tuple(and_case))
+            conditional_cases.append(tuple(conditional_case))
+
+        # Score each distinct case once -- the conditional cases are
+        # often all the same -- pipelining the requests to the server.
+        cases = list(OrderedDict.fromkeys(
+            itertools.chain(and_cases, conditional_cases)))
         server = self._get_query_server(bdb, generator_id)
-        and_score = server.score(and_case)
-        conditional_score = server.score(conditional_case)
-        return and_score - conditional_score
+        scores = dict(
+            zip(cases, server.batch_score([list(case) for case in cases])))
+        return numpy.array([
+            scores[and_case] - scores[conditional_case]
+            for and_case, conditional_case in zip(and_cases, conditional_cases)
+        ])
 
     def _convert_to_proper_stattype(self, bdb, generator_id, colno, value):
         """Convert a value returned by the logpdf_joint method parameters into a
@@ -898,6 +977,16 @@ class LoomBackend(BayesDB_Backend):
         ''', (generator_id, colno, string_form,))
         return cursor_value(cursor)
 
+    def _get_string_forms(self, bdb, generator_id, colno):
+        """Return dict mapping the integer codes of colno to their strings."""
+        cursor = bdb.sql_execute('''
+            SELECT integer_form, string_form
+            FROM bayesdb_loom_string_encoding
+            WHERE generator_id = ?
+                AND colno = ?
+        ''', (generator_id, colno,))
+        return dict(cursor)
+
     def _get_is_incorporated_rowid(self, bdb, generator_id, rowid):
         """Return True iff the rowid is incorporated in the loom model."""
         cursor = bdb.sql_execute('''
@@ -927,85 +1016,97 @@ class LoomBackend(BayesDB_Backend):
         ''', (generator_id,))
         return [colno for (colno,) in cursor]
 
-    def _get_ordered_column_names(self, bdb, generator_id):
-        """Return list of column names ordered by their loom rank."""
-        population_id = bayesdb_generator_population(bdb, generator_id)
-        return [
-            bayesdb_variable_name(bdb, population_id, None, colno)
-            for colno in self._get_ordered_column_numbers(bdb, generator_id)
-        ]
-
-    # Cached QueryServer objects.
+    # Pooled server objects, keyed by Loom project.
 
     def _get_query_server(self, bdb, generator_id):
         """Return instance of loom.query.QueryServer for the Loom project."""
-        server = self._get_cache_entry(bdb, generator_id, 'query_server')
-        if server is not None:
-            return server
         project_path = self._get_loom_project_path(bdb, generator_id)
-        server = loom.query.get_server(project_path)
-        self._set_cache_entry(bdb, generator_id, 'query_server', server)
-        return server
+        return self._servers.get((project_path, 'query'),
+            lambda: loom.query.get_server(project_path))
 
     def _close_query_server(self, bdb, generator_id):
-        """Close the QueryServer and remove it from the cache."""
-        server = self._get_cache_entry(bdb, generator_id, 'query_server')
-        if server is not None:
-            server.close()
-            self._del_cache_entry(bdb, generator_id, 'query_server')
-
-    # Cached PreQL server objects.
+        """Close the QueryServer and remove it from the pool."""
+        project_path = self._get_loom_project_path(bdb, generator_id)
+        self._servers.close((project_path, 'query'))
 
     def _get_preql_server(self, bdb, generator_id):
         """Return instance of loom.preql.PreQL for the Loom project."""
-        server = self._get_cache_entry(bdb, generator_id, 'preql_server')
-        if server is not None:
-            return server
         project_path = self._get_loom_project_path(bdb, generator_id)
-        server = loom.tasks.query(project_path)
-        self._set_cache_entry(bdb, generator_id, 'preql_server', server)
-        return server
+        return self._servers.get((project_path, 'preql'),
+            lambda: loom.tasks.query(project_path))
 
     def _close_preql_server(self, bdb, generator_id):
-        """Close the PreQL server and remove it from the cache."""
-        server = self._get_cache_entry(bdb, generator_id, 'preql_server')
-        if server is not None:
-            server.close()
-            self._del_cache_entry(bdb, generator_id, 'preql_server')
-
-    # Cache management.
-
-    def _retrieve_cache(self, bdb):
-        """Fetch the cache for the given bdb object."""
-        if bdb in self._cache:
-            return self._cache[bdb]
-        self._cache[bdb] = dict()
-        return self._cache[bdb]
-
-    def _set_cache_entry(self, bdb, generator_id, key, value):
-        """Set cache entry."""
-        cache = self._retrieve_cache(bdb)
-        if generator_id not in cache:
-            cache[generator_id] = dict()
-        cache[generator_id][key] = value
-
-    def _get_cache_entry(self, bdb, generator_id, key):
-        """Return cache entry, or None if generator_id or key do not exist."""
-        cache = self._retrieve_cache(bdb)
-        if generator_id not in cache:
-            return None
-        if key not in cache[generator_id]:
-            return None
-        return cache[generator_id][key]
-
-    def _del_cache_entry(self, bdb, generator_id, key):
-        """Delete cache entry, use None to clear dict for generator_id."""
-        cache = self._retrieve_cache(bdb)
-        if generator_id in cache:
-            if key is None:
-                del cache[generator_id]
-            elif key in cache[generator_id]:
-                del cache[generator_id][key]
+        """Close the PreQL server and remove it from the pool."""
+        project_path = self._get_loom_project_path(bdb, generator_id)
+        self._servers.close((project_path, 'preql'))
+
+    def _warm_servers(self, bdb):
+        """Start the servers of the generators named for prewarming."""
+        for name in self._prewarm:
+            cursor = bdb.sql_execute('''
+                SELECT id FROM bayesdb_generator
+                WHERE name = ? AND backend = ?
+            ''', (name, self.name()))
+            for (generator_id,) in cursor.fetchall():
+                if self._get_num_models(bdb, generator_id) > 0:
+                    self._get_query_server(bdb, generator_id)
+                    self._get_preql_server(bdb, generator_id)
+
+#: Most sample requests to have in flight to a query server at once.
+_SAMPLE_WINDOW = 64
+
+def _batch_sample(query_server, requests, num_samples):
+    """Sample from `query_server` for each of `requests`.
+
+    Each request is a ``(to_sample, conditioning_row)`` pair, as for
+    ``QueryServer.sample``.  Returns a list, for each request, of
+    `num_samples` encoded rows.  Keeps up to :data:`_SAMPLE_WINDOW`
+    requests in flight rather than waiting on each reply.
+    """
+    protobuf_server = query_server.protobuf_server
+    def receive():
+        response = protobuf_server.receive()
+        if response.error:
+            raise Exception('\n'.join(response.error))
+        return [
+            loom.query.protobuf_to_data_row(sample)
+            for sample in response.sample.samples
+        ]
+    results = []
+    pending = 0
+    for to_sample, conditioning_row in requests:
+        if conditioning_row is None:
+            conditioning_row = [None] * len(to_sample)
+        assert len(to_sample) == len(conditioning_row)
+        request = query_server.request()
+        loom.query.data_row_to_protobuf(
+            conditioning_row, request.sample.data)
+        request.sample.to_sample.sparsity = loom.query.DENSE
+        request.sample.to_sample.dense[:] = to_sample
+        request.sample.sample_count = num_samples
+        if pending == _SAMPLE_WINDOW:
+            results.append(receive())
+            pending -= 1
+        protobuf_server.send(request)
+        pending += 1
+    for _ in xrange(pending):
+        results.append(receive())
+    return results
+
+def _csv_value(value):
+    """Return `value` as written in a CSV file for loom.
+
+    Loom reads its CSV and writes its encodings as ASCII, so text is
+    escaped as by Python's ``unicode_escape`` codec, which escapes
+    backslashes too and can therefore be undone exactly.
+    """
+    if value is None:
+        return ''
+    if isinstance(value, str):
+        value = value.decode('utf-8')
+    if isinstance(value, unicode):
+        return value.encode('unicode_escape')
+    return value
 
 def _is_nominal(stattype):
     return casefold(stattype) in ['nominal', 'unbounded_nominal']
@@ -331,18 +331,46 @@ class NIGNormalBackend(bayeslite.backend.BayesDB_Backend):
         modelwise = [model_log_pdf(m) for m in sorted(all_mus.keys())]
         return logmeanexp(modelwise)
 
+    def logpdf_joint_batch(self, bdb, generator_id, modelnos, rows):
+        # Read the parameters and the deviation columns once for the
+        # whole batch.  The constraints are irrelevant as in
+        # logpdf_joint.
+        (all_mus, all_sigmas) = self._all_mus_sigmas(bdb, generator_id)
+        models = [
+            (all_mus[m], all_sigmas[m]) for m in sorted(all_mus.keys())
+        ]
+        obs_colnos = {}
+        def logpdf_1(mus, sigmas, colno, x):
+            if colno < 0:
+                if colno not in obs_colnos:
+                    obs_colnos[colno] = self._observed_colno(
+                        bdb, generator_id, colno)
+                return logpdf_gaussian(x, 0, sigmas[obs_colnos[colno]])
+            else:
+                return logpdf_gaussian(x, mus[colno], sigmas[colno])
+        # XXX Ignore modelnos and aggregate over all of them.
+        return [
+            logmeanexp([
+                sum(logpdf_1(mus, sigmas, colno, x) for colno, x in targets)
+                for mus, sigmas in models
+            ])
+            for _rowid, targets, _constraints in rows
+        ]
+
     def _logpdf_1(self, bdb, generator_id, mus, sigmas, colno, x):
         if colno < 0:
-            dev_colno = colno
-            cursor = bdb.sql_execute('''
-                SELECT observed_colno FROM bayesdb_nig_normal_deviation
-                    WHERE generator_id = ? AND deviation_colno = ?
-            ''', (generator_id, dev_colno))
-            obs_colno = cursor_value(cursor)
+            obs_colno = self._observed_colno(bdb, generator_id, colno)
             return logpdf_gaussian(x, 0, sigmas[obs_colno])
         else:
             return logpdf_gaussian(x, mus[colno], sigmas[colno])
 
+    def _observed_colno(self, bdb, generator_id, dev_colno):
+        cursor = bdb.sql_execute('''
+            SELECT observed_colno FROM bayesdb_nig_normal_deviation
+                WHERE generator_id = ? AND deviation_colno = ?
+        ''', (generator_id, dev_colno))
+        return cursor_value(cursor)
+
     def _all_mus_sigmas(self, bdb, generator_id):
         params_sql = '''
             SELECT colno, modelno, mu, sigma FROM bayesdb_nig_normal_model
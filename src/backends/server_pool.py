@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Bounded pool of long-lived model server processes.
+
+Some backends answer queries through server processes, such as Loom's
+query servers, which are slow to start and hold a model in memory for
+as long as they run.  A :class:`ServerPool` keeps the servers started
+for each key -- for Loom, a project and a kind of server -- so that
+later queries reuse them, while bounding how many run at once and
+closing those left idle for too long.
+
+Idle servers are closed when the pool is next used, or when
+:meth:`ServerPool.close_idle` is called; the pool runs no threads of
+its own.
+"""
+
+import time
+
+from collections import OrderedDict
+
+#: Default bound on the number of live servers in a :class:`ServerPool`.
+DEFAULT_MAX_SERVERS = 16
+
+class ServerPool(object):
+    """LRU pool of servers, bounded in number and idle time.
+
+    A server is any object with a ``close`` method.  `max_servers` and
+    `idle_seconds` may be changed at any time, and None means no
+    bound.  `starts`, `reuses`, and `evictions` count servers started,
+    requests served by a running server, and servers closed to stay
+    within the bounds.
+    """
+
+    def __init__(self, max_servers=DEFAULT_MAX_SERVERS, idle_seconds=None,
+            clock=time.time):
+        self.max_servers = max_servers
+        self.idle_seconds = idle_seconds
+        self.starts = 0
+        self.reuses = 0
+        self.evictions = 0
+        self._clock = clock
+        # key -> (server, time of last use), least recently used first.
+        self._servers = OrderedDict()
+
+    def get(self, key, start):
+        """Return the server for `key`, calling `start` if there is none."""
+        self.close_idle()
+        server, _last_used = self._servers.pop(key, (None, None))
+        if server is None:
+            server = start()
+            self.starts += 1
+        else:
+            self.reuses += 1
+        # Mark it most recently used.
+        self._servers[key] = (server, self._clock())
+        self._evict(key)
+        return server
+
+    def running(self, key):
+        """True if a server for `key` is running."""
+        return key in self._servers
+
+    def close(self, key):
+        """Close the server for `key`, if any."""
+        server, _last_used = self._servers.pop(key, (None, None))
+        if server is not None:
+            server.close()
+
+    def close_idle(self):
+        """Close the servers unused for more than `idle_seconds`."""
+        if self.idle_seconds is None:
+            return
+        deadline = self._clock() - self.idle_seconds
+        for key, (server, last_used) in self._servers.items():
+            if deadline <= last_used:
+                # The rest were used later still.
+                break
+            del self._servers[key]
+            server.close()
+            self.evictions += 1
+
+    def close_all(self):
+        """Close every server."""
+        while self._servers:
+            _key, (server, _last_used) = self._servers.popitem(last=False)
+            server.close()
+
+    def stats(self):
+        """Return a dict of statistics about the pool."""
+        return {
+            'starts': self.starts,
+            'reuses': self.reuses,
+            'evictions': self.evictions,
+            'servers': len(self._servers),
+            'max_servers': self.max_servers,
+            'idle_seconds': self.idle_seconds,
+        }
+
+    def _evict(self, keep):
+        if self.max_servers is None:
+            return
+        for key in self._servers.keys():
+            if len(self._servers) <= self.max_servers:
+                break
+            if key == keep:
+                continue
+            server, _last_used = self._servers.pop(key)
+            server.close()
+            self.evictions += 1
+
+#: The pool shared by backends by default.
+shared_servers = ServerPool()
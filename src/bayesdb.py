@@ -15,6 +15,7 @@
 #   limitations under the License.
 
 import apsw
+import collections
 import contextlib
 import numpy.random
 import random
@@ -24,6 +25,7 @@ import bayeslite.bql as bql
 import bayeslite.bqlfn as bqlfn
 import bayeslite.bqlmath as bqlmath
 import bayeslite.bqlvtab as bqlvtab
+import bayeslite.core as core
 import bayeslite.parse as parse
 import bayeslite.schema as schema
 import bayeslite.txn as txn
@@ -82,11 +84,17 @@ class BayesDB(object):
         self._sqlite3 = apsw.Connection(pathname)
         self._txn_depth = 0     # managed in txn.py
         self._cache = None      # managed in txn.py
+        self._catalog_cache = {}        # managed in core.py
+        self._catalog_generation = 0    # managed in core.py
         self.backends = {}
         self.tracer = None
         self.sql_tracer = None
         self.temptable = 0
         self.qid = 0
+        self.plan_cache_size = 128
+        self.plan_cache_hits = 0
+        self.plan_cache_misses = 0
+        self._plan_cache = collections.OrderedDict()
         if seed is None:
             seed = struct.pack('<QQQQ', 0, 0, 0, 0)
         self._prng = weakprng.weakprng(seed)
@@ -225,6 +233,16 @@ class BayesDB(object):
         The argument `bindings` is a sequence or dictionary of
         bindings for parameters in the query, or ``None`` to supply no
         bindings.
+
+        Compiled queries are cached, up to `plan_cache_size` of them,
+        and reused when the same query is executed again with
+        bindings of the same shape and no intervening changes to
+        populations, variables, or generators.  The attributes
+        `plan_cache_hits` and `plan_cache_misses` count how often
+        that happens.  Queries that simulate or run subqueries at
+        compile time are never reused.  Reused queries that fill
+        temporary tables before they run, as batched estimates do,
+        get new tables each time.
         """
         if bindings is None:
             bindings = ()
@@ -266,6 +284,15 @@ class BayesDB(object):
             raise
 
     def _do_execute(self, string, bindings):
+        # Compiled queries depend only on the query text, the shape of
+        # the parameters, and the catalog, unless they say otherwise.
+        plan_key = (string, _bindings_shape(bindings),
+            core.bayesdb_catalog_generation(self))
+        out = self._plan_cache.pop(plan_key, None)
+        if out is not None:
+            self._plan_cache[plan_key] = out
+            self.plan_cache_hits += 1
+            return bql.execute_compiled(self, out.rebind(self, bindings))
         phrases = parse.parse_bql_string(string)
         phrase = None
         try:
@@ -278,8 +305,16 @@ class BayesDB(object):
             pass
         else:
             raise ValueError('>1 phrase in string')
-        cursor = bql.execute_phrase(self, phrase, bindings)
-        return self._empty_cursor if cursor is None else cursor
+        out = bql.compile_phrase(self, phrase, bindings)
+        if out is None:
+            cursor = bql.execute_phrase(self, phrase, bindings)
+            return self._empty_cursor if cursor is None else cursor
+        self.plan_cache_misses += 1
+        if out.cacheable() and 0 < self.plan_cache_size:
+            while self.plan_cache_size <= len(self._plan_cache):
+                self._plan_cache.popitem(last=False)
+            self._plan_cache[plan_key] = out
+        return bql.execute_compiled(self, out)
 
     def sql_execute(self, string, bindings=None):
         """Execute a SQL query on the underlying SQLite database.
@@ -302,6 +337,28 @@ class BayesDB(object):
         cursor.execute(string, bindings)
         return bql.BayesDBCursor(self, cursor)
 
+    def sql_executemany(self, string, bindings_seq):
+        """Execute a SQL query once for each element of `bindings_seq`.
+
+        Like :meth:`sql_execute`, but the query is prepared once and
+        run for each sequence or dictionary of bindings in the iterable
+        `bindings_seq`, which may be a generator.  The query must not
+        return rows.
+        """
+        tracer = self.sql_tracer
+        if tracer and isinstance(tracer, IBayesDBTracer):
+            for bindings in bindings_seq:
+                self.sql_execute(string, bindings)
+            return
+        if tracer:
+            def traced(bindings_seq):
+                for bindings in bindings_seq:
+                    tracer(string, bindings)
+                    yield bindings
+            bindings_seq = traced(bindings_seq)
+        cursor = self._sqlite3.cursor()
+        cursor.executemany(string, bindings_seq)
+
     @contextlib.contextmanager
     def savepoint(self):
         """Savepoint context.  On return, commit; on exception, roll back.
@@ -368,6 +425,7 @@ class BayesDB(object):
         assert self._txn_depth == 0, "pending BayesDB transactions"
         self._sqlite3.close()
         self._sqlite3 = apsw.Connection(self.pathname)
+        core.bayesdb_catalog_invalidate(self)
 
     def changes(self):
         """Return the number of changes of the last INSERT, DELETE, or UPDATE.
@@ -377,6 +435,14 @@ class BayesDB(object):
         """
         return self._sqlite3.changes()
 
+def _bindings_shape(bindings):
+    if isinstance(bindings, dict):
+        return tuple(sorted(bindings.iterkeys()))
+    elif isinstance(bindings, (tuple, list)):
+        return len(bindings)
+    else:
+        return type(bindings)
+
 class IBayesDBTracer(object):
     """BayesDB articulated tracing interface.
 
@@ -43,6 +43,10 @@ from bayeslite.util import cursor_value
 
 def execute_phrase(bdb, phrase, bindings=()):
     """Execute the BQL AST phrase `phrase` and return a cursor of results."""
+    out = compile_phrase(bdb, phrase, bindings)
+    if out is not None:
+        return execute_compiled(bdb, out)
+
     if isinstance(phrase, ast.Parametrized):
         n_numpar = phrase.n_numpar
         nampar_map = phrase.nampar_map
@@ -53,17 +57,45 @@ def execute_phrase(bdb, phrase, bindings=()):
         nampar_map = None
         # Ignore extraneous bindings.  XXX Bad idea?
 
-    if ast.is_query(phrase):
-        # Compile the query in the transaction in case we need to
-        # execute subqueries to determine column lists.  Compiling is
-        # a quick tree descent, so this should be fast.
-        out = compiler.Output(n_numpar, nampar_map, bindings)
-        with bdb.savepoint():
-            compiler.compile_query(bdb, phrase, out)
-        winders, unwinders = out.getwindings()
-        return execute_wound(bdb, winders, unwinders, out.getvalue(),
-            out.getbindings())
+    # Commands may change the populations, variables, and generators
+    # in the catalog, so bypass the catalog cache while they run and
+    # discard it afterward.
+    with core.bayesdb_catalog_changing(bdb):
+        return _execute_command(bdb, phrase, n_numpar, nampar_map, bindings)
 
+def compile_phrase(bdb, phrase, bindings=()):
+    """Compile the BQL AST phrase `phrase` if it is a query.
+
+    Return the :class:`~bayeslite.compiler.Output` accumulator of the
+    compiled SQL, or ``None`` if `phrase` is not a query.
+    """
+    if isinstance(phrase, ast.Parametrized):
+        n_numpar = phrase.n_numpar
+        nampar_map = phrase.nampar_map
+        phrase = phrase.phrase
+        assert 0 < n_numpar
+    else:
+        n_numpar = 0
+        nampar_map = None
+
+    if not ast.is_query(phrase):
+        return None
+
+    # Compile the query in the transaction in case we need to
+    # execute subqueries to determine column lists.  Compiling is
+    # a quick tree descent, so this should be fast.
+    out = compiler.Output(n_numpar, nampar_map, bindings)
+    with bdb.savepoint():
+        compiler.compile_query(bdb, phrase, out)
+    return out
+
+def execute_compiled(bdb, out):
+    """Execute a query compiled by :func:`compile_phrase`."""
+    winders, unwinders = out.getwindings()
+    return execute_wound(bdb, winders, unwinders, out.getvalue(),
+        out.getbindings())
+
+def _execute_command(bdb, phrase, n_numpar, nampar_map, bindings):
     if isinstance(phrase, ast.Begin):
         txn.bayesdb_begin_transaction(bdb)
         return empty_cursor(bdb)
@@ -641,8 +673,12 @@ def execute_phrase(bdb, phrase, bindings=()):
                 (phrase.generator,))
         generator_id = core.bayesdb_get_generator(bdb, None, phrase.generator)
         backend = core.bayesdb_generator_backend(bdb, generator_id)
+        if phrase.background:
+            analyze_models = backend.analyze_models_background
+        else:
+            analyze_models = backend.analyze_models
         # XXX Should allow parameters for iterations and ckpt/iter.
-        backend.analyze_models(bdb, generator_id,
+        analyze_models(bdb, generator_id,
             modelnos=phrase.modelnos,
             iterations=phrase.iterations,
             max_seconds=phrase.seconds,
@@ -950,23 +986,33 @@ def empty_cursor(bdb):
     return None
 
 def execute_wound(bdb, winders, unwinders, sql, bindings):
-    if len(winders) == 0 and len(unwinders) == 0:
-        return bdb.sql_execute(sql, bindings)
-    with bdb.savepoint():
-        for (wsql, wbindings) in winders:
-            bdb.sql_execute(wsql, wbindings)
-        try:
-            return WoundCursor(bdb, bdb.sql_execute(sql, bindings), unwinders)
-        except:
-            for (usql, ubindings) in unwinders:
-                bdb.sql_execute(usql, ubindings)
-            raise
+    # SQLite computes the first row right away.  Let it, the winders,
+    # and every later fetch share one cache for the statement, so that
+    # what the backends memoize in it, such as engine stamps, is looked
+    # up once per statement rather than once per row.
+    cache = {}
+    with txn.bayesdb_caching(bdb, cache):
+        if len(winders) == 0 and len(unwinders) == 0:
+            return BayesDBCursor(bdb, bdb.sql_execute(sql, bindings), cache)
+        with bdb.savepoint():
+            for (wsql, wbindings) in winders:
+                bdb.sql_execute(wsql, wbindings)
+            try:
+                return WoundCursor(bdb, bdb.sql_execute(sql, bindings),
+                    unwinders, cache)
+            except:
+                for (usql, ubindings) in unwinders:
+                    bdb.sql_execute(usql, ubindings)
+                raise
 
 class BayesDBCursor(object):
     """Cursor for a BQL or SQL query from a BayesDB."""
-    def __init__(self, bdb, cursor):
+    def __init__(self, bdb, cursor, cache=None):
         self._bdb = bdb
         self._cursor = cursor
+        # Cache for fetches outside a transaction, kept for as long as
+        # the cursor.
+        self._cache = {} if cache is None else cache
         # XXX Must save the description early because apsw discards it
         # after we have iterated over all rows -- or if there are no
         # rows, discards it immediately!
@@ -981,16 +1027,18 @@ class BayesDBCursor(object):
     def __iter__(self):
         return self
     def next(self):
-        return self._cursor.next()
+        with txn.bayesdb_caching(self._bdb, self._cache):
+            return self._cursor.next()
     def fetchone(self):
-        return self._cursor.fetchone()
+        with txn.bayesdb_caching(self._bdb, self._cache):
+            return self._cursor.fetchone()
     def fetchvalue(self):
         return cursor_value(self)
     def fetchmany(self, size=1):
-        with txn.bayesdb_caching(self._bdb):
+        with txn.bayesdb_caching(self._bdb, self._cache):
             return self._cursor.fetchmany(size=size)
     def fetchall(self):
-        with txn.bayesdb_caching(self._bdb):
+        with txn.bayesdb_caching(self._bdb, self._cache):
             return self._cursor.fetchall()
     @property
     def connection(self):
@@ -1003,9 +1051,9 @@ class BayesDBCursor(object):
         return self._description
 
 class WoundCursor(BayesDBCursor):
-    def __init__(self, bdb, cursor, unwinders):
+    def __init__(self, bdb, cursor, unwinders, cache=None):
         self._unwinders = unwinders
-        super(WoundCursor, self).__init__(bdb, cursor)
+        super(WoundCursor, self).__init__(bdb, cursor, cache)
     def __del__(self):
         del self._cursor
         # If the database is still open, we need to undo the effects
@@ -37,15 +37,21 @@ def bayesdb_install_bql(db, cookie):
     function("bql_column_correlation_pvalue", 5, bql_column_correlation_pvalue)
     function("bql_column_dependence_probability", 5,
         bql_column_dependence_probability)
+    function("bql_column_dependence_probability_batch", 5,
+        bql_column_dependence_probability_batch)
     function("bql_column_mutual_information", -1, bql_column_mutual_information)
     function("bql_column_value_probability", -1, bql_column_value_probability)
     function("bql_rand", 0, bql_rand)
     function("bql_row_similarity", 6, bql_row_similarity)
+    function("bql_row_similarity_batch", 6, bql_row_similarity_batch)
     function("bql_row_predictive_relevance", -1, bql_row_predictive_relevance)
     function("bql_row_column_predictive_probability", 6,
         bql_row_column_predictive_probability)
+    function("bql_row_column_predictive_probability_batch", 6,
+        bql_row_column_predictive_probability_batch)
     function("bql_predict", 7, bql_predict)
     function("bql_predict_confidence", 6, bql_predict_confidence)
+    function("bql_predict_confidence_batch", 6, bql_predict_confidence_batch)
     function("bql_json_get", 2, bql_json_get)
     function("bql_pdf_joint", -1, bql_pdf_joint)
 
@@ -293,6 +299,31 @@ def bql_column_dependence_probability(
     depprobs = map(generator_depprob, generator_ids)
     return stats.arithmetic_mean(depprobs)
 
+# Batched form of DEPENDENCE PROBABILITY for every pair of `colnos`:
+# fill in the (colno0, colno1, value) rows of `temptable` with one
+# call to column_dependence_probability_matrix per generator, and
+# return the number of pairs.
+def bql_column_dependence_probability_batch(
+        bdb, population_id, generator_id, modelnos, temptable, colnos):
+    colnos = json.loads(colnos)
+    modelnos = _retrieve_modelnos(modelnos)
+    def generator_depprobs(generator_id):
+        backend = core.bayesdb_generator_backend(bdb, generator_id)
+        return backend.column_dependence_probability_matrix(
+            bdb, generator_id, modelnos, colnos)
+    generator_ids = _retrieve_generator_ids(bdb, population_id, generator_id)
+    depprobs = map(generator_depprobs, generator_ids)
+    qtt = sqlite3_quote_name(temptable)
+    insert_sql = '''
+        INSERT INTO %s (colno0, colno1, value) VALUES (?, ?, ?)
+    ''' % (qtt,)
+    bdb.sql_executemany(insert_sql, (
+        (colno0, colno1, stats.arithmetic_mean([d[i][j] for d in depprobs]))
+        for i, colno0 in enumerate(colnos)
+        for j, colno1 in enumerate(colnos)
+    ))
+    return len(colnos)**2
+
 # Two-column function:  MUTUAL INFORMATION [OF <col0> WITH <col1>]
 def bql_column_mutual_information(
         bdb, population_id, generator_id, modelnos, colnos0, colnos1,
@@ -425,6 +456,42 @@ def bql_row_similarity(
     similarities = map(generator_similarity, generator_ids)
     return stats.arithmetic_mean(similarities)
 
+# Batched form of SIMILARITY IN THE CONTEXT OF <column> for pairs of
+# rows: the rows of `temptable` list some (rowid0, rowid1) pairs on
+# entry.  Replace them by every pair of a rowid0 with a rowid1, with
+# its similarity, using one call to row_similarity_matrix per
+# generator, and return the number of pairs.
+def bql_row_similarity_batch(
+        bdb, population_id, generator_id, modelnos, temptable, rowstable,
+        colno):
+    modelnos = _retrieve_modelnos(modelnos)
+    qtt = sqlite3_quote_name(temptable)
+    qrt = sqlite3_quote_name(rowstable)
+    def rowids(side):
+        cursor = bdb.sql_execute('''
+            SELECT rowid FROM %s WHERE side = ? ORDER BY rowid
+        ''' % (qrt,), (side,))
+        return [rowid for (rowid,) in cursor]
+    rowids0 = rowids(0)
+    rowids1 = rowids(1)
+    def generator_similarities(generator_id):
+        backend = core.bayesdb_generator_backend(bdb, generator_id)
+        return numpy.asarray(backend.row_similarity_matrix(
+            bdb, generator_id, modelnos, rowids0, rowids1, colno),
+            dtype=float)
+    generator_ids = _retrieve_generator_ids(bdb, population_id, generator_id)
+    similarities = sum(map(generator_similarities, generator_ids)) \
+        / len(generator_ids)
+    insert_sql = '''
+        INSERT INTO %s (rowid0, rowid1, value) VALUES (?, ?, ?)
+    ''' % (qtt,)
+    bdb.sql_executemany(insert_sql, (
+        (rowid0, rowid1, float(similarities[i, j]))
+        for i, rowid0 in enumerate(rowids0)
+        for j, rowid1 in enumerate(rowids1)
+    ))
+    return len(rowids0) * len(rowids1)
+
 # Row function:  PREDICTIVE RELEVANCE TO (<target_row>)
 #  [<AND HYPOTHETICAL ROWS WITH VALUES ((...))] IN THE CONTEXT OF <column>
 def bql_row_predictive_relevance(
@@ -462,19 +529,21 @@ def bql_row_column_predictive_probability(
     targets = json.loads(targets)
     constraints = json.loads(constraints)
     modelnos = _retrieve_modelnos(modelnos)
-    # Build the constraints and query from rowid, using a fresh rowid.
-    fresh_rowid = core.bayesdb_population_fresh_row_id(bdb, population_id)
-    def retrieve_values(colnos):
-        values = [
-            core.bayesdb_population_cell_value(bdb, population_id, rowid, colno)
-            for colno in colnos
-        ]
-        return [(c,v) for (c,v) in zip (colnos, values) if v is not None]
-    cgpm_targets = retrieve_values(targets)
+    cells = _retrieve_cell_values(bdb, population_id, targets + constraints,
+        'SELECT ?', (rowid,))
+    if len(cells) == 0:
+        population = core.bayesdb_population_name(bdb, population_id)
+        raise BQLError(bdb, 'No such individual in population %r: %d'
+            % (population, rowid))
+    [(_rowid, values)] = cells
+    query = _predictive_probability_query(
+        targets, constraints, values)
     # If all targets have NULL values, return None.
-    if len(cgpm_targets) == 0:
+    if query is None:
         return None
-    cgpm_constraints = retrieve_values(constraints)
+    cgpm_targets, cgpm_constraints = query
+    # Build the constraints and query from rowid, using a fresh rowid.
+    fresh_rowid = core.bayesdb_population_fresh_row_id(bdb, population_id)
     def generator_predprob(generator_id):
         backend = core.bayesdb_generator_backend(bdb, generator_id)
         return backend.logpdf_joint(
@@ -485,6 +554,80 @@ def bql_row_column_predictive_probability(
     r = logmeanexp(predprobs)
     return ieee_exp(r)
 
+# Batched form of PREDICTIVE PROBABILITY for every row listed in the
+# rowid column of `temptable`: fill in its value column with one call
+# to logpdf_joint_batch per generator, and return the number of rows
+# with values.
+def bql_row_column_predictive_probability_batch(
+        bdb, population_id, generator_id, modelnos, temptable, targets,
+        constraints):
+    targets = json.loads(targets)
+    constraints = json.loads(constraints)
+    modelnos = _retrieve_modelnos(modelnos)
+    qtt = sqlite3_quote_name(temptable)
+    cells = _retrieve_cell_values(bdb, population_id, targets + constraints,
+        'SELECT rowid FROM %s' % (qtt,), ())
+    fresh_rowid = core.bayesdb_population_fresh_row_id(bdb, population_id)
+    rowids = []
+    rows = []
+    for rowid, values in cells:
+        query = _predictive_probability_query(
+            targets, constraints, values)
+        # Rows whose targets all have NULL values stay NULL.
+        if query is None:
+            continue
+        cgpm_targets, cgpm_constraints = query
+        rowids.append(rowid)
+        rows.append((fresh_rowid, cgpm_targets, cgpm_constraints))
+    if len(rows) == 0:
+        return 0
+    def generator_predprobs(generator_id):
+        backend = core.bayesdb_generator_backend(bdb, generator_id)
+        return backend.logpdf_joint_batch(bdb, generator_id, modelnos, rows)
+    generator_ids = _retrieve_generator_ids(bdb, population_id, generator_id)
+    predprobs = map(generator_predprobs, generator_ids)
+    update_sql = 'UPDATE %s SET value = ? WHERE rowid = ?' % (qtt,)
+    bdb.sql_executemany(update_sql, (
+        (ieee_exp(logmeanexp(row_predprobs)), rowid)
+        for rowid, row_predprobs in zip(rowids, zip(*predprobs))
+    ))
+    return len(rows)
+
+def _retrieve_cell_values(bdb, population_id, colnos, rowids_sql, bindings):
+    """Return the values of `colnos` in rows selected by `rowids_sql`.
+
+    Returns a list of ``(rowid, values)`` pairs, in order of rowid.
+    Latent variables have no values in the table, so their values are
+    always None.
+    """
+    table_name = core.bayesdb_population_table(bdb, population_id)
+    qt = sqlite3_quote_name(table_name)
+    qcns = [
+        'NULL' if colno < 0 else sqlite3_quote_name(
+            core.bayesdb_variable_name(bdb, population_id, None, colno))
+        for colno in colnos
+    ]
+    cells_sql = 'SELECT _rowid_%s FROM %s WHERE _rowid_ IN (%s)' \
+        ' ORDER BY _rowid_' % (
+            ''.join(', %s' % (qcn,) for qcn in qcns), qt, rowids_sql)
+    cursor = bdb.sql_execute(cells_sql, bindings)
+    return [(row[0], row[1:]) for row in cursor]
+
+def _predictive_probability_query(targets, constraints, values):
+    """Return non-NULL ``(targets, constraints)`` for PREDICTIVE PROBABILITY.
+
+    `values` holds the values of `targets` followed by those of
+    `constraints`.  Returns None if all targets have NULL values.
+    """
+    assert len(values) == len(targets) + len(constraints)
+    def present(colnos, values):
+        return [(c, v) for (c, v) in zip(colnos, values) if v is not None]
+    cgpm_targets = present(targets, values[:len(targets)])
+    if len(cgpm_targets) == 0:
+        return None
+    cgpm_constraints = present(constraints, values[len(targets):])
+    return (cgpm_targets, cgpm_constraints)
+
 ### Predict and simulate
 
 def bql_predict(
@@ -518,6 +661,43 @@ def bql_predict_confidence(
     # XXX Whattakludge!
     return json.dumps({'value': value, 'confidence': confidence})
 
+# Batched form of bql_predict_confidence for every row listed in the
+# rowid column of `temptable`: fill in its value and confidence
+# columns, and its prediction column with both as bql_predict_confidence
+# would give them, with one call to predict_confidence_batch per
+# generator, and return the number of rows.
+def bql_predict_confidence_batch(
+        bdb, population_id, generator_id, modelnos, temptable, colno,
+        numsamples):
+    modelnos = _retrieve_modelnos(modelnos)
+    qtt = sqlite3_quote_name(temptable)
+    rowids = [rowid for (rowid,) in bdb.sql_execute(
+        'SELECT rowid FROM %s ORDER BY rowid' % (qtt,))]
+    # XXX As bql_predict_confidence does for each row, randomly sample
+    # 1 generator from the population for each row.
+    generator_rowids = {}
+    if generator_id is None:
+        generator_ids = core.bayesdb_population_generators(bdb, population_id)
+        for rowid in rowids:
+            index = bdb.np_prng.randint(0, high=len(generator_ids))
+            generator_rowids.setdefault(generator_ids[index], []).append(rowid)
+    elif rowids:
+        generator_rowids[generator_id] = rowids
+    update_sql = '''
+        UPDATE %s SET value = ?, confidence = ?, prediction = ?
+            WHERE rowid = ?
+    ''' % (qtt,)
+    for generator_id, rowids in sorted(generator_rowids.iteritems()):
+        backend = core.bayesdb_generator_backend(bdb, generator_id)
+        predictions = backend.predict_confidence_batch(
+            bdb, generator_id, modelnos, rowids, colno, numsamples=numsamples)
+        bdb.sql_executemany(update_sql, (
+            (value, confidence,
+                json.dumps({'value': value, 'confidence': confidence}), rowid)
+            for rowid, (value, confidence) in zip(rowids, predictions)
+        ))
+    return sum(len(rowids) for rowids in generator_rowids.itervalues())
+
 # XXX Whattakludge!
 def bql_json_get(bdb, blob, key):
     return json.loads(blob)[key]
@@ -30,6 +30,7 @@ To compile a parsed BQL query:
 
 import StringIO
 import contextlib
+import copy
 import json
 
 import bayeslite.ast as ast
@@ -50,7 +51,7 @@ class Output(object):
     for parameters and subqueries.
     """
 
-    def __init__(self, n_numpar, nampar_map, bindings):
+    def __init__(self, n_numpar, nampar_map, bindings, parent=None):
         self._stringio = StringIO.StringIO()
         # Below, `number' means 1-based, and `index' means 0-based.  n
         # is a source language number; m, an output sqlite3 number; i,
@@ -61,12 +62,90 @@ class Output(object):
         self._bindings = bindings       # map of input index -> value
         self._renumber = {}             # map of input number -> output number
         self._select = []               # map of output index -> input index
-        self._winders = []              # list of pre-query (sql, bindings)
-        self._unwinders = []            # list of post-query (sql, bindings)
+        self._winders = []              # list of pre-query (sql, bindings,
+                                        # temporary table binding indices)
+        self._unwinders = []            # likewise, post-query
+        self._parent = parent           # accumulator we are a subquery of
+        self._cacheable = True          # output depends only on the catalog
+        self._temptables = []           # temporary tables renamed by rebind
+        self._temptable_offsets = []    # list of (offset, temporary table)
 
     def subquery(self):
         """Return an output accumulator for a subquery."""
-        return Output(self._n_numpar, self._nampar_map, self._bindings)
+        return Output(self._n_numpar, self._nampar_map, self._bindings,
+            parent=self)
+
+    def uncacheable(self):
+        """Note that the output depends on more than the catalog.
+
+        Call this when compiling executes queries or otherwise depends
+        on the data or on the parameter values, so that the output may
+        not be reused for another execution of the same query.
+        """
+        out = self
+        while out is not None:
+            out._cacheable = False
+            out = out._parent
+
+    def cacheable(self):
+        """True if the output may be reused with different bindings."""
+        return self._cacheable
+
+    def rebind(self, bdb, bindings):
+        """Return a copy of the accumulated output with new bindings.
+
+        Temporary tables named by :meth:`temp_table_name` get new
+        names in the copy, wherever :meth:`write_temp_table` wrote them
+        and in the winder bindings that :meth:`winder` was told of, so
+        that it may run while the original's tables still exist.  The
+        copy otherwise shares the accumulated text, so it must not be
+        written to.
+        """
+        assert self.cacheable()
+        renames = dict(
+            (temptable, bdb.temp_table_name())
+            for temptable in self._temptables)
+        return self._rebind(bindings, renames)
+
+    def _rebind(self, bindings, renames):
+        other = copy.copy(self)
+        other._bindings = bindings
+        # Splice the new names in at the offsets where the old ones
+        # were written, keeping track of where they land.
+        value = self.getvalue()
+        parts = []
+        offsets = []
+        start = 0
+        length = 0
+        for offset, temptable in self._temptable_offsets:
+            old = sqlite3_quote_name(temptable)
+            assert value[offset:offset + len(old)] == old
+            new = renames[temptable]
+            parts.append(value[start:offset])
+            length += offset - start
+            offsets.append((length, new))
+            parts.append(sqlite3_quote_name(new))
+            length += len(parts[-1])
+            start = offset + len(old)
+        parts.append(value[start:])
+        other._stringio = StringIO.StringIO(''.join(parts))
+        other._temptable_offsets = offsets
+        def rebind_winding((sql, bindings, temptables)):
+            if isinstance(sql, Output):
+                sql = sql._rebind(other._bindings, renames)
+            if isinstance(bindings, Output):
+                bindings = bindings._rebind(other._bindings, renames)
+            elif temptables:
+                bindings = list(bindings)
+                for i in temptables:
+                    bindings[i] = renames[bindings[i]]
+                bindings = tuple(bindings)
+            return (sql, bindings, temptables)
+        other._winders = map(rebind_winding, self._winders)
+        other._unwinders = map(rebind_winding, self._unwinders)
+        other._temptables = [renames[temptable]
+            for temptable in self._temptables]
+        return other
 
     def getvalue(self):
         """Return the accumulated output."""
@@ -143,7 +222,14 @@ class Output(object):
             raise TypeError('Invalid query bindings: %s' % (self._bindings,))
 
     def getwindings(self):
-        return self._winders, self._unwinders
+        """Return lists of ``(sql, bindings)`` to run before and after."""
+        def resolve((sql, bindings, _temptables)):
+            if isinstance(sql, Output):
+                sql = sql.getvalue()
+            if isinstance(bindings, Output):
+                bindings = bindings.getbindings()
+            return (sql, bindings)
+        return map(resolve, self._winders), map(resolve, self._unwinders)
 
     def write(self, text):
         """Accumulate `text` in the output of :meth:`getvalue`."""
@@ -180,10 +266,59 @@ class Output(object):
         assert self._nampar_map[name] == n
         self.write_numpar(n)
 
-    def winder(self, sql, bindings):
-        self._winders.append((sql, bindings))
-    def unwinder(self, sql, bindings):
-        self._unwinders.append((sql, bindings))
+    def temp_table_name(self, bdb):
+        """Return a new temporary table name for the winders to use.
+
+        The table is renamed whenever the output is rebound, where it
+        is written by :meth:`write_temp_table` or passed to
+        :meth:`winder` as one of its `temptables`.
+        """
+        temptable = bdb.temp_table_name()
+        self._temptables.append(temptable)
+        return temptable
+
+    def write_temp_table(self, temptable):
+        """Accumulate the quoted name of the temporary table `temptable`.
+
+        `temptable` must come from :meth:`temp_table_name` of this
+        output or of one it is a subquery of.
+        """
+        self._temptable_offsets.append((self._stringio.tell(), temptable))
+        self.write(sqlite3_quote_name(temptable))
+
+    def temp_table_sql(self, template, *temptables):
+        """Return an output accumulator for SQL naming temporary tables.
+
+        Each ``%s`` in `template` stands for the next of `temptables`,
+        and is written with :meth:`write_temp_table`.  The result may
+        be passed to :meth:`winder` or :meth:`unwinder` as the SQL.
+        """
+        sql = self.subquery()
+        parts = template.split('%s')
+        assert len(parts) == len(temptables) + 1
+        for part, temptable in zip(parts, temptables):
+            sql.write(part)
+            sql.write_temp_table(temptable)
+        sql.write(parts[-1])
+        return sql
+
+    def winder(self, sql, bindings, temptables=()):
+        """Run `sql` with `bindings` before the query.
+
+        `temptables` lists the indices of `bindings` that hold names
+        from :meth:`temp_table_name`.
+        """
+        self._winders.append((sql, bindings, temptables))
+    def subquery_winder(self, subout):
+        """Run the subquery `subout` before the query.
+
+        Unlike a winder with fixed bindings, it is rebound with the
+        query.
+        """
+        self._winders.append((subout, subout, ()))
+    def unwinder(self, sql, bindings, temptables=()):
+        """Run `sql` with `bindings` after the query, as for :meth:`winder`."""
+        self._unwinders.append((sql, bindings, temptables))
 
 @contextlib.contextmanager
 def bayesdb_wind(bdb, winders, unwinders):
@@ -211,9 +346,9 @@ def compile_query(bdb, query, out):
     :param query: abstract syntax tree of a query
     :param Output out: output accumulator
     """
-    _compile_query(bdb, query, BQLCompiler_None(), out)
+    _compile_query(bdb, query, BQLCompiler_None(), out, toplevel=True)
 
-def _compile_query(bdb, query, bql_compiler, out):
+def _compile_query(bdb, query, bql_compiler, out, toplevel=False):
     if isinstance(query, ast.SimulateModelsExp):
         # First expand any subquery columns.
         if any(isinstance(selcol, ast.SelColSub) for selcol in query.columns):
@@ -239,17 +374,17 @@ def _compile_query(bdb, query, bql_compiler, out):
     if isinstance(query, ast.Select):
         compile_select(bdb, query, bql_compiler, out)
     elif isinstance(query, ast.Estimate):
-        compile_estimate(bdb, query, out)
+        compile_estimate(bdb, query, toplevel, out)
     elif isinstance(query, ast.EstBy):
         compile_estimate_by(bdb, query, out)
     elif isinstance(query, ast.InferExplicit):
         if any(isinstance(c, ast.PredCol) for c in query.columns):
-            compile_infer_explicit_predict(bdb, query, out)
+            compile_infer_explicit_predict(bdb, query, toplevel, out)
         else:
             named = True
-            compile_infer_explicit(bdb, query, named, out)
+            compile_infer_explicit(bdb, query, named, toplevel, out)
     elif isinstance(query, ast.InferAuto):
-        compile_infer_auto(bdb, query, out)
+        compile_infer_auto(bdb, query, toplevel, out)
     elif isinstance(query, ast.Simulate):
         compile_simulate(bdb, query, out)
     elif isinstance(query, ast.SimulateModels):
@@ -259,7 +394,7 @@ def _compile_query(bdb, query, bql_compiler, out):
     elif isinstance(query, ast.EstPairCols):
         compile_estpaircols(bdb, query, out)
     elif isinstance(query, ast.EstPairRow):
-        compile_estpairrow(bdb, query, out)
+        compile_estpairrow(bdb, query, toplevel, out)
     else:
         assert False, 'Invalid query: %s' % (repr(query),)
 
@@ -320,7 +455,7 @@ def compile_select(bdb, select, bql_compiler, out):
             out.write(' OFFSET ')
             compile_nobql_expression(bdb, select.limit.offset, out)
 
-def compile_infer_explicit_predict(bdb, infer, out):
+def compile_infer_explicit_predict(bdb, infer, toplevel, out):
     out.write('SELECT')
     first = True
     for i, col in enumerate(infer.columns):
@@ -359,9 +494,9 @@ def compile_infer_explicit_predict(bdb, infer, out):
     out.write(' FROM ')
     with compiling_paren(bdb, out, '(', ')'):
         named = False
-        compile_infer_explicit(bdb, infer, named, out)
+        compile_infer_explicit(bdb, infer, named, toplevel, out)
 
-def compile_infer_explicit(bdb, infer, named, out):
+def compile_infer_explicit(bdb, infer, named, toplevel, out, impute=False):
     assert isinstance(infer, ast.InferExplicit)
     out.write('SELECT')
     if not core.bayesdb_has_population(bdb, infer.population):
@@ -373,8 +508,13 @@ def compile_infer_explicit(bdb, infer, named, out):
             raise BQLError(bdb, 'No such generator: %s' % (infer.generator,))
         generator_id = core.bayesdb_get_generator(
             bdb, population_id, infer.generator)
+    # As for ESTIMATE, without LIMIT or GROUP BY, a query not nested in
+    # another predicts for every row satisfying the condition, so the
+    # predictions can be made in a batch.
+    batch = toplevel and infer.limit is None and infer.grouping is None \
+        and (infer.condition is None or is_plain_expression(infer.condition))
     bql_compiler = BQLCompiler_1Row_Infer(population_id, generator_id,
-        infer.modelnos)
+        infer.modelnos, batch=batch, condition=infer.condition, impute=impute)
     columns = expand_select_columns(
         bdb, infer.columns, named, bql_compiler, out)
     compile_select_columns(bdb, columns, named, bql_compiler, out)
@@ -421,7 +561,7 @@ def compile_infer_explicit(bdb, infer, named, out):
             out.write(' OFFSET ')
             compile_expression(bdb, infer.limit.offset, bql_compiler, out)
 
-def compile_infer_auto(bdb, infer, out):
+def compile_infer_auto(bdb, infer, toplevel, out):
     assert isinstance(infer, ast.InferAuto)
     if not core.bayesdb_has_population(bdb, infer.population):
         raise BQLError(bdb, 'No such population: %s' % (infer.population,))
@@ -444,6 +584,8 @@ def compile_infer_auto(bdb, infer, out):
         return ast.SelColExp(exp, name)
     def map_columns(col):
         if isinstance(col, ast.InfColAll):
+            # The table's columns may change without the catalog.
+            out.uncacheable()
             column_names = core.bayesdb_table_column_names(bdb, table)
             return [map_column(colname, None) for colname in column_names]
         elif isinstance(col, ast.InfColOne):
@@ -455,9 +597,15 @@ def compile_infer_auto(bdb, infer, out):
         infer.modelnos, infer.condition, infer.grouping, infer.order,
         infer.limit)
     named = True
-    return compile_infer_explicit(bdb, infer_exp, named, out)
-
-def compile_estimate(bdb, estimate, out):
+    # Each prediction in the columns only fills in a missing value, so
+    # a batch may skip the rows where it is observed -- unless ORDER BY
+    # has predictions of its own.
+    impute = infer.order is None or \
+        all(is_plain_expression(o.expression) for o in infer.order)
+    return compile_infer_explicit(bdb, infer_exp, named, toplevel, out,
+        impute=impute)
+
+def compile_estimate(bdb, estimate, toplevel, out):
     assert isinstance(estimate, ast.Estimate)
     out.write('SELECT')
     if estimate.quantifier == ast.SELQUANT_DISTINCT:
@@ -475,8 +623,13 @@ def compile_estimate(bdb, estimate, out):
                 (estimate.generator,))
         generator_id = core.bayesdb_get_generator(
             bdb, population_id, estimate.generator)
+    # Without LIMIT, a query not nested in another touches every row
+    # satisfying the condition, so row-wise estimates can be computed
+    # in a batch.  A subquery may be cut short by an outer LIMIT.
+    batch = toplevel and estimate.limit is None and \
+        (estimate.condition is None or is_plain_expression(estimate.condition))
     bql_compiler = BQLCompiler_1Row(population_id, generator_id,
-        estimate.modelnos)
+        estimate.modelnos, batch=batch, condition=estimate.condition)
     named = True
     columns = expand_select_columns(
         bdb, estimate.columns, named, bql_compiler, out)
@@ -606,6 +759,7 @@ def subquery_columns(bdb, subquery, out):
     # XXX We need some kind of type checking to guarantee that
     # what we get out of this will be a list of columns in the
     # named table.
+    out.uncacheable()
     subout = out.subquery()
     with compiling_paren(bdb, subout,
             'SELECT CAST(name AS TEXT) FROM (', ')'):
@@ -641,6 +795,9 @@ def compile_select_table(bdb, table, bql_compiler, out):
 def compile_simulate(bdb, simulate, out):
     assert all(isinstance(c, ast.SelColExp) for c in simulate.columns)
     assert all(isinstance(c.expression, ast.ExpCol) for c in simulate.columns)
+    # Simulation happens now, at compile time, so the output is good
+    # for only this one execution.
+    out.uncacheable()
     with bdb.savepoint():
         temptable = bdb.temp_table_name()
         assert not core.bayesdb_has_table(bdb, temptable)
@@ -935,7 +1092,8 @@ def compile_estpaircols(bdb, estpaircols, out):
         generator_id = core.bayesdb_get_generator(
             bdb, population_id, estpaircols.generator)
     bql_compiler = BQLCompiler_2Col(population_id, generator_id,
-        estpaircols.modelnos, colno0_exp, colno1_exp)
+        estpaircols.modelnos, colno0_exp, colno1_exp,
+        subcolumns=estpaircols.subcolumns)
     out.write('SELECT'
         ' %d AS population_id, v0.name AS name0, v1.name AS name1' %
         (population_id,))
@@ -1003,7 +1161,7 @@ def compile_estpaircols(bdb, estpaircols, out):
             compile_expression(bdb, estpaircols.limit.offset, bql_compiler,
                 out)
 
-def compile_estpairrow(bdb, estpairrow, out):
+def compile_estpairrow(bdb, estpairrow, toplevel, out):
     assert isinstance(estpairrow, ast.EstPairRow)
     if not core.bayesdb_has_population(bdb, estpairrow.population):
         raise BQLError(bdb, 'No such population: %s' %
@@ -1019,8 +1177,14 @@ def compile_estpairrow(bdb, estpairrow, out):
             bdb, population_id, estpairrow.generator)
     rowid0_exp = 'r0._rowid_'
     rowid1_exp = 'r1._rowid_'
+    # Without LIMIT, a query not nested in another touches every pair
+    # of rows satisfying the condition, so similarities can be
+    # computed in a batch.
+    batch = toplevel and estpairrow.limit is None and (estpairrow.condition is None
+        or is_plain_expression(estpairrow.condition))
     bql_compiler = BQLCompiler_2Row(population_id, generator_id,
-        estpairrow.modelnos, rowid0_exp, rowid1_exp)
+        estpairrow.modelnos, rowid0_exp, rowid1_exp, batch=batch,
+        condition=estpairrow.condition)
     out.write('SELECT %s AS rowid0, %s AS rowid1,' % (rowid0_exp, rowid1_exp))
     named = True
     columns = expand_select_columns(
@@ -1136,6 +1300,17 @@ class BQLCompiler_Const(IBQLCompiler):
             assert False, 'Invalid BQL function: %s' % (repr(bql),)
 
 class BQLCompiler_1Row(BQLCompiler_Const):
+    def __init__(self, population_id, generator_id, modelnos, batch=False,
+            condition=None):
+        super(BQLCompiler_1Row, self).__init__(
+            population_id, generator_id, modelnos)
+        # If `batch' is true, the query ranges over every row of the
+        # population's table satisfying `condition', which must be
+        # None or free of BQL, so that row-wise estimates may be
+        # computed for all of them at once before the query runs.
+        self.batch = batch
+        self.condition = condition
+
     @override(IBQLCompiler)
     def implicit_reference_var_colno_exp(self, bdb):
         raise BQLError(bdb, 'No implicit BQL population variable')
@@ -1220,13 +1395,18 @@ class BQLCompiler_1Row(BQLCompiler_Const):
                         bdb, population_id, generator_id, constraint)
                     for constraint in constraints
                 ]
-            out.write('bql_row_column_predictive_probability(%d, %s, %s' %(
-                population_id, nullor(generator_id), nullorq(modelnos)))
-            out.write(', %s, \'%s\', \'%s\')' % (
-                rowid_col,
-                json.dumps(colnos_targets),
-                json.dumps(colnos_constraints))
-            )
+            if self.batch:
+                compile_predictive_probability_batch(
+                    bdb, population_id, generator_id, modelnos,
+                    colnos_targets, colnos_constraints, self.condition, out)
+            else:
+                out.write('bql_row_column_predictive_probability(%d, %s, %s'
+                    % (population_id, nullor(generator_id), nullorq(modelnos)))
+                out.write(', %s, \'%s\', \'%s\')' % (
+                    rowid_col,
+                    json.dumps(colnos_targets),
+                    json.dumps(colnos_constraints))
+                )
         elif isinstance(bql, ast.ExpBQLSim) and bql.ofcondition is None:
             if bql.ofcondition is not None:
                 raise BQLError(bdb, 'Similarity as 1-row function needs one '
@@ -1253,11 +1433,96 @@ class BQLCompiler_1Row(BQLCompiler_Const):
         else:
             super(BQLCompiler_1Row, self).compile_bql(bdb, bql, out)
 
+def compile_predictive_probability_batch(bdb, population_id, generator_id,
+        modelnos, colnos_targets, colnos_constraints, condition, out):
+    # Before the query runs, fill a temporary table with the
+    # predictive probability of every row satisfying the condition,
+    # using one batched call to each backend, and look it up by rowid.
+    table_name = core.bayesdb_population_table(bdb, population_id)
+    qt = sqlite3_quote_name(table_name)
+    temptable = out.temp_table_name(bdb)
+    assert not core.bayesdb_has_table(bdb, temptable)
+    out.winder(out.temp_table_sql('''
+        CREATE TEMP TABLE %s (rowid INTEGER PRIMARY KEY, value REAL)
+    ''', temptable), ())
+    subout = out.subquery()
+    subout.write('INSERT INTO ')
+    subout.write_temp_table(temptable)
+    subout.write(' (rowid) SELECT _rowid_ FROM %s' % (qt,))
+    if condition is not None:
+        subout.write(' WHERE ')
+        compile_nobql_expression(bdb, condition, subout)
+    out.subquery_winder(subout)
+    out.winder('''
+        SELECT bql_row_column_predictive_probability_batch(%d, %s, %s, ?, ?, ?)
+    ''' % (population_id, nullor(generator_id), nullorq(modelnos)),
+        (temptable, json.dumps(colnos_targets),
+            json.dumps(colnos_constraints)),
+        temptables=[0])
+    out.unwinder(out.temp_table_sql('DROP TABLE %s', temptable), ())
+    out.write('(SELECT value FROM ')
+    out.write_temp_table(temptable)
+    out.write(' WHERE rowid = %s._rowid_)' % (qt,))
+
+def is_plain_expression(exp):
+    """True if `exp` is free of BQL and subqueries."""
+    if isinstance(exp, (ast.ExpLit, ast.ExpNumpar, ast.ExpNampar, ast.ExpCol,
+            ast.ExpAppStar)):
+        return True
+    elif isinstance(exp, (ast.ExpCollate, ast.ExpCast)):
+        return is_plain_expression(exp.expression)
+    elif isinstance(exp, ast.ExpInExp):
+        return is_plain_expression(exp.expression) and \
+            all(is_plain_expression(e) for e in exp.expressions)
+    elif isinstance(exp, ast.ExpApp):
+        # The condition is evaluated twice, so it must be deterministic.
+        return casefold(exp.operator) not in ('random', 'randomblob') and \
+            all(is_plain_expression(e) for e in exp.operands)
+    elif isinstance(exp, ast.ExpOp):
+        return all(is_plain_expression(e) for e in exp.operands)
+    elif isinstance(exp, ast.ExpCase):
+        return (exp.key is None or is_plain_expression(exp.key)) and \
+            all(is_plain_expression(cond) and is_plain_expression(then)
+                for cond, then in exp.whens) and \
+            (exp.otherwise is None or is_plain_expression(exp.otherwise))
+    else:
+        return False
+
 class BQLCompiler_1Row_Infer(BQLCompiler_1Row):
+    def __init__(self, population_id, generator_id, modelnos, batch=False,
+            condition=None, impute=False):
+        super(BQLCompiler_1Row_Infer, self).__init__(
+            population_id, generator_id, modelnos, batch=batch,
+            condition=condition)
+        # If `impute' is true, every prediction only fills in a missing
+        # value of its variable, as in INFER without EXPLICIT, so a
+        # batch need cover only the rows where it is missing.
+        self.impute = impute
+        self.prediction_tables = {}
+
     @override(IBQLCompiler)
     def implicit_reference_var_colno_exp(self, bdb):
         raise BQLError(bdb, 'No implicit BQL population variable')
 
+    def prediction_table(self, bdb, colno, nsamples, out):
+        # Return the table of predictions of colno in a batch, compiling
+        # it the first time, or None if they cannot be batched: the
+        # number of samples must be known before the query runs.
+        if not self.batch or \
+                not (nsamples is None or isinstance(nsamples, ast.ExpLit)):
+            return None
+        nsout = out.subquery()
+        if nsamples is None:
+            nsout.write('NULL')
+        else:
+            compile_nobql_expression(bdb, nsamples, nsout)
+        key = (colno, nsout.getvalue())
+        if key not in self.prediction_tables:
+            self.prediction_tables[key] = compile_predict_batch(
+                bdb, self.population_id, self.generator_id, self.modelnos,
+                colno, nsout.getvalue(), self.condition, self.impute, out)
+        return self.prediction_tables[key]
+
     @override(IBQLCompiler)
     def compile_bql(self, bdb, bql, out):
         assert ast.is_bql(bql)
@@ -1274,6 +1539,21 @@ class BQLCompiler_1Row_Infer(BQLCompiler_1Row):
                     (population, bql.column))
             colno = core.bayesdb_variable_number(bdb, population_id,
                 generator_id, bql.column)
+            temptable = self.prediction_table(bdb, colno, bql.nsamples, out)
+            if temptable is not None:
+                # Give the value only if the confidence is high enough,
+                # as bql_predict does.
+                out.write('CASE WHEN ')
+                compile_prediction_lookup(
+                    bdb, population_id, temptable, 'confidence', out)
+                out.write(' < ')
+                with compiling_paren(bdb, out, '(', ')'):
+                    compile_expression(bdb, bql.confidence, self, out)
+                out.write(' THEN NULL ELSE ')
+                compile_prediction_lookup(
+                    bdb, population_id, temptable, 'value', out)
+                out.write(' END')
+                return
             out.write('bql_predict(%d, %s, %s' %
                 (population_id, nullor(generator_id), nullorq(modelnos)))
             out.write(', %s, %d, ' % (rowid_col, colno))
@@ -1293,6 +1573,11 @@ class BQLCompiler_1Row_Infer(BQLCompiler_1Row):
                     (population, bql.column))
             colno = core.bayesdb_variable_number(bdb, population_id,
                 generator_id, bql.column)
+            temptable = self.prediction_table(bdb, colno, bql.nsamples, out)
+            if temptable is not None:
+                compile_prediction_lookup(
+                    bdb, population_id, temptable, 'prediction', out)
+                return
             out.write('bql_predict_confidence(%d, %s, %s' %
                 (population_id, nullor(generator_id), nullorq(modelnos)))
             out.write(', %s, %d, ' % (rowid_col, colno))
@@ -1304,9 +1589,54 @@ class BQLCompiler_1Row_Infer(BQLCompiler_1Row):
         else:
             super(BQLCompiler_1Row_Infer, self).compile_bql(bdb, bql, out)
 
+def compile_predict_batch(bdb, population_id, generator_id, modelnos, colno,
+        nsamples, condition, impute, out):
+    # Before the query runs, fill a temporary table with a prediction
+    # of colno and its confidence for every row satisfying the
+    # condition -- only where colno is missing, if `impute' -- using
+    # one batched call to each backend, and return its name.
+    table_name = core.bayesdb_population_table(bdb, population_id)
+    qt = sqlite3_quote_name(table_name)
+    temptable = out.temp_table_name(bdb)
+    assert not core.bayesdb_has_table(bdb, temptable)
+    out.winder(out.temp_table_sql('''
+        CREATE TEMP TABLE %s (
+            rowid       INTEGER PRIMARY KEY,
+            value,
+            confidence  REAL,
+            prediction  TEXT
+        )
+    ''', temptable), ())
+    subout = out.subquery()
+    subout.write('INSERT INTO ')
+    subout.write_temp_table(temptable)
+    subout.write(' (rowid) SELECT _rowid_ FROM %s' % (qt,))
+    if impute:
+        qcn = sqlite3_quote_name(
+            core.bayesdb_variable_name(bdb, population_id, generator_id, colno))
+        subout.write(' WHERE %s IS NULL' % (qcn,))
+    if condition is not None:
+        subout.write(' AND ' if impute else ' WHERE ')
+        compile_nobql_expression(bdb, condition, subout)
+    out.subquery_winder(subout)
+    out.winder('''
+        SELECT bql_predict_confidence_batch(%d, %s, %s, ?, %d, %s)
+    ''' % (population_id, nullor(generator_id), nullorq(modelnos), colno,
+            nsamples),
+        (temptable,), temptables=[0])
+    out.unwinder(out.temp_table_sql('DROP TABLE %s', temptable), ())
+    return temptable
+
+def compile_prediction_lookup(bdb, population_id, temptable, column, out):
+    table_name = core.bayesdb_population_table(bdb, population_id)
+    qt = sqlite3_quote_name(table_name)
+    out.write('(SELECT %s FROM ' % (column,))
+    out.write_temp_table(temptable)
+    out.write(' WHERE rowid = %s._rowid_)' % (qt,))
+
 class BQLCompiler_2Row(IBQLCompiler):
     def __init__(self, population_id, generator_id, modelnos, rowid0_exp,
-            rowid1_exp):
+            rowid1_exp, batch=False, condition=None):
         assert isinstance(population_id, int)
         assert generator_id is None or isinstance(generator_id, int)
         assert modelnos is None or isinstance(modelnos, list)
@@ -1317,6 +1647,14 @@ class BQLCompiler_2Row(IBQLCompiler):
         self.modelnos = modelnos
         self.rowid0_exp = rowid0_exp
         self.rowid1_exp = rowid1_exp
+        # If `batch' is true, the query ranges over every pair of rows
+        # of the population's table satisfying `condition', which must
+        # be None or free of BQL, so that similarities may be computed
+        # for all of them at once before the query runs.
+        self.batch = batch
+        self.condition = condition
+        # Temporary tables of similarities, by context colno.
+        self.similarity_tables = {}
 
     @override(IBQLCompiler)
     def implicit_reference_var_colno_exp(self, bdb):
@@ -1341,16 +1679,31 @@ class BQLCompiler_2Row(IBQLCompiler):
             if bql.ofcondition is not None or bql.tocondition is not None:
                 raise BQLError(bdb, 'Similarity needs no row'
                     ' in 2-row context.')
-            out.write('bql_row_similarity(%d, %s, %s' %
-                (population_id, nullor(generator_id), nullorq(modelnos)))
-            out.write(', %s, %s' % (self.rowid0_exp, self.rowid1_exp))
             assert len(bql.column) == 1
             if isinstance(bql.column[0], ast.ColListAll):
                 raise BQLError(bdb, 'Cannot use all variables for CONTEXT.')
-            out.write(', ')
-            compile_column_lists(bdb, population_id, generator_id,
-                bql.column, self, out)
-            out.write(')')
+            if self.batch and isinstance(bql.column[0], ast.ColListLit) \
+                    and len(bql.column[0].columns) == 1:
+                colout = out.subquery()
+                compile_column_lists(bdb, population_id, generator_id,
+                    bql.column, self, colout)
+                colno = int(colout.getvalue())
+                if colno not in self.similarity_tables:
+                    self.similarity_tables[colno] = compile_similarity_batch(
+                        bdb, population_id, generator_id, modelnos, colno,
+                        self.condition, out)
+                out.write('(SELECT value FROM ')
+                out.write_temp_table(self.similarity_tables[colno])
+                out.write(' WHERE rowid0 = %s AND rowid1 = %s)'
+                    % (self.rowid0_exp, self.rowid1_exp))
+            else:
+                out.write('bql_row_similarity(%d, %s, %s' %
+                    (population_id, nullor(generator_id), nullorq(modelnos)))
+                out.write(', %s, %s' % (self.rowid0_exp, self.rowid1_exp))
+                out.write(', ')
+                compile_column_lists(bdb, population_id, generator_id,
+                    bql.column, self, out)
+                out.write(')')
         elif isinstance(bql, ast.ExpBQLDepProb):
             raise BQLError(bdb, 'Dependence probability is 0-row function.')
         elif isinstance(bql, ast.ExpBQLMutInf):
@@ -1423,7 +1776,7 @@ class BQLCompiler_1Col(BQLCompiler_Const):
 
 class BQLCompiler_2Col(BQLCompiler_Const):
     def __init__(self, population_id, generator_id, modelnos,
-            colno0_exp, colno1_exp):
+            colno0_exp, colno1_exp, subcolumns=None):
         assert isinstance(population_id, int)
         assert generator_id is None or isinstance(generator_id, int)
         assert modelnos is None or isinstance(modelnos, list)
@@ -1433,6 +1786,12 @@ class BQLCompiler_2Col(BQLCompiler_Const):
             modelnos)
         self.colno0_exp = colno0_exp
         self.colno1_exp = colno1_exp
+        # Column lists the query ranges over, or None for every
+        # variable.
+        self.subcolumns = subcolumns
+        # Temporary table of the dependence probability of every pair
+        # of those variables, once any has been compiled.
+        self.depprob_table = None
 
     @override(IBQLCompiler)
     def implicit_reference_var_colno_exp(self, bdb):
@@ -1448,11 +1807,16 @@ class BQLCompiler_2Col(BQLCompiler_Const):
             compile_pdf_joint(bdb, population_id, generator_id, modelnos,
                 bql.targets, bql.constraints, self, out)
         elif isinstance(bql, ast.ExpBQLDepProb):
-            compile_bql_2col_0(bdb, population_id, generator_id, modelnos,
-                'bql_column_dependence_probability',
-                'Dependence probability',
-                None,
-                bql, self.colno0_exp, self.colno1_exp, self, out)
+            if bql.column0 is not None or bql.column1 is not None:
+                raise BQLError(bdb, 'Dependence probability needs no columns.')
+            if self.depprob_table is None:
+                self.depprob_table = compile_depprob_batch(
+                    bdb, population_id, generator_id, modelnos,
+                    self.subcolumns, out)
+            out.write('(SELECT value FROM ')
+            out.write_temp_table(self.depprob_table)
+            out.write(' WHERE colno0 = %s AND colno1 = %s)'
+                % (self.colno0_exp, self.colno1_exp))
         elif isinstance(bql, ast.ExpBQLMutInf):
             compile_mutinf_2col_0(
                 bdb, population_id, generator_id, modelnos, bql, self.colno0_exp,
@@ -1472,6 +1836,86 @@ class BQLCompiler_2Col(BQLCompiler_Const):
         else:
             super(BQLCompiler_2Col, self).compile_bql(bdb, bql, out)
 
+def compile_depprob_batch(bdb, population_id, generator_id, modelnos,
+        subcolumns, out):
+    # Before the query runs, fill a temporary table with the
+    # dependence probability of every pair of variables in subcolumns,
+    # or of all variables if None, using one batched call to each
+    # backend, and return its name.
+    temptable = out.temp_table_name(bdb)
+    assert not core.bayesdb_has_table(bdb, temptable)
+    if subcolumns is None:
+        colnos = core.bayesdb_variable_numbers(
+            bdb, population_id, generator_id)
+    else:
+        colnos = column_lists_colnos(
+            bdb, population_id, generator_id, subcolumns, out)
+        # Each pair goes in the table once.
+        colnos = sorted(set(colnos))
+    out.winder(out.temp_table_sql('''
+        CREATE TEMP TABLE %s (
+            colno0  INTEGER NOT NULL,
+            colno1  INTEGER NOT NULL,
+            value   REAL,
+            PRIMARY KEY(colno0, colno1)
+        )
+    ''', temptable), ())
+    out.winder('''
+        SELECT bql_column_dependence_probability_batch(%d, %s, %s, ?, ?)
+    ''' % (population_id, nullor(generator_id), nullorq(modelnos)),
+        (temptable, json.dumps(colnos)), temptables=[0])
+    out.unwinder(out.temp_table_sql('DROP TABLE %s', temptable), ())
+    return temptable
+
+def compile_similarity_batch(bdb, population_id, generator_id, modelnos,
+        colno, condition, out):
+    # Before the query runs, fill a temporary table with the
+    # similarity in the context of colno of every pair of rows that
+    # may satisfy the condition, using one batched call to each
+    # backend, and return its name.
+    table_name = core.bayesdb_population_table(bdb, population_id)
+    qt = sqlite3_quote_name(table_name)
+    temptable = out.temp_table_name(bdb)
+    assert not core.bayesdb_has_table(bdb, temptable)
+    rowstable = out.temp_table_name(bdb)
+    assert not core.bayesdb_has_table(bdb, rowstable)
+    out.winder(out.temp_table_sql('''
+        CREATE TEMP TABLE %s (
+            rowid0  INTEGER NOT NULL,
+            rowid1  INTEGER NOT NULL,
+            value   REAL,
+            PRIMARY KEY(rowid0, rowid1)
+        )
+    ''', temptable), ())
+    # List the rows that may appear on each side of a pair: those
+    # for which some row on the other side satisfies the condition.
+    out.winder(out.temp_table_sql('''
+        CREATE TEMP TABLE %s (
+            side    INTEGER NOT NULL,
+            rowid   INTEGER NOT NULL,
+            PRIMARY KEY(side, rowid)
+        )
+    ''', rowstable), ())
+    for side, (this, other) in enumerate([('r0', 'r1'), ('r1', 'r0')]):
+        subout = out.subquery()
+        subout.write('INSERT INTO ')
+        subout.write_temp_table(rowstable)
+        subout.write(' (side, rowid) SELECT %d, %s._rowid_ FROM %s AS %s'
+            % (side, this, qt, this))
+        if condition is not None:
+            subout.write(' WHERE EXISTS (SELECT 1 FROM %s AS %s WHERE '
+                % (qt, other))
+            compile_nobql_expression(bdb, condition, subout)
+            subout.write(')')
+        out.subquery_winder(subout)
+    out.winder('''
+        SELECT bql_row_similarity_batch(%d, %s, %s, ?, ?, ?)
+    ''' % (population_id, nullor(generator_id), nullorq(modelnos)),
+        (temptable, rowstable, colno), temptables=[0, 1])
+    out.unwinder(out.temp_table_sql('DROP TABLE %s', rowstable), ())
+    out.unwinder(out.temp_table_sql('DROP TABLE %s', temptable), ())
+    return temptable
+
 def compile_pdf_joint(bdb, population_id, generator_id, modelnos,
         targets, constraints, bql_compiler, out):
     out.write('bql_pdf_joint(%d, %s, %s' % (population_id,
@@ -1627,6 +2071,7 @@ def compile_predictive_relevance_conditions(bdb, population_id, generator_id,
     else:
         table_name = core.bayesdb_population_table(bdb, population_id)
         qt = sqlite3_quote_name(table_name)
+        out.uncacheable()
         subout = out.subquery()
         compile_expression(bdb, tocondition, bql_compiler, subout)
         subbindings = subout.getbindings()
@@ -1667,16 +2112,16 @@ def compile_constraints(bdb, population_id, generator_id, constraints,
 
 def compile_column_lists(bdb, population_id, generator_id, column_lists,
         _bql_compiler, out):
-    first = True
+    colnos = column_lists_colnos(
+        bdb, population_id, generator_id, column_lists, out)
+    out.write(', '.join(str(colno) for colno in colnos))
+
+def column_lists_colnos(bdb, population_id, generator_id, column_lists, out):
+    colnos = []
     for collist in column_lists:
-        if first:
-            first = False
-        else:
-            out.write(', ')
         if isinstance(collist, ast.ColListAll):
-            colnos = core.bayesdb_variable_numbers(bdb, population_id,
+            colnos += core.bayesdb_variable_numbers(bdb, population_id,
                 generator_id)
-            out.write(', '.join(str(colno) for colno in colnos))
         elif isinstance(collist, ast.ColListLit):
             unknown = set()
             for column in collist.columns:
@@ -1686,14 +2131,14 @@ def compile_column_lists(bdb, population_id, generator_id, column_lists,
             if 0 < len(unknown):
                 raise BQLError(bdb, 'No such columns in population: %s' %
                     (repr(list(unknown)),))
-            colnos = (core.bayesdb_variable_number(bdb, population_id,
+            colnos += (core.bayesdb_variable_number(bdb, population_id,
                     generator_id, column)
                 for column in collist.columns)
-            out.write(', '.join(str(colno) for colno in colnos))
         elif isinstance(collist, ast.ColListSub):
             # XXX We need some kind of type checking to guarantee that
             # what we get out of this will be a list of columns in the
             # table implied by the surrounding context.
+            out.uncacheable()
             subout = out.subquery()
             compile_query(bdb, collist.query, subout)
             subquery = subout.getvalue()
@@ -1701,23 +2146,18 @@ def compile_column_lists(bdb, population_id, generator_id, column_lists,
             subwinders, subunwinders = subout.getwindings()
             with bayesdb_wind(bdb, subwinders, subunwinders):
                 columns = bdb.sql_execute(subquery, subbindings).fetchall()
-            subfirst = True
             for column in columns:
-                if subfirst:
-                    subfirst = False
-                else:
-                    out.write(', ')
                 if len(column) != 1:
                     raise BQLError(bdb, 'ESTIMATE * FROM COLUMNS OF subquery'
                         ' returned multi-cell rows.')
                 if not isinstance(column[0], unicode):
                     raise BQLError(bdb, 'ESTIMATE * FROM COLUMNS OF subquery'
                         ' returned non-string.')
-                colno = core.bayesdb_variable_number(bdb, population_id,
-                    generator_id, column[0])
-                out.write('%d' % (colno,))
+                colnos.append(core.bayesdb_variable_number(bdb,
+                    population_id, generator_id, column[0]))
         else:
             assert False, 'Invalid column list: %s' % (repr(collist),)
+    return colnos
 
 def compile_bql_2col_2(bdb, population_id, generator_id, modelnos, bqlfn,
         desc, extra, bql, bql_compiler, out):
@@ -39,13 +39,66 @@ representing a particular choice of parameters for the parametrized
 generative model.  Models are numbered consecutively for the
 generator, and may be identified uniquely by ``(generator_id,
 modelno)`` or ``(generator_name, modelno)``.
+
+Lookups of populations, variables, generators, and rowid tokens are
+answered from a per-BayesDB in-memory catalog cache, so that repeated
+compilation and evaluation of BQL need not query the catalog tables
+over and over.  The cache is disabled while a BQL command runs, and is
+discarded whenever the catalog may have changed: after every BQL
+command, whenever a savepoint or transaction is rolled back, and when
+variables are added.  Each discard bumps the catalog generation,
+:func:`bayesdb_catalog_generation`.
 """
 
+import contextlib
+
 from bayeslite.exception import BQLError
 from bayeslite.sqlite3_util import sqlite3_quote_name
 from bayeslite.util import casefold
 from bayeslite.util import cursor_value
 
+def bayesdb_catalog_generation(bdb):
+    """Return the generation number of the catalog of `bdb`.
+
+    The generation number changes whenever populations, variables, or
+    generators may have changed, so it can be used to key caches of
+    anything derived from the catalog.
+    """
+    return bdb._catalog_generation
+
+def bayesdb_catalog_invalidate(bdb):
+    """Discard cached catalog metadata and bump the catalog generation."""
+    bdb._catalog_generation += 1
+    if bdb._catalog_cache is not None:
+        bdb._catalog_cache = {}
+
+@contextlib.contextmanager
+def bayesdb_catalog_changing(bdb):
+    """Context manager for operations that may change the catalog.
+
+    Catalog lookups bypass the cache until the outermost such context
+    exits, at which point the cache is discarded.
+    """
+    cache = bdb._catalog_cache
+    bdb._catalog_cache = None
+    bdb._catalog_generation += 1
+    try:
+        yield
+    finally:
+        bdb._catalog_generation += 1
+        bdb._catalog_cache = None if cache is None else {}
+
+def _catalog_cached(bdb, key, compute):
+    cache = bdb._catalog_cache
+    if cache is None:
+        return compute()
+    try:
+        return cache[key]
+    except KeyError:
+        value = compute()
+        cache[key] = value
+        return value
+
 def bayesdb_has_table(bdb, name):
     """True if there is a table named `name` in `bdb`.
 
@@ -202,8 +255,10 @@ def bayesdb_table_has_rowid(bdb, table, rowid):
 
 def bayesdb_has_population(bdb, name):
     """True if there is a population named `name` in `bdb`."""
-    sql = 'SELECT COUNT(*) FROM bayesdb_population WHERE name = ?'
-    return 0 != cursor_value(bdb.sql_execute(sql, (name,)))
+    def lookup():
+        sql = 'SELECT COUNT(*) FROM bayesdb_population WHERE name = ?'
+        return 0 != cursor_value(bdb.sql_execute(sql, (name,)))
+    return _catalog_cached(bdb, ('has_population', name), lookup)
 
 def bayesdb_get_population(bdb, name):
     """Return the id of the population named `name` in `bdb`.
@@ -214,56 +269,71 @@ def bayesdb_get_population(bdb, name):
     `bdb` must have a population named `name`.  If you're not sure,
     call :func:`bayesdb_has_population` first.
     """
-    sql = 'SELECT id FROM bayesdb_population WHERE name = ?'
-    cursor = bdb.sql_execute(sql, (name,))
-    try:
-        row = cursor.next()
-    except StopIteration:
-        raise ValueError('No such population: %r' % (repr(name),))
-    else:
-        assert isinstance(row[0], int)
-        return row[0]
+    def lookup():
+        sql = 'SELECT id FROM bayesdb_population WHERE name = ?'
+        cursor = bdb.sql_execute(sql, (name,))
+        try:
+            row = cursor.next()
+        except StopIteration:
+            raise ValueError('No such population: %r' % (repr(name),))
+        else:
+            assert isinstance(row[0], int)
+            return row[0]
+    return _catalog_cached(bdb, ('population', name), lookup)
 
 def bayesdb_population_name(bdb, population_id):
     """Return the name of the population with given `population_id`."""
-    sql = 'SELECT name FROM bayesdb_population WHERE id = ?'
-    cursor = bdb.sql_execute(sql, (population_id,))
-    try:
-        row = cursor.next()
-    except StopIteration:
-        raise ValueError('No such population id: %r' % (repr(population_id),))
-    else:
-        return row[0]
+    def lookup():
+        sql = 'SELECT name FROM bayesdb_population WHERE id = ?'
+        cursor = bdb.sql_execute(sql, (population_id,))
+        try:
+            row = cursor.next()
+        except StopIteration:
+            raise ValueError('No such population id: %r'
+                % (repr(population_id),))
+        else:
+            return row[0]
+    return _catalog_cached(bdb, ('population_name', population_id), lookup)
 
 def bayesdb_population_table(bdb, population_id):
     """Return the name of table of the population with id `id`."""
-    sql = 'SELECT tabname FROM bayesdb_population WHERE id = ?'
-    cursor = bdb.sql_execute(sql, (population_id,))
-    try:
-        row = cursor.next()
-    except StopIteration:
-        raise ValueError('No such population id: %r' % (repr(population_id),))
-    else:
-        return row[0]
+    def lookup():
+        sql = 'SELECT tabname FROM bayesdb_population WHERE id = ?'
+        cursor = bdb.sql_execute(sql, (population_id,))
+        try:
+            row = cursor.next()
+        except StopIteration:
+            raise ValueError('No such population id: %r'
+                % (repr(population_id),))
+        else:
+            return row[0]
+    return _catalog_cached(bdb, ('population_table', population_id), lookup)
 
 def bayesdb_population_generators(bdb, population_id):
     """Return list of generators for population_id."""
-    cursor = bdb.sql_execute('''
-        SELECT id FROM bayesdb_generator WHERE population_id = ?
-    ''', (population_id,))
-    return [generator_id for (generator_id,) in cursor]
+    def lookup():
+        cursor = bdb.sql_execute('''
+            SELECT id FROM bayesdb_generator WHERE population_id = ?
+        ''', (population_id,))
+        return tuple(generator_id for (generator_id,) in cursor)
+    key = ('population_generators', population_id)
+    return list(_catalog_cached(bdb, key, lookup))
 
 def bayesdb_population_is_implicit(bdb, population_id):
     """True if the population with id `id` is implicit."""
-    sql = 'SELECT implicit FROM bayesdb_population WHERE id = ?'
-    cursor = bdb.sql_execute(sql, (population_id,))
-    try:
-        (result,) = cursor.next()
-    except StopIteration:
-        raise ValueError('No such population id: %r' % (repr(population_id),))
-    else:
-        assert result in [0, 1]
-        return result == 1
+    def lookup():
+        sql = 'SELECT implicit FROM bayesdb_population WHERE id = ?'
+        cursor = bdb.sql_execute(sql, (population_id,))
+        try:
+            (result,) = cursor.next()
+        except StopIteration:
+            raise ValueError('No such population id: %r'
+                % (repr(population_id),))
+        else:
+            assert result in [0, 1]
+            return result == 1
+    key = ('population_is_implicit', population_id)
+    return _catalog_cached(bdb, key, lookup)
 
 def bayesdb_population_has_implicit_generator(bdb, population_id):
     """True if `population_id` has an implicit generator."""
@@ -301,6 +371,7 @@ def bayesdb_add_variable(bdb, population_id, name, stattype):
             (population_id, name, colno, stattype)
             VALUES (?, ?, ?, ?)
     ''', (population_id, name, colno, stattype))
+    bayesdb_catalog_invalidate(bdb)
 
 def bayesdb_has_variable(bdb, population_id, generator_id, name):
     """True if the population has a given variable.
@@ -308,23 +379,29 @@ def bayesdb_has_variable(bdb, population_id, generator_id, name):
     generator_id is None for manifest variables and the id of a
     generator for variables that may be latent.
     """
-    cursor = bdb.sql_execute('''
-        SELECT COUNT(*) FROM bayesdb_variable
-            WHERE population_id = ?
-                AND (generator_id IS NULL OR generator_id = ?)
-                AND name = ?
-    ''', (population_id, generator_id, name))
-    return cursor_value(cursor) != 0
+    def lookup():
+        cursor = bdb.sql_execute('''
+            SELECT COUNT(*) FROM bayesdb_variable
+                WHERE population_id = ?
+                    AND (generator_id IS NULL OR generator_id = ?)
+                    AND name = ?
+        ''', (population_id, generator_id, name))
+        return cursor_value(cursor) != 0
+    key = ('has_variable', population_id, generator_id, name)
+    return _catalog_cached(bdb, key, lookup)
 
 def bayesdb_variable_number(bdb, population_id, generator_id, name):
     """Return the column number of a population variable."""
-    cursor = bdb.sql_execute('''
-        SELECT colno FROM bayesdb_variable
-            WHERE population_id = ?
-                AND (generator_id IS NULL OR generator_id = ?)
-                AND name = ?
-    ''', (population_id, generator_id, name))
-    return cursor_value(cursor)
+    def lookup():
+        cursor = bdb.sql_execute('''
+            SELECT colno FROM bayesdb_variable
+                WHERE population_id = ?
+                    AND (generator_id IS NULL OR generator_id = ?)
+                    AND name = ?
+        ''', (population_id, generator_id, name))
+        return cursor_value(cursor)
+    key = ('variable_number', population_id, generator_id, name)
+    return _catalog_cached(bdb, key, lookup)
 
 def bayesdb_variable_names(bdb, population_id, generator_id):
     """Return a list of the names of columns modeled in `population_id`."""
@@ -334,57 +411,66 @@ def bayesdb_variable_names(bdb, population_id, generator_id):
 
 def bayesdb_variable_numbers(bdb, population_id, generator_id):
     """Return a list of the numbers of columns modeled in `population_id`."""
-    cursor = bdb.sql_execute('''
-        SELECT colno FROM bayesdb_variable
-            WHERE population_id = ?
-                AND (generator_id IS NULL OR generator_id = ?)
-            ORDER BY colno ASC
-    ''', (population_id, generator_id))
-    return [colno for (colno,) in cursor]
+    def lookup():
+        cursor = bdb.sql_execute('''
+            SELECT colno FROM bayesdb_variable
+                WHERE population_id = ?
+                    AND (generator_id IS NULL OR generator_id = ?)
+                ORDER BY colno ASC
+        ''', (population_id, generator_id))
+        return tuple(colno for (colno,) in cursor)
+    key = ('variable_numbers', population_id, generator_id)
+    return list(_catalog_cached(bdb, key, lookup))
 
 def bayesdb_variable_name(bdb, population_id, generator_id, colno):
     """Return the name a population variable."""
-    cursor = bdb.sql_execute('''
-        SELECT name FROM bayesdb_variable
-            WHERE population_id = ?
-                AND (generator_id IS NULL OR generator_id = ?)
-                AND colno = ?
-    ''', (population_id, generator_id, colno))
-    return cursor_value(cursor)
+    def lookup():
+        cursor = bdb.sql_execute('''
+            SELECT name FROM bayesdb_variable
+                WHERE population_id = ?
+                    AND (generator_id IS NULL OR generator_id = ?)
+                    AND colno = ?
+        ''', (population_id, generator_id, colno))
+        return cursor_value(cursor)
+    key = ('variable_name', population_id, generator_id, colno)
+    return _catalog_cached(bdb, key, lookup)
 
 def bayesdb_variable_stattype(bdb, population_id, generator_id, colno):
     """Return the statistical type of a population variable."""
-    sql = '''
-        SELECT stattype FROM bayesdb_variable
-            WHERE population_id = ?
-                AND (generator_id IS NULL OR generator_id = ?)
-                AND colno = ?
-    '''
-    cursor = bdb.sql_execute(sql, (population_id, generator_id, colno))
-    try:
-        row = cursor.next()
-    except StopIteration:
-        population = bayesdb_population_name(bdb, population_id)
+    def lookup():
         sql = '''
-            SELECT COUNT(*)
-                FROM bayesdb_population AS p, bayesdb_column AS c
-                WHERE p.id = :population_id
-                    AND p.tabname = c.tabname
-                    AND c.colno = :colno
+            SELECT stattype FROM bayesdb_variable
+                WHERE population_id = ?
+                    AND (generator_id IS NULL OR generator_id = ?)
+                    AND colno = ?
         '''
-        cursor = bdb.sql_execute(sql, {
-            'population_id': population_id,
-            'colno': colno,
-        })
-        if cursor_value(cursor) == 0:
-            raise ValueError('No such variable in population %s: %d'
-                % (population, colno))
+        cursor = bdb.sql_execute(sql, (population_id, generator_id, colno))
+        try:
+            row = cursor.next()
+        except StopIteration:
+            population = bayesdb_population_name(bdb, population_id)
+            sql = '''
+                SELECT COUNT(*)
+                    FROM bayesdb_population AS p, bayesdb_column AS c
+                    WHERE p.id = :population_id
+                        AND p.tabname = c.tabname
+                        AND c.colno = :colno
+            '''
+            cursor = bdb.sql_execute(sql, {
+                'population_id': population_id,
+                'colno': colno,
+            })
+            if cursor_value(cursor) == 0:
+                raise ValueError('No such variable in population %s: %d'
+                    % (population, colno))
+            else:
+                raise ValueError('Variable not modeled in population %s: %d'
+                    % (population, colno))
         else:
-            raise ValueError('Variable not modeled in population %s: %d'
-                % (population, colno))
-    else:
-        assert len(row) == 1
-        return row[0]
+            assert len(row) == 1
+            return row[0]
+    key = ('variable_stattype', population_id, generator_id, colno)
+    return _catalog_cached(bdb, key, lookup)
 
 def bayesdb_add_latent(bdb, population_id, generator_id, var, stattype):
     """Add a generator's latent variable to a population.
@@ -402,6 +488,7 @@ def bayesdb_add_latent(bdb, population_id, generator_id, var, stattype):
                 (population_id, generator_id, colno, name, stattype)
                 VALUES (?, ?, ?, ?, ?)
         ''', (population_id, generator_id, colno, var, stattype))
+        bayesdb_catalog_invalidate(bdb)
         return colno
 
 def bayesdb_has_latent(bdb, population_id, var):
@@ -452,16 +539,19 @@ def bayesdb_has_generator(bdb, population_id, name):
     defined for that population. Otherwise, when `population_id` is None, the
     `name` may be of any generator.
     """
-    if population_id is None:
-        sql = 'SELECT COUNT(*) FROM bayesdb_generator WHERE name = ?'
-        cursor = bdb.sql_execute(sql, (name,))
-    else:
-        sql = '''
-            SELECT COUNT(*) FROM bayesdb_generator
-                WHERE name = ? AND population_id = ?
-        '''
-        cursor = bdb.sql_execute(sql, (name, population_id))
-    return 0 != cursor_value(cursor)
+    def lookup():
+        if population_id is None:
+            sql = 'SELECT COUNT(*) FROM bayesdb_generator WHERE name = ?'
+            cursor = bdb.sql_execute(sql, (name,))
+        else:
+            sql = '''
+                SELECT COUNT(*) FROM bayesdb_generator
+                    WHERE name = ? AND population_id = ?
+            '''
+            cursor = bdb.sql_execute(sql, (name, population_id))
+        return 0 != cursor_value(cursor)
+    key = ('has_generator', population_id, name)
+    return _catalog_cached(bdb, key, lookup)
 
 def bayesdb_get_generator(bdb, population_id, name):
     """Return the id of the generator named `name` in `bdb`.
@@ -472,48 +562,59 @@ def bayesdb_get_generator(bdb, population_id, name):
     `bdb` must have a generator named `name`.  If you're not sure,
     call :func:`bayesdb_has_generator` first.
     """
-    if population_id is None:
-        sql = 'SELECT id FROM bayesdb_generator WHERE name = ?'
-        cursor = bdb.sql_execute(sql, (name,))
-    else:
-        sql = '''
-            SELECT id FROM bayesdb_generator
-                WHERE name = ? AND population_id = ?
-        '''
-        cursor = bdb.sql_execute(sql, (name, population_id))
-    try:
-        row = cursor.next()
-    except StopIteration:
-        raise ValueError('No such generator: %s' % (repr(name),))
-    else:
-        assert isinstance(row[0], int)
-        return row[0]
+    def lookup():
+        if population_id is None:
+            sql = 'SELECT id FROM bayesdb_generator WHERE name = ?'
+            cursor = bdb.sql_execute(sql, (name,))
+        else:
+            sql = '''
+                SELECT id FROM bayesdb_generator
+                    WHERE name = ? AND population_id = ?
+            '''
+            cursor = bdb.sql_execute(sql, (name, population_id))
+        try:
+            row = cursor.next()
+        except StopIteration:
+            raise ValueError('No such generator: %s' % (repr(name),))
+        else:
+            assert isinstance(row[0], int)
+            return row[0]
+    return _catalog_cached(bdb, ('generator', population_id, name), lookup)
 
 def bayesdb_generator_name(bdb, generator_id):
     """Return the name of the generator with given `generator_id`."""
-    sql = 'SELECT name FROM bayesdb_generator WHERE id = ?'
-    cursor = bdb.sql_execute(sql, (generator_id,))
-    try:
-        row = cursor.next()
-    except StopIteration:
-        raise ValueError('No such generator id: %r' % (repr(generator_id),))
-    else:
-        return row[0]
+    def lookup():
+        sql = 'SELECT name FROM bayesdb_generator WHERE id = ?'
+        cursor = bdb.sql_execute(sql, (generator_id,))
+        try:
+            row = cursor.next()
+        except StopIteration:
+            raise ValueError('No such generator id: %r'
+                % (repr(generator_id),))
+        else:
+            return row[0]
+    return _catalog_cached(bdb, ('generator_name', generator_id), lookup)
 
 def bayesdb_generator_backend(bdb, generator_id):
     """Return the backend of the generator with given `generator_id`."""
-    sql = 'SELECT backend FROM bayesdb_generator WHERE id = ?'
-    cursor = bdb.sql_execute(sql, (generator_id,))
-    try:
-        row = cursor.next()
-    except StopIteration:
-        raise ValueError('No such generator: %s' % (repr(generator_id),))
-    else:
-        if row[0] not in bdb.backends:
-            name = bayesdb_generator_name(bdb, generator_id)
-            raise ValueError('Backend of generator %s not registered: %s' %
-                (repr(name), repr(row[0])))
-        return bdb.backends[row[0]]
+    def lookup():
+        sql = 'SELECT backend FROM bayesdb_generator WHERE id = ?'
+        cursor = bdb.sql_execute(sql, (generator_id,))
+        try:
+            row = cursor.next()
+        except StopIteration:
+            raise ValueError('No such generator: %s' % (repr(generator_id),))
+        else:
+            return row[0]
+    # Cache only the backend's name: backends may be registered and
+    # deregistered independently of the catalog.
+    backend_name = _catalog_cached(
+        bdb, ('generator_backend', generator_id), lookup)
+    if backend_name not in bdb.backends:
+        name = bayesdb_generator_name(bdb, generator_id)
+        raise ValueError('Backend of generator %s not registered: %s' %
+            (repr(name), repr(backend_name)))
+    return bdb.backends[backend_name]
 
 def bayesdb_generator_table(bdb, generator_id):
     """Return name of table of the generator with given `generator_id`."""
@@ -522,27 +623,33 @@ def bayesdb_generator_table(bdb, generator_id):
 
 def bayesdb_generator_population(bdb, generator_id):
     """Return id of population of the generator with given `generator_id`."""
-    sql = 'SELECT population_id FROM bayesdb_generator WHERE id = ?'
-    cursor = bdb.sql_execute(sql, (generator_id,))
-    try:
-        row = cursor.next()
-    except StopIteration:
-        raise ValueError('No such generator: %s' % (repr(generator_id),))
-    else:
-        assert len(row) == 1
-        return row[0]
+    def lookup():
+        sql = 'SELECT population_id FROM bayesdb_generator WHERE id = ?'
+        cursor = bdb.sql_execute(sql, (generator_id,))
+        try:
+            row = cursor.next()
+        except StopIteration:
+            raise ValueError('No such generator: %s' % (repr(generator_id),))
+        else:
+            assert len(row) == 1
+            return row[0]
+    return _catalog_cached(bdb, ('generator_population', generator_id), lookup)
 
 def bayesdb_generator_is_implicit(bdb, generator_id):
     """True if the generator with given `generator_id` is implicit."""
-    sql = 'SELECT implicit FROM bayesdb_generator WHERE id = ?'
-    cursor = bdb.sql_execute(sql, (generator_id,))
-    try:
-        (result,) = cursor.next()
-    except StopIteration:
-        raise ValueError('No such generator id: %r' % (repr(generator_id),))
-    else:
-        assert result in [0, 1]
-        return result == 1
+    def lookup():
+        sql = 'SELECT implicit FROM bayesdb_generator WHERE id = ?'
+        cursor = bdb.sql_execute(sql, (generator_id,))
+        try:
+            (result,) = cursor.next()
+        except StopIteration:
+            raise ValueError('No such generator id: %r'
+                % (repr(generator_id),))
+        else:
+            assert result in [0, 1]
+            return result == 1
+    key = ('generator_is_implicit', generator_id)
+    return _catalog_cached(bdb, key, lookup)
 
 def bayesdb_generator_has_model(bdb, generator_id, modelno):
     """True if `generator_id` has a model numbered `modelno`."""
@@ -589,10 +696,12 @@ def bayesdb_population_row_values(bdb, population_id, rowid):
 
 def bayesdb_rowid_tokens(bdb):
     """Return list of built-in tokens that identify rowids (e.g. oid)."""
-    tokens = bdb.sql_execute('''
-        SELECT token FROM bayesdb_rowid_tokens
-    ''').fetchall()
-    return [t[0] for t in tokens]
+    def lookup():
+        tokens = bdb.sql_execute('''
+            SELECT token FROM bayesdb_rowid_tokens
+        ''').fetchall()
+        return tuple(t[0] for t in tokens)
+    return list(_catalog_cached(bdb, ('rowid_tokens',), lookup))
 
 def bayesdb_has_stattype(bdb, stattype):
     """True if `stattype` is registered in `bdb` instance."""
@@ -174,6 +174,7 @@ command(init_models)    ::= K_INITIALIZE L_INTEGER(n) model_token
 command(analyze_models) ::= K_ANALYZE generator_name(generator)
                                 anmodelset_opt(models) anlimit(anlimit)
                                 anckpt_opt(anckpt)
+                                anbackground_opt(background)
                                 analysis_program_opt(program).
 command(drop_models)    ::= K_DROP model_token modelset_opt(models)
                                 K_FROM generator_name(generator).
@@ -208,6 +209,9 @@ anlimit(two)      ::= K_FOR anduration(duration0) K_OR anduration(duration1).
 anckpt_opt(none)        ::= .
 anckpt_opt(some)        ::= K_CHECKPOINT anduration(duration).
 
+anbackground_opt(none)  ::= .
+anbackground_opt(some)  ::= K_IN K_BACKGROUND.
+
 anduration(iterations)  ::= L_INTEGER(n) K_ITERATION|K_ITERATIONS.
 anduration(minutes)     ::= L_INTEGER(n) K_MINUTE|K_MINUTES.
 anduration(seconds)     ::= L_INTEGER(n) K_SECOND|K_SECONDS.
@@ -770,6 +774,7 @@ typearg(negative)       ::= T_MINUS L_INTEGER(i).
         K_AND
         K_AS
         K_ASC
+        K_BACKGROUND
         K_BEGIN
         K_BETWEEN
         K_BTABLE
@@ -259,7 +259,7 @@ class BQLSemantics(object):
     def p_command_init_models(self, n, ifnotexists, generator):
         return ast.InitModels(ifnotexists, generator, n)
     def p_command_analyze_models(
-            self, generator, models, anlimit, anckpt, program):
+            self, generator, models, anlimit, anckpt, background, program):
         iters = [lim[1] for lim in anlimit if lim and lim[0] == 'iterations']
         secs = [lim[1] for lim in anlimit if lim and lim[0] == 'seconds']
         iterations = min(iters) if iters else None
@@ -270,7 +270,7 @@ class BQLSemantics(object):
             ckpt_iterations = anckpt[1] if anckpt[0] == 'iterations' else None
             ckpt_seconds = anckpt[1] if anckpt[0] == 'seconds' else None
         return ast.AnalyzeModels(generator, models, iterations, seconds,
-            ckpt_iterations, ckpt_seconds, program)
+            ckpt_iterations, ckpt_seconds, program, background)
     def p_command_drop_models(self, models, generator):
         return ast.DropModels(generator, models)
 
@@ -297,6 +297,9 @@ class BQLSemantics(object):
     def p_anckpt_opt_none(self):                return None
     def p_anckpt_opt_some(self, duration):      return duration
 
+    def p_anbackground_opt_none(self):          return False
+    def p_anbackground_opt_some(self):          return True
+
     def p_anduration_iterations(self, n):       return ('iterations', n)
     def p_anduration_minutes(self, n):          return ('seconds', 60*n)
     def p_anduration_seconds(self, n):          return ('seconds', n)
@@ -15,37 +15,51 @@
 #   limitations under the License.
 
 import csv
+import itertools
 
 import bayeslite.core as core
 
 from bayeslite.sqlite3_util import sqlite3_quote_name
 from bayeslite.util import casefold
 
+#: Default number of rows to insert with each executemany.
+DEFAULT_BATCH_SIZE = 10000
+
 def bayesdb_read_csv_file(bdb, table, pathname, header=False, create=False,
-        ifnotexists=False):
+        ifnotexists=False, batch_size=DEFAULT_BATCH_SIZE):
     """Read CSV data from a file into a table.
 
+    Returns the number of rows read.
+
     :param bayeslite.BayesDB bdb: BayesDB instance
     :param str table: name of table
     :param str pathname: pathname of CSV file
     :param bool header: if true, first line specifies column names
     :param bool create: if true and `table` does not exist, create it
     :param bool ifnotexists: if true and `table` exists, do it anyway
+    :param int batch_size: number of rows to parse and insert at once
     """
     with open(pathname, 'rU') as f:
-        bayesdb_read_csv(bdb, table, f, header=header, create=create,
-            ifnotexists=ifnotexists)
+        return bayesdb_read_csv(bdb, table, f, header=header, create=create,
+            ifnotexists=ifnotexists, batch_size=batch_size)
 
 def bayesdb_read_csv(bdb, table, f, header=False,
-        create=False, ifnotexists=False):
+        create=False, ifnotexists=False, batch_size=DEFAULT_BATCH_SIZE):
     """Read CSV data from a line iterator into a table.
 
+    Returns the number of rows read.
+
+    The rows are parsed and inserted `batch_size` at a time, all in
+    one savepoint.  Any indexes on the table are dropped during the
+    load and created again afterward.
+
     :param bayeslite.BayesDB bdb: BayesDB instance
     :param str table: name of table
     :param iterable f: iterator returning lines as :class:`str`
     :param bool header: if true, first line specifies column names
     :param bool create: if true and `table` does not exist, create it
     :param bool ifnotexists: if true and `table` exists, do it anyway
+    :param int batch_size: number of rows to parse and insert at once
     """
     if not header:
         if create:
@@ -53,6 +67,8 @@ def bayesdb_read_csv(bdb, table, f, header=False,
     if not create:
         if ifnotexists:
             raise ValueError('Not creating table whether or not exists!')
+    if batch_size < 1:
+        raise ValueError('Invalid batch size: %r' % (batch_size,))
     with bdb.savepoint():
         if core.bayesdb_has_table(bdb, table):
             if create and not ifnotexists:
@@ -111,11 +127,42 @@ def bayesdb_read_csv(bdb, table, f, header=False,
         # execute a cursor, which also binds and steps the statement.
         sql = 'INSERT INTO %s (%s) VALUES (%s)' % \
             (qt, ','.join(qcns), ','.join('?' for _qcn in qcns))
-        for row in reader:
-            if len(row) < ncols:
-                raise IOError('Line %d: Too few columns: %d < %d' %
-                    (line, len(row), ncols))
-            if len(row) > ncols:
-                raise IOError('Line %d: Too many columns: %d > %d' %
-                    (line, len(row), ncols))
-            bdb.sql_execute(sql, [unicode(v, 'utf8').strip() for v in row])
+        # Maintaining indexes row by row is slower than building them
+        # once all the rows are in.
+        indexes = _drop_indexes(bdb, table)
+        nrows = 0
+        while True:
+            rows = list(itertools.islice(reader, batch_size))
+            if len(rows) == 0:
+                break
+            for i, row in enumerate(rows):
+                if len(row) < ncols:
+                    raise IOError('Line %d: Too few columns: %d < %d' %
+                        (line + i, len(row), ncols))
+                if len(row) > ncols:
+                    raise IOError('Line %d: Too many columns: %d > %d' %
+                        (line + i, len(row), ncols))
+            bdb.sql_executemany(sql, [
+                [v.decode('utf8').strip() for v in row] for row in rows
+            ])
+            line += len(rows)
+            nrows += len(rows)
+        for index_sql in indexes:
+            bdb.sql_execute(index_sql)
+    return nrows
+
+def _drop_indexes(bdb, table):
+    """Drop the explicitly created indexes on `table`.
+
+    Returns a list of the SQL statements to create them again.
+    Indexes that SQLite maintains for UNIQUE and PRIMARY KEY
+    constraints cannot be dropped, and are left alone.
+    """
+    cursor = bdb.sql_execute('''
+        SELECT name, sql FROM sqlite_master
+            WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL
+    ''', (table,))
+    indexes = cursor.fetchall()
+    for name, _sql in indexes:
+        bdb.sql_execute('DROP INDEX %s' % (sqlite3_quote_name(name),))
+    return [sql for _name, sql in indexes]
@@ -16,45 +16,64 @@
 
 """Reading data from pandas dataframes."""
 
+import itertools
+import numpy
+
 import bayeslite.core as core
 
 from bayeslite.sqlite3_util import sqlite3_quote_name
 
 def bayesdb_read_pandas_df(bdb, table, df, create=False, ifnotexists=False,
-        index=None):
+        index=None, chunksize=None):
     """Read data from a pandas dataframe into a table.
 
     :param bayeslite.BayesDB bdb: BayesDB instance
     :param str table: name of table
-    :param pandas.DataFrame df: pandas dataframe
+    :param df: pandas dataframe, or iterable of pandas dataframes
+        with the same columns, such as the one returned by
+        ``pandas.read_csv(..., chunksize=...)``
     :param bool create: if true and `table` does not exist, create it
     :param bool ifnotexists: if true, and `create` is true` and `table`
         exists, read data into it anyway
     :param str index: name of column for index
+    :param int chunksize: if not `None`, number of rows of a dataframe
+        to convert and insert at once
 
     If `index` is `None`, then the dataframe's index dtype must be
     convertible to int64, and it is mapped to the table's rowids.  If
     the dataframe's index dtype is not convertible to int64, you must
     specify `index` to give a primary key for the table.
+
+    NaN and other values pandas considers null are stored as SQL
+    ``NULL``.
     """
     if not create:
         if ifnotexists:
             raise ValueError('Not creating table whether or not exists!')
-    column_names = [str(column) for column in df.columns]
+    if chunksize is not None and chunksize < 1:
+        raise ValueError('Invalid chunk size: %r' % (chunksize,))
+    if hasattr(df, 'columns'):
+        dfs = iter([df])
+    else:
+        dfs = iter(df)
+    try:
+        first = dfs.next()
+    except StopIteration:
+        raise ValueError('No dataframes to read!')
+    dfs = itertools.chain([first], dfs)
+    column_names = [str(column) for column in first.columns]
     if index is None:
         create_column_names = column_names
         insert_column_names = ['_rowid_'] + column_names
-        try:
-            key_index = df.index.astype('int64')
-        except ValueError:
-            raise ValueError('Must specify index name for non-integral index!')
+        # Check before touching the database; every chunk's index is
+        # converted again as it is inserted.
+        _integral_index(first)
     else:
-        if index in df.columns:
+        if index in first.columns:
             raise ValueError('Index name collides with column name: %r'
                 % (index,))
         create_column_names = [index] + column_names
         insert_column_names = create_column_names
-        key_index = df.index
     with bdb.savepoint():
         if core.bayesdb_has_table(bdb, table):
             if create and not ifnotexists:
@@ -82,5 +101,40 @@ def bayesdb_read_pandas_df(bdb, table, df, create=False, ifnotexists=False,
         qicns = map(sqlite3_quote_name, insert_column_names)
         sql = 'INSERT INTO %s (%s) VALUES (%s)' % \
             (qt, ','.join(qicns), ','.join('?' for _qicn in qicns))
-        for key, i in zip(key_index, df.index):
-            bdb.sql_execute(sql, (key,) + tuple(df.ix[i]))
+        for chunk in _chunks(dfs, chunksize):
+            if [str(column) for column in chunk.columns] != column_names:
+                raise ValueError('Dataframe columns differ: %r' %
+                    (list(chunk.columns),))
+            if index is None:
+                keys = _integral_index(chunk)
+            else:
+                keys = chunk.index.values
+            bdb.sql_executemany(sql, _records(keys, chunk))
+
+def _chunks(dfs, chunksize):
+    """Yield successive frames of at most `chunksize` rows from `dfs`."""
+    for df in dfs:
+        if chunksize is None or len(df.index) <= chunksize:
+            yield df
+        else:
+            for start in xrange(0, len(df.index), chunksize):
+                yield df.iloc[start:start + chunksize]
+
+def _integral_index(df):
+    try:
+        return df.index.values.astype('int64')
+    except ValueError:
+        raise ValueError('Must specify index name for non-integral index!')
+
+def _records(keys, df):
+    """Return a list of rows of `keys` followed by the columns of `df`.
+
+    Null values in `df` are mapped to `None` over the whole frame at
+    once, and numeric NumPy values are converted to Python values so
+    that they can be bound to SQL parameters.
+    """
+    values = numpy.empty((len(df.index), len(df.columns) + 1), dtype=object)
+    values[:, 0] = keys
+    values[:, 1:] = df.values
+    values[:, 1:][df.isnull().values] = None
+    return values.tolist()
@@ -38,6 +38,7 @@ keywords = {
     "and": grammar.K_AND,
     "as": grammar.K_AS,
     "asc": grammar.K_ASC,
+    "background": grammar.K_BACKGROUND,
     "begin": grammar.K_BEGIN,
     "between": grammar.K_BETWEEN,
     "btable": grammar.K_BTABLE,
@@ -16,6 +16,7 @@
 
 import contextlib
 
+from bayeslite.core import bayesdb_catalog_invalidate
 from bayeslite.exception import BayesDBException
 from bayeslite.sqlite3_util import sqlite3_savepoint
 from bayeslite.sqlite3_util import sqlite3_savepoint_rollback
@@ -25,8 +26,10 @@ from bayeslite.sqlite3_util import sqlite3_transaction
 # lightweight per-thread state.
 
 @contextlib.contextmanager
-def bayesdb_caching(bdb):
-    bayesdb_txn_push(bdb)
+def bayesdb_caching(bdb, cache=None):
+    # Outside a transaction, use `cache' if given, so that it may
+    # outlast this extent, e.g. for every fetch from one cursor.
+    bayesdb_txn_push(bdb, cache)
     try:
         yield
     finally:
@@ -35,10 +38,14 @@ def bayesdb_caching(bdb):
 @contextlib.contextmanager
 def bayesdb_savepoint(bdb):
     bayesdb_txn_push(bdb)
+    ok = False
     try:
         with sqlite3_savepoint(bdb._sqlite3):
             yield
+        ok = True
     finally:
+        if not ok:
+            bayesdb_txn_invalidate(bdb)
         bayesdb_txn_pop(bdb)
 
 @contextlib.contextmanager
@@ -48,6 +55,7 @@ def bayesdb_savepoint_rollback(bdb):
         with sqlite3_savepoint_rollback(bdb._sqlite3):
             yield
     finally:
+        bayesdb_txn_invalidate(bdb)
         bayesdb_txn_pop(bdb)
 
 @contextlib.contextmanager
@@ -56,10 +64,14 @@ def bayesdb_transaction(bdb):
         raise BayesDBTxnError(bdb, 'Already in a transaction!')
     bayesdb_txn_init(bdb)
     bdb._txn_depth = 1
+    ok = False
     try:
         with sqlite3_transaction(bdb._sqlite3):
             yield
+        ok = True
     finally:
+        if not ok:
+            bayesdb_catalog_invalidate(bdb)
         assert bdb._txn_depth == 1
         bdb._txn_depth = 0
         bayesdb_txn_fini(bdb)
@@ -75,6 +87,7 @@ def bayesdb_rollback_transaction(bdb):
     if bdb._txn_depth == 0:
         raise BayesDBTxnError(bdb, 'Not in a transaction!')
     bdb.sql_execute("ROLLBACK")
+    bayesdb_catalog_invalidate(bdb)
     bdb._txn_depth = 0
     bayesdb_txn_fini(bdb)
 
@@ -91,9 +104,9 @@ def bayesdb_commit_transaction(bdb):
 # (For the bdb.savepoint() context manager that is not an issue.)
 # We'll implement that later.
 
-def bayesdb_txn_push(bdb):
+def bayesdb_txn_push(bdb, cache=None):
     if bdb._txn_depth == 0:
-        bayesdb_txn_init(bdb)
+        bayesdb_txn_init(bdb, cache)
     else:
         assert bdb._cache is not None
     bdb._txn_depth += 1
@@ -105,10 +118,16 @@ def bayesdb_txn_pop(bdb):
     else:
         assert bdb._cache is not None
 
-def bayesdb_txn_init(bdb):
+def bayesdb_txn_invalidate(bdb):
+    # Rolled back: the catalog, and anything else cached for the
+    # transaction, may have reverted.
+    bayesdb_catalog_invalidate(bdb)
+    bdb._cache.clear()
+
+def bayesdb_txn_init(bdb, cache=None):
     assert bdb._txn_depth == 0
     assert bdb._cache is None
-    bdb._cache = {}
+    bdb._cache = {} if cache is None else cache
 
 def bayesdb_txn_fini(bdb):
     assert bdb._txn_depth == 0
@@ -37,7 +37,7 @@ import test_csv
 
 from stochastic import stochastic
 
-def bql2sql(string, setup=None):
+def bql2sql(string, setup=None, winders=False):
     with bayeslite.bayesdb_open(':memory:') as bdb:
         test_core.t1_schema(bdb)
         test_core.t1_data(bdb)
@@ -57,8 +57,29 @@ def bql2sql(string, setup=None):
             assert ast.is_query(phrase)
             compiler.compile_query(bdb, phrase, out)
             out.write(';')
+        if winders:
+            return out.getvalue(), out.getwindings()[0]
         return out.getvalue()
 
+def bql2sqlpredprob(string, setup=None):
+    # Row-wise PREDICTIVE PROBABILITY over a whole table is filled
+    # into a temporary table by the last winder before the query runs.
+    sql, winders = bql2sql(string, setup=setup, winders=True)
+    fill_sql, (temptable, targets, constraints) = winders[-1]
+    assert temptable == 'bayesdb_temp_0'
+    return sql, ' '.join(fill_sql.split()), targets, constraints
+
+def predict_lookup(column, temptable='bayesdb_temp_0'):
+    # Batched PREDICT over a whole table is filled into a temporary
+    # table by the winders and looked up by rowid.
+    return '(SELECT %s FROM "%s" WHERE rowid = "t1"._rowid_)' % \
+        (column, temptable)
+
+def predict_batch(threshold, temptable='bayesdb_temp_0'):
+    return 'CASE WHEN %s < (%s) THEN NULL ELSE %s END' % \
+        (predict_lookup('confidence', temptable), threshold,
+            predict_lookup('value', temptable))
+
 # XXX Kludgey mess.  Please reorganize.
 def bql2sqlparam(string):
     with bayeslite.bayesdb_open(':memory:') as bdb:
@@ -439,58 +460,65 @@ def test_select_trivial():
 
 def test_estimate_bql():
     # PREDICTIVE PROBABILITY
-    assert bql2sql('estimate predictive probability of weight from p1;') == \
+    predprob = '(SELECT value FROM "bayesdb_temp_0"' \
+        ' WHERE rowid = "t1"._rowid_)'
+    assert bql2sqlpredprob('estimate predictive probability of weight'
+            ' from p1;') == \
+        ('SELECT ' + predprob + ' FROM "t1";',
+            'SELECT bql_row_column_predictive_probability_batch(1, NULL, NULL,'
+                ' ?, ?, ?)',
+            '[3]', '[]')
+    assert bql2sqlpredprob('estimate predictive probability of (age, weight) '
+            'from p1;')[2:] == \
+        ('[2, 3]', '[]')
+    assert bql2sqlpredprob('estimate predictive probability of (age, weight)'
+            ' given (label) from p1;')[2:] == \
+        ('[2, 3]', '[1]')
+    assert bql2sqlpredprob('estimate predictive probability of (*)'
+            ' from p1;')[2:] == \
+        ('[1, 2, 3]', '[]')
+    assert bql2sqlpredprob('estimate predictive probability of (*)'
+            ' given (age, weight) from p1;')[2:] == \
+        ('[1]', '[2, 3]')
+    assert bql2sqlpredprob('estimate predictive probability of age given (*) '
+            'from p1;')[2:] == \
+        ('[2]', '[1, 3]')
+    assert bql2sqlpredprob('estimate label, predictive probability of weight'
+            ' from p1;')[::2] == \
+        ('SELECT "label", ' + predprob + ' FROM "t1";', '[3]')
+    assert bql2sqlpredprob('estimate predictive probability of weight, label'
+            ' from p1;')[::2] == \
+        ('SELECT ' + predprob + ', "label" FROM "t1";', '[3]')
+    assert bql2sqlpredprob('estimate predictive probability of weight + 1'
+            ' from p1;')[::2] == \
+        ('SELECT (' + predprob + ' + 1) FROM "t1";', '[3]')
+    assert bql2sqlpredprob('estimate predictive probability of weight'
+            ' given (*) + 1 from p1;')[::3] == \
+        ('SELECT (' + predprob + ' + 1) FROM "t1";', '[1, 2]')
+    # Rows are filled in only if they satisfy the condition.
+    sql, winders = bql2sql('estimate predictive probability of weight'
+        ' from p1 where age > 30;', winders=True)
+    assert sql == 'SELECT ' + predprob + ' FROM "t1" WHERE ("age" > 30);'
+    assert winders[1] == \
+        ('INSERT INTO "bayesdb_temp_0" (rowid) SELECT _rowid_ FROM "t1"'
+            ' WHERE ("age" > 30)', [])
+    # With a limit, or a condition that is not plain SQL, each row is
+    # computed separately.
+    assert bql2sql('estimate predictive probability of weight from p1'
+            ' limit 2;') == \
         'SELECT bql_row_column_predictive_probability(1, NULL, NULL, _rowid_, '\
                 '\'[3]\', \'[]\')' \
-            ' FROM "t1";'
-    assert bql2sql('estimate predictive probability of (age, weight) '
-            'from p1;') == \
-        'SELECT bql_row_column_predictive_probability(1, NULL, NULL, _rowid_, '\
-                '\'[2, 3]\', \'[]\')' \
-            ' FROM "t1";'
-    assert bql2sql('estimate predictive probability of (age, weight) given '
-            '(label) from p1;') == \
-        'SELECT bql_row_column_predictive_probability(1, NULL, NULL, _rowid_, '\
-                '\'[2, 3]\', \'[1]\')' \
-            ' FROM "t1";'
-    assert bql2sql('estimate predictive probability of (*) from p1;') == \
+            ' FROM "t1" LIMIT 2;'
+    assert bql2sql('estimate predictive probability of weight from p1'
+            ' where random() > 0;') == \
         'SELECT bql_row_column_predictive_probability(1, NULL, NULL, _rowid_, '\
-                '\'[1, 2, 3]\', \'[]\')' \
-            ' FROM "t1";'
-    assert bql2sql('estimate predictive probability of (*) given (age, weight) '
-            'from p1;') == \
-        'SELECT bql_row_column_predictive_probability(1, NULL, NULL, _rowid_, '\
-                '\'[1]\', \'[2, 3]\')' \
-            ' FROM "t1";'
-    assert bql2sql('estimate predictive probability of age given (*) '
-            'from p1;') == \
-        'SELECT bql_row_column_predictive_probability(1, NULL, NULL, _rowid_, '\
-                '\'[2]\', \'[1, 3]\')' \
-            ' FROM "t1";'
-    assert bql2sql('estimate label, predictive probability of weight'
-            ' from p1;') \
-        == \
-        'SELECT "label", ' \
-            'bql_row_column_predictive_probability(1, NULL, NULL, _rowid_, '\
                 '\'[3]\', \'[]\')' \
-            ' FROM "t1";'
-    assert bql2sql('estimate predictive probability of weight, label'
-            ' from p1;') \
-        == \
-        'SELECT bql_row_column_predictive_probability(1, NULL, NULL, _rowid_, '\
-                '\'[3]\', \'[]\'),' \
-            ' "label"' \
-            ' FROM "t1";'
-    assert bql2sql('estimate predictive probability of weight + 1'
-            ' from p1;') == \
-        'SELECT (bql_row_column_predictive_probability(1, NULL, NULL, '\
-                '_rowid_, \'[3]\', \'[]\') + 1)' \
-            ' FROM "t1";'
-    assert bql2sql('estimate predictive probability of weight given (*) + 1'
-            ' from p1;') == \
-        'SELECT (bql_row_column_predictive_probability(1, NULL, NULL, '\
-                '_rowid_, \'[3]\', \'[1, 2]\') + 1)' \
-            ' FROM "t1";'
+            ' FROM "t1" WHERE ("random"() > 0);'
+    # So is a subquery, which an outer query may cut short.
+    assert bql2sql('select * from (estimate predictive probability of weight'
+            ' from p1) limit 2;') == \
+        'SELECT * FROM (SELECT bql_row_column_predictive_probability(1, NULL,'\
+                ' NULL, _rowid_, \'[3]\', \'[]\') FROM "t1") LIMIT 2;'
     # PREDICTIVE PROBABILITY parse and compilation errors.
     with pytest.raises(parse.BQLParseError):
         # Need a table.
@@ -630,13 +658,33 @@ def test_predict_outside_infer():
 def test_infer_explicit_predict_confidence():
     assert bql2sql('infer explicit predict age with confidence 0.9'
             ' from p1;') == \
-        'SELECT bql_predict(1, NULL, NULL, _rowid_, 2, 0.9, NULL) FROM "t1";'
+        'SELECT ' + predict_batch('0.9') + ' FROM "t1";'
+    # With a limit, or a condition that is not plain SQL, each row is
+    # predicted separately.
+    assert bql2sql('infer explicit predict age with confidence 0.9'
+            ' from p1 limit 2;') == \
+        'SELECT bql_predict(1, NULL, NULL, _rowid_, 2, 0.9, NULL)' \
+            ' FROM "t1" LIMIT 2;'
+    assert bql2sql('infer explicit predict age with confidence 0.9'
+            ' from p1 where random() > 0;') == \
+        'SELECT bql_predict(1, NULL, NULL, _rowid_, 2, 0.9, NULL)' \
+            ' FROM "t1" WHERE ("random"() > 0);'
 
 def test_infer_explicit_predict_confidence_nsamples():
-    assert bql2sql('infer explicit'
+    sql, winders = bql2sql('infer explicit'
             ' predict age with confidence 0.9 using 42 samples'
-            ' from p1;') == \
-        'SELECT bql_predict(1, NULL, NULL, _rowid_, 2, 0.9, 42) FROM "t1";'
+            ' from p1 where label = \'foo\';', winders=True)
+    assert sql == \
+        'SELECT ' + predict_batch('0.9') + ' FROM "t1"' \
+            ' WHERE ("label" = \'foo\');'
+    # Rows are filled in only if they satisfy the condition, with one
+    # batched call for them all.
+    assert winders[1] == \
+        ('INSERT INTO "bayesdb_temp_0" (rowid) SELECT _rowid_ FROM "t1"'
+            ' WHERE ("label" = \'foo\')', [])
+    assert (' '.join(winders[2][0].split()), winders[2][1]) == \
+        ('SELECT bql_predict_confidence_batch(1, NULL, NULL, ?, 2, 42)',
+            ('bayesdb_temp_0',))
 
 def test_infer_explicit_verbatim_and_predict_confidence():
     assert bql2sql('infer explicit rowid, age,'
@@ -645,8 +693,7 @@ def test_infer_explicit_verbatim_and_predict_confidence():
             ' bql_json_get(c2, \'value\') AS "age",' \
             ' bql_json_get(c2, \'confidence\') AS "age_conf"' \
             ' FROM (SELECT "rowid" AS c0, "age" AS c1,' \
-                ' bql_predict_confidence(1, NULL, NULL, _rowid_, 2, NULL)' \
-                ' AS c2 FROM "t1");'
+                ' ' + predict_lookup('prediction') + ' AS c2 FROM "t1");'
 
 def test_infer_explicit_verbatim_and_predict_noconfidence():
     assert bql2sql('infer explicit rowid, age,'
@@ -654,8 +701,7 @@ def test_infer_explicit_verbatim_and_predict_noconfidence():
         'SELECT c0 AS "rowid", c1 AS "age",' \
             ' bql_json_get(c2, \'value\') AS "age"' \
             ' FROM (SELECT "rowid" AS c0, "age" AS c1,' \
-                ' bql_predict_confidence(1, NULL, NULL, _rowid_, 2, NULL)' \
-                ' AS c2 FROM "t1");'
+                ' ' + predict_lookup('prediction') + ' AS c2 FROM "t1");'
 
 def test_infer_explicit_verbatim_and_predict_confidence_nsamples():
     assert bql2sql('infer explicit rowid, age,'
@@ -664,8 +710,7 @@ def test_infer_explicit_verbatim_and_predict_confidence_nsamples():
             ' bql_json_get(c2, \'value\') AS "age",' \
             ' bql_json_get(c2, \'confidence\') AS "age_conf"' \
             ' FROM (SELECT "rowid" AS c0, "age" AS c1,' \
-                ' bql_predict_confidence(1, NULL, NULL, _rowid_, 2, 42)' \
-                ' AS c2 FROM "t1");'
+                ' ' + predict_lookup('prediction') + ' AS c2 FROM "t1");'
 
 def test_infer_explicit_verbatim_and_predict_noconfidence_nsamples():
     assert bql2sql('infer explicit rowid, age,'
@@ -673,8 +718,7 @@ def test_infer_explicit_verbatim_and_predict_noconfidence_nsamples():
         'SELECT c0 AS "rowid", c1 AS "age",' \
             ' bql_json_get(c2, \'value\') AS "age"' \
             ' FROM (SELECT "rowid" AS c0, "age" AS c1,' \
-                ' bql_predict_confidence(1, NULL, NULL, _rowid_, 2, 42)' \
-                ' AS c2 FROM "t1");'
+                ' ' + predict_lookup('prediction') + ' AS c2 FROM "t1");'
 
 def test_infer_explicit_verbatim_and_predict_confidence_as():
     assert bql2sql('infer explicit rowid, age,'
@@ -683,8 +727,7 @@ def test_infer_explicit_verbatim_and_predict_confidence_as():
             ' bql_json_get(c2, \'value\') AS "age_inf",' \
             ' bql_json_get(c2, \'confidence\') AS "age_conf"' \
             ' FROM (SELECT "rowid" AS c0, "age" AS c1,' \
-                ' bql_predict_confidence(1, NULL, NULL, _rowid_, 2, NULL)' \
-                ' AS c2 FROM "t1");'
+                ' ' + predict_lookup('prediction') + ' AS c2 FROM "t1");'
 
 def test_infer_explicit_verbatim_and_predict_noconfidence_as():
     assert bql2sql('infer explicit rowid, age,'
@@ -692,8 +735,7 @@ def test_infer_explicit_verbatim_and_predict_noconfidence_as():
         'SELECT c0 AS "rowid", c1 AS "age",' \
             ' bql_json_get(c2, \'value\') AS "age_inf"' \
             ' FROM (SELECT "rowid" AS c0, "age" AS c1,' \
-                ' bql_predict_confidence(1, NULL, NULL, _rowid_, 2, NULL)' \
-                ' AS c2 FROM "t1");'
+                ' ' + predict_lookup('prediction') + ' AS c2 FROM "t1");'
 
 def test_infer_explicit_verbatim_and_predict_confidence_as_nsamples():
     assert bql2sql('infer explicit rowid, age,'
@@ -703,8 +745,7 @@ def test_infer_explicit_verbatim_and_predict_confidence_as_nsamples():
             ' bql_json_get(c2, \'value\') AS "age_inf",' \
             ' bql_json_get(c2, \'confidence\') AS "age_conf"' \
             ' FROM (SELECT "rowid" AS c0, "age" AS c1,' \
-                ' bql_predict_confidence(1, NULL, NULL, _rowid_, 2, 87)' \
-                ' AS c2 FROM "t1");'
+                ' ' + predict_lookup('prediction') + ' AS c2 FROM "t1");'
 
 def test_infer_explicit_verbatim_and_predict_noconfidence_as_nsamples():
     assert bql2sql('infer explicit rowid, age,'
@@ -713,16 +754,15 @@ def test_infer_explicit_verbatim_and_predict_noconfidence_as_nsamples():
         'SELECT c0 AS "rowid", c1 AS "age",' \
             ' bql_json_get(c2, \'value\') AS "age_inf"' \
             ' FROM (SELECT "rowid" AS c0, "age" AS c1,' \
-                ' bql_predict_confidence(1, NULL, NULL, _rowid_, 2, 87)' \
-                ' AS c2 FROM "t1");'
+                ' ' + predict_lookup('prediction') + ' AS c2 FROM "t1");'
 
 def test_infer_auto():
     assert bql2sql('infer rowid, age, weight from p1') \
         == \
         'SELECT "rowid" AS "rowid",' \
-        ' "IFNULL"("age", bql_predict(1, NULL, NULL, _rowid_, 2, 0, NULL))' \
+        ' "IFNULL"("age", ' + predict_batch('0') + ')' \
             ' AS "age",' \
-        ' "IFNULL"("weight", bql_predict(1, NULL, NULL, _rowid_, 3, 0, NULL))' \
+        ' "IFNULL"("weight", ' + predict_batch('0', 'bayesdb_temp_1') + ')' \
             ' AS "weight"' \
         ' FROM "t1";'
 
@@ -741,10 +781,10 @@ def test_infer_auto_with_confidence():
     assert bql2sql('infer rowid, age, weight with confidence 0.9 from p1') \
         == \
         'SELECT "rowid" AS "rowid",' \
-        ' "IFNULL"("age", bql_predict(1, NULL, NULL, _rowid_, 2, 0.9, NULL))' \
+        ' "IFNULL"("age", ' + predict_batch('0.9') + ')' \
             ' AS "age",' \
         ' "IFNULL"("weight",'\
-                ' bql_predict(1, NULL, NULL, _rowid_, 3, 0.9, NULL))' \
+                ' ' + predict_batch('0.9', 'bayesdb_temp_1') + ')' \
             ' AS "weight"' \
         ' FROM "t1";'
 
@@ -762,15 +802,27 @@ def test_infer_auto_with_confidence_nsamples():
             ' AS "weight"' \
         ' FROM "t1";'
 
+def test_infer_auto_missing():
+    # INFER predicts a value only where it is missing.
+    _sql, winders = bql2sql('infer rowid, age from p1 where label = \'foo\'',
+        winders=True)
+    assert winders[1] == \
+        ('INSERT INTO "bayesdb_temp_0" (rowid) SELECT _rowid_ FROM "t1"'
+            ' WHERE "age" IS NULL AND ("label" = \'foo\')', [])
+    # Unless ORDER BY predicts it too.
+    _sql, winders = bql2sql('infer rowid, age from p1'
+        ' order by predict age with confidence 0.5', winders=True)
+    assert winders[1] == \
+        ('INSERT INTO "bayesdb_temp_0" (rowid) SELECT _rowid_ FROM "t1"', [])
+
 def test_infer_auto_with_confidence_where():
     assert bql2sql('infer rowid, age, weight with confidence 0.9 from p1'
             ' where label = \'foo\'') \
         == \
         'SELECT "rowid" AS "rowid",' \
-        ' "IFNULL"("age", bql_predict(1, NULL, NULL, _rowid_, 2, 0.9, NULL))' \
+        ' "IFNULL"("age", ' + predict_batch('0.9') + ')' \
             ' AS "age",' \
-        ' "IFNULL"("weight", bql_predict(1, NULL, NULL, _rowid_, 3, 0.9,'\
-                ' NULL))' \
+        ' "IFNULL"("weight", ' + predict_batch('0.9', 'bayesdb_temp_1') + ')' \
             ' AS "weight"' \
         ' FROM "t1"' \
         ' WHERE ("label" = \'foo\');'
@@ -782,9 +834,9 @@ def test_infer_auto_with_confidence_nsamples_where():
             ' where label = \'foo\'') \
         == \
         'SELECT "rowid" AS "rowid",' \
-        ' "IFNULL"("age", bql_predict(1, NULL, NULL, _rowid_, 2, 0.9, 42))' \
+        ' "IFNULL"("age", ' + predict_batch('0.9') + ')' \
             ' AS "age",' \
-        ' "IFNULL"("weight", bql_predict(1, NULL, NULL, _rowid_, 3, 0.9, 42))' \
+        ' "IFNULL"("weight", ' + predict_batch('0.9', 'bayesdb_temp_1') + ')' \
             ' AS "weight"' \
         ' FROM "t1"' \
         ' WHERE ("label" = \'foo\');'
@@ -826,22 +878,22 @@ def test_infer_auto_with_confidence_nsamples_where_predict_nsamples():
 def test_infer_auto_star():
     assert bql2sql('infer rowid, * from p1') == \
         'SELECT "rowid" AS "rowid", "id" AS "id",' \
-        ' "IFNULL"("label", bql_predict(1, NULL, NULL, _rowid_, 1, 0, NULL))' \
+        ' "IFNULL"("label", ' + predict_batch('0') + ')' \
             ' AS "label",' \
-        ' "IFNULL"("age", bql_predict(1, NULL, NULL, _rowid_, 2, 0, NULL))' \
+        ' "IFNULL"("age", ' + predict_batch('0', 'bayesdb_temp_1') + ')' \
             ' AS "age",' \
-        ' "IFNULL"("weight", bql_predict(1, NULL, NULL, _rowid_, 3, 0, NULL))' \
+        ' "IFNULL"("weight", ' + predict_batch('0', 'bayesdb_temp_2') + ')' \
             ' AS "weight"' \
         ' FROM "t1";'
 
 def test_infer_auto_star_nsamples():
     assert bql2sql('infer rowid, * using 1 samples from p1') == \
         'SELECT "rowid" AS "rowid", "id" AS "id",' \
-        ' "IFNULL"("label", bql_predict(1, NULL, NULL, _rowid_, 1, 0, 1))' \
+        ' "IFNULL"("label", ' + predict_batch('0') + ')' \
             ' AS "label",' \
-        ' "IFNULL"("age", bql_predict(1, NULL, NULL, _rowid_, 2, 0, 1))' \
+        ' "IFNULL"("age", ' + predict_batch('0', 'bayesdb_temp_1') + ')' \
             ' AS "age",' \
-        ' "IFNULL"("weight", bql_predict(1, NULL, NULL, _rowid_, 3, 0, 1))' \
+        ' "IFNULL"("weight", ' + predict_batch('0', 'bayesdb_temp_2') + ')' \
             ' AS "weight"' \
         ' FROM "t1";'
 
@@ -996,12 +1048,17 @@ def test_estimate_pairwise_trivial():
     infix0 += ' AND v0.generator_id IS NULL'
     infix0 += ' AND v1.generator_id IS NULL'
     infix += infix0
-    assert bql2sql('estimate dependence probability'
-            ' from pairwise columns of p1;') == \
+    sql, winders = bql2sql('estimate dependence probability'
+            ' from pairwise columns of p1;', winders=True)
+    assert sql == \
         prefix + \
-        'bql_column_dependence_probability(1, NULL, NULL, v0.colno,'\
-            ' v1.colno)' + \
+        '(SELECT value FROM "bayesdb_temp_0"'\
+            ' WHERE colno0 = v0.colno AND colno1 = v1.colno)' + \
         infix + ';'
+    # Every pair is filled in at once before the query runs.
+    assert ' '.join(winders[-1][0].split()) == \
+        'SELECT bql_column_dependence_probability_batch(1, NULL, NULL, ?, ?)'
+    assert winders[-1][1] == ('bayesdb_temp_0', '[1, 2, 3]')
     assert bql2sql('estimate mutual information'
             ' from pairwise columns of p1 where'
             ' (probability density of age = 0) > 0.5;') == \
@@ -1046,8 +1103,8 @@ def test_estimate_pairwise_trivial():
             ' where dependence probability > 0.5;') == \
         prefix + 'bql_column_correlation(1, NULL, NULL, v0.colno, v1.colno)' + \
         infix + ' AND' \
-        ' (bql_column_dependence_probability(1, NULL, NULL, v0.colno,' \
-                ' v1.colno)' \
+        ' ((SELECT value FROM "bayesdb_temp_0"' \
+                ' WHERE colno0 = v0.colno AND colno1 = v1.colno)' \
             ' > 0.5);'
     with pytest.raises(bayeslite.BQLError):
         # Must omit both columns.
@@ -1110,7 +1167,8 @@ def test_estimate_pairwise_trivial():
             ' from pairwise columns of p1'
             ' where depprob > 0.5 order by mutinf desc') == \
         prefix + \
-        'bql_column_dependence_probability(1, NULL, NULL, v0.colno, v1.colno)' \
+        '(SELECT value FROM "bayesdb_temp_0"' \
+        ' WHERE colno0 = v0.colno AND colno1 = v1.colno)' \
         ' AS "depprob",' \
         ' bql_column_mutual_information(1, NULL, NULL,'\
         ' \'[\' || v0.colno || \']\', \'[\' || v1.colno || \']\', NULL)'\
@@ -1122,11 +1180,41 @@ def test_estimate_pairwise_trivial():
 def test_estimate_pairwise_row():
     prefix = 'SELECT r0._rowid_ AS rowid0, r1._rowid_ AS rowid1'
     infix = ' AS value FROM "t1" AS r0, "t1" AS r1'
+    sql, winders = bql2sql('estimate similarity in the context of age' +
+            ' from pairwise p1;', winders=True)
+    assert sql == \
+        prefix + ', (SELECT value FROM "bayesdb_temp_0"'\
+            ' WHERE rowid0 = r0._rowid_ AND rowid1 = r1._rowid_)' + \
+        infix + ';'
+    # Every pair of rows is filled in at once before the query runs,
+    # from the rows listed for each side.
+    assert ' '.join(winders[2][0].split()) == \
+        'INSERT INTO "bayesdb_temp_1" (side, rowid)' \
+        ' SELECT 0, r0._rowid_ FROM "t1" AS r0'
+    assert ' '.join(winders[3][0].split()) == \
+        'INSERT INTO "bayesdb_temp_1" (side, rowid)' \
+        ' SELECT 1, r1._rowid_ FROM "t1" AS r1'
+    assert ' '.join(winders[4][0].split()) == \
+        'SELECT bql_row_similarity_batch(1, NULL, NULL, ?, ?, ?)'
+    assert winders[4][1] == ('bayesdb_temp_0', 'bayesdb_temp_1', 2)
+    sql, winders = bql2sql('estimate similarity in the context of age' +
+            ' from pairwise p1 where r0.age < r1.age;', winders=True)
+    assert ' '.join(winders[2][0].split()) == \
+        'INSERT INTO "bayesdb_temp_1" (side, rowid)' \
+        ' SELECT 0, r0._rowid_ FROM "t1" AS r0' \
+        ' WHERE EXISTS (SELECT 1 FROM "t1" AS r1' \
+        ' WHERE ("r0"."age" < "r1"."age"))'
+    assert ' '.join(winders[3][0].split()) == \
+        'INSERT INTO "bayesdb_temp_1" (side, rowid)' \
+        ' SELECT 1, r1._rowid_ FROM "t1" AS r1' \
+        ' WHERE EXISTS (SELECT 1 FROM "t1" AS r0' \
+        ' WHERE ("r0"."age" < "r1"."age"))'
+    # With a limit, each pair is computed separately.
     assert bql2sql('estimate similarity in the context of age' +
-            ' from pairwise p1;') == \
+            ' from pairwise p1 limit 10;') == \
         prefix + ', bql_row_similarity(1, NULL, NULL,'\
             ' r0._rowid_, r1._rowid_, 2)' + \
-        infix + ';'
+        infix + ' LIMIT 10;'
     with pytest.raises(bayeslite.BQLError):
         # PREDICT is a 1-row function.
         bql2sql('estimate predict age with confidence 0.9 from pairwise t1;')
@@ -1135,8 +1223,8 @@ def test_estimate_pairwise_selected_columns():
     assert bql2sql('estimate dependence probability'
             ' from pairwise columns of p1 for label, age') == \
         'SELECT 1 AS population_id, v0.name AS name0, v1.name AS name1,' \
-        ' bql_column_dependence_probability(1, NULL, NULL,' \
-                ' v0.colno, v1.colno)' \
+        ' (SELECT value FROM "bayesdb_temp_0"' \
+                ' WHERE colno0 = v0.colno AND colno1 = v1.colno)' \
             ' AS value' \
         ' FROM bayesdb_population AS p,' \
         ' bayesdb_variable AS v0,' \
@@ -1150,8 +1238,8 @@ def test_estimate_pairwise_selected_columns():
             ' for (ESTIMATE * FROM COLUMNS OF p1'
                 ' ORDER BY name DESC LIMIT 2)') == \
         'SELECT 1 AS population_id, v0.name AS name0, v1.name AS name1,' \
-        ' bql_column_dependence_probability(1, NULL, NULL, v0.colno,' \
-                ' v1.colno)' \
+        ' (SELECT value FROM "bayesdb_temp_0"' \
+                ' WHERE colno0 = v0.colno AND colno1 = v1.colno)' \
             ' AS value' \
         ' FROM bayesdb_population AS p,' \
         ' bayesdb_variable AS v0,' \
@@ -1160,6 +1248,11 @@ def test_estimate_pairwise_selected_columns():
         ' AND v0.population_id = p.id AND v1.population_id = p.id' \
         ' AND v0.generator_id IS NULL AND v1.generator_id IS NULL' \
         ' AND v0.colno IN (3, 1) AND v1.colno IN (3, 1);'
+    # Only the selected pairs are filled in before the query runs.
+    _sql, winders = bql2sql('estimate dependence probability'
+            ' from pairwise columns of p1 for label, age, label',
+        winders=True)
+    assert winders[-1][1] == ('bayesdb_temp_0', '[1, 2]')
 
 def test_select_columns_subquery():
     assert bql2sql('select id, t1.(estimate * from columns of p1'
@@ -1271,11 +1364,14 @@ def test_probability_of_mutinf():
 def test_modeledby_usingmodels_trival():
     def setup(bdb):
         bdb.execute('create generator m1 for p1 using cgpm;')
-    assert bql2sql('estimate predictive probability of weight + 1'
+    assert bql2sqlpredprob('estimate predictive probability of weight + 1'
             ' from p1 modeled by m1 using models 1-3, 5;', setup=setup) == \
-        'SELECT (bql_row_column_predictive_probability(1, 1, \'[1, 2, 3, 5]\','\
-                ' _rowid_, \'[3]\', \'[]\') + 1)' \
-            ' FROM "t1";'
+        ('SELECT ((SELECT value FROM "bayesdb_temp_0"'
+                ' WHERE rowid = "t1"._rowid_) + 1)' \
+            ' FROM "t1";',
+            'SELECT bql_row_column_predictive_probability_batch(1, 1,'
+                ' \'[1, 2, 3, 5]\', ?, ?, ?)',
+            '[3]', '[]')
     assert bql2sql(
         'infer rowid, age, weight from p1 modeled by m1 using model 7',
             setup=setup) == \
@@ -1305,16 +1401,21 @@ def test_modeledby_usingmodels_trival():
             '(SELECT _rowid_ FROM "t1" WHERE ("label" = \'Uganda\')), '\
             '\'[1, 2, 3]\', 3, '\
             '2, 82, 3, 14, NULL, 2, 74, 1, \'Europe\', 3, 7, NULL);'
-    assert bql2sql('''
+    sql, winders = bql2sql('''
         estimate dependence probability
         from pairwise columns of p1
         for label, age
         modeled by m1
         using models 1, 4, 12
-    ''', setup=setup) == \
+    ''', setup=setup, winders=True)
+    assert ' '.join(winders[-1][0].split()) == \
+        'SELECT bql_column_dependence_probability_batch(1, 1,' \
+            ' \'[1, 4, 12]\', ?, ?)'
+    assert winders[-1][1] == ('bayesdb_temp_0', '[1, 2]')
+    assert sql == \
         'SELECT 1 AS population_id, v0.name AS name0, v1.name AS name1,' \
-        ' bql_column_dependence_probability(1, 1, \'[1, 4, 12]\',' \
-                ' v0.colno, v1.colno)' \
+        ' (SELECT value FROM "bayesdb_temp_0"' \
+                ' WHERE colno0 = v0.colno AND colno1 = v1.colno)' \
             ' AS value' \
         ' FROM bayesdb_population AS p,' \
         ' bayesdb_variable AS v0,' \
@@ -1592,25 +1693,13 @@ def test_parametrized():
         assert sqltraced_execute('estimate similarity to (rowid = 1)'
                 ' in the context of (estimate * from columns of p limit 1)'
                 ' from p;') == [
-            'SELECT COUNT(*) FROM bayesdb_population WHERE name = ?',
-            'SELECT id FROM bayesdb_population WHERE name = ?',
-            'SELECT tabname FROM bayesdb_population WHERE id = ?',
-            'SELECT COUNT(*) FROM bayesdb_population WHERE name = ?',
-            'SELECT id FROM bayesdb_population WHERE name = ?',
+            # Catalog lookups were cached by the previous execution.
             'SELECT v.name AS name FROM bayesdb_variable AS v'
                 ' WHERE v.population_id = 1'
                     ' AND v.generator_id IS NULL'
                 ' LIMIT 1',
-            'SELECT colno FROM bayesdb_variable'
-                ' WHERE population_id = ?'
-                    ' AND (generator_id IS NULL OR generator_id = ?)'
-                    ' AND name = ?',
-            'SELECT tabname FROM bayesdb_population'
-                ' WHERE id = ?',
             'SELECT bql_row_similarity(1, NULL, NULL, _rowid_,'
                 ' (SELECT _rowid_ FROM "t" WHERE ("rowid" = 1)), 0) FROM "t"',
-            'SELECT id FROM bayesdb_generator WHERE population_id = ?',
-            'SELECT backend FROM bayesdb_generator WHERE id = ?',
             'SELECT cgpm_rowid FROM bayesdb_cgpm_individual'
                 ' WHERE generator_id = ? AND table_rowid = ?',
             'SELECT cgpm_rowid FROM bayesdb_cgpm_individual '
@@ -1623,31 +1712,15 @@ def test_parametrized():
                 ' in the context of (estimate * from columns of p limit ?)'
                 ' from p;',
                 (1,)) == [
-            'SELECT COUNT(*) FROM bayesdb_population'
-                ' WHERE name = ?',
-            'SELECT id FROM bayesdb_population'
-                ' WHERE name = ?',
-            'SELECT tabname FROM bayesdb_population WHERE id = ?',
-            'SELECT COUNT(*) FROM bayesdb_population'
-                ' WHERE name = ?',
-            'SELECT id FROM bayesdb_population'
-                ' WHERE name = ?',
             # ESTIMATE * FROM COLUMNS OF:
             'SELECT v.name AS name'
                 ' FROM bayesdb_variable AS v'
                 ' WHERE v.population_id = 1'
                     ' AND v.generator_id IS NULL'
                 ' LIMIT ?1',
-            'SELECT colno FROM bayesdb_variable'
-                ' WHERE population_id = ?'
-                    ' AND (generator_id IS NULL OR generator_id = ?)'
-                    ' AND name = ?',
-            'SELECT tabname FROM bayesdb_population WHERE id = ?',
             # ESTIMATE SIMILARITY TO (rowid=1):
             'SELECT bql_row_similarity(1, NULL, NULL, _rowid_,'
                 ' (SELECT _rowid_ FROM "t" WHERE ("rowid" = 1)), 0) FROM "t"',
-            'SELECT id FROM bayesdb_generator WHERE population_id = ?',
-            'SELECT backend FROM bayesdb_generator WHERE id = ?',
             'SELECT cgpm_rowid FROM bayesdb_cgpm_individual'
                 ' WHERE generator_id = ? AND table_rowid = ?',
             'SELECT cgpm_rowid FROM bayesdb_cgpm_individual'
@@ -1822,61 +1895,38 @@ def test_parametrized():
                     ' AND name = ?',
             'SELECT CAST(4 AS INTEGER), \'F\'',
             'SELECT token FROM bayesdb_rowid_tokens',
-            'SELECT COUNT(*) FROM bayesdb_variable'
-                ' WHERE population_id = ?'
-                    ' AND (generator_id IS NULL OR generator_id = ?)'
-                    ' AND name = ?',
             'SELECT colno FROM bayesdb_variable'
                 ' WHERE population_id = ?'
                     ' AND (generator_id IS NULL OR generator_id = ?)'
                     ' AND name = ?',
-            'SELECT token FROM bayesdb_rowid_tokens',
-            'SELECT COUNT(*) FROM bayesdb_variable'
-                ' WHERE population_id = ?'
-                    ' AND (generator_id IS NULL OR generator_id = ?)'
-                    ' AND name = ?',
             'SELECT colno FROM bayesdb_variable'
                 ' WHERE population_id = ?'
                     ' AND (generator_id IS NULL OR generator_id = ?)'
                     ' AND name = ?',
             'SELECT tabname FROM bayesdb_population WHERE id = ?',
             'SELECT MAX(_rowid_) FROM "t"',
-            'SELECT token FROM bayesdb_rowid_tokens',
-            'SELECT token FROM bayesdb_rowid_tokens',
             'SELECT id FROM bayesdb_generator WHERE population_id = ?',
             'SELECT backend FROM bayesdb_generator WHERE id = ?',
             'SELECT population_id FROM bayesdb_generator WHERE id = ?',
-            'SELECT tabname FROM bayesdb_population WHERE id = ?',
             'SELECT 1 FROM "t" WHERE oid = ?',
             'SELECT 1 FROM bayesdb_cgpm_individual'
                 ' WHERE generator_id = ? AND table_rowid = ? LIMIT 1',
             'SELECT cgpm_rowid FROM bayesdb_cgpm_individual'
                 ' WHERE generator_id = ? AND table_rowid = ?',
-            'SELECT population_id FROM bayesdb_generator WHERE id = ?',
             'SELECT stattype FROM bayesdb_variable WHERE population_id = ?'
                 ' AND (generator_id IS NULL OR generator_id = ?) AND colno = ?',
             'SELECT code FROM bayesdb_cgpm_category'
                 ' WHERE generator_id = ? AND colno = ? AND value = ?',
             'SELECT engine_stamp FROM bayesdb_cgpm_generator'
                 ' WHERE generator_id = ?',
-            'SELECT population_id FROM bayesdb_generator WHERE id = ?',
             'SELECT stattype FROM bayesdb_variable WHERE population_id = ?'
                 ' AND (generator_id IS NULL OR generator_id = ?) AND colno = ?',
             'SELECT value FROM bayesdb_cgpm_category'
                 ' WHERE generator_id = ? AND colno = ? AND code = ?',
-            'SELECT population_id FROM bayesdb_generator WHERE id = ?',
-            'SELECT stattype FROM bayesdb_variable WHERE population_id = ?'
-                ' AND (generator_id IS NULL OR generator_id = ?) AND colno = ?',
             'SELECT value FROM bayesdb_cgpm_category'
                 ' WHERE generator_id = ? AND colno = ? AND code = ?',
-            'SELECT population_id FROM bayesdb_generator WHERE id = ?',
-            'SELECT stattype FROM bayesdb_variable WHERE population_id = ?'
-                ' AND (generator_id IS NULL OR generator_id = ?) AND colno = ?',
             'SELECT value FROM bayesdb_cgpm_category'
                 ' WHERE generator_id = ? AND colno = ? AND code = ?',
-            'SELECT population_id FROM bayesdb_generator WHERE id = ?',
-            'SELECT stattype FROM bayesdb_variable WHERE population_id = ?'
-                ' AND (generator_id IS NULL OR generator_id = ?) AND colno = ?',
             'SELECT value FROM bayesdb_cgpm_category'
                 ' WHERE generator_id = ? AND colno = ? AND code = ?',
             'CREATE TEMP TABLE "bayesdb_temp_1" ("age")',
@@ -1903,14 +1953,102 @@ def test_parametrized():
             'SELECT COUNT(*) FROM bayesdb_generator WHERE name = ?',
             'SELECT id FROM bayesdb_generator WHERE name = ?',
             'SELECT backend FROM bayesdb_generator WHERE id = ?',
-            'SELECT engine_json, engine_stamp FROM bayesdb_cgpm_generator'
+            'SELECT engine_blob, engine_stamp FROM bayesdb_cgpm_generator'
                 ' WHERE generator_id = ?',
+            'SELECT state_blob FROM bayesdb_cgpm_state'
+                ' WHERE generator_id = ? ORDER BY cgpm_modelno ASC',
             'SELECT population_id FROM bayesdb_generator WHERE id = ?',
             'SELECT engine_stamp FROM bayesdb_cgpm_generator'
                 ' WHERE generator_id = ?',
             'UPDATE bayesdb_cgpm_generator'
-                ' SET engine_json = :engine_json, engine_stamp = :engine_stamp'
-                ' WHERE generator_id = :generator_id']
+                ' SET engine_blob = :engine_blob, engine_stamp = :engine_stamp'
+                ' WHERE generator_id = :generator_id',
+            'INSERT OR REPLACE INTO bayesdb_cgpm_state'
+                ' (generator_id, cgpm_modelno, state_blob, state_stamp)'
+                ' VALUES (?, ?, ?, ?)',
+            'DELETE FROM bayesdb_cgpm_state'
+                ' WHERE generator_id = ? AND cgpm_modelno >= ?']
+
+def test_plan_cache():
+    with test_core.t1() as (bdb, _population_id, _generator_id):
+        bdb.execute('initialize 1 model for p1_cc')
+        hits = bdb.plan_cache_hits
+        misses = bdb.plan_cache_misses
+        query = 'estimate predictive probability of age from p1 where age < ?'
+        result = bdb.execute(query, (20,)).fetchall()
+        assert bdb.plan_cache_misses == misses + 1
+        assert bdb.execute(query, (20,)).fetchall() == result
+        assert bdb.plan_cache_hits == hits + 1
+        # Different parameter values reuse the plan.
+        assert len(bdb.execute(query, (10,)).fetchall()) < len(result)
+        assert bdb.plan_cache_hits == hits + 2
+        # Changing the parameter shape needs a new plan.
+        with pytest.raises(ValueError):
+            bdb.execute(query, (10, 20))
+        assert bdb.plan_cache_misses == misses + 2
+        # Commands change the catalog version.
+        bdb.execute('initialize 1 model if not exists for p1_cc')
+        assert bdb.execute(query, (20,)).fetchall() == result
+        assert bdb.plan_cache_misses == misses + 3
+        # Simulation happens at compile time, so it is never reused.
+        simulate = 'select * from (simulate age from p1 limit 1)'
+        bdb.execute(simulate).fetchall()
+        bdb.execute(simulate).fetchall()
+        assert bdb.plan_cache_misses == misses + 5
+        assert bdb.plan_cache_hits == hits + 2
+
+def test_plan_cache_temp_tables():
+    with test_core.t1() as (bdb, _population_id, _generator_id):
+        bayeslite.bayesdb_register_backend(bdb, CacheRecordingBackend())
+        bdb.execute('DROP GENERATOR p1_cc')
+        bdb.execute('CREATE GENERATOR p1_rec FOR p1 USING cache_recording()')
+        hits = bdb.plan_cache_hits
+        # Batched queries fill temporary tables before they run, and
+        # drop them when the cursor goes away.  A reused plan fills its
+        # own, even while the first cursor is still around.
+        query = 'estimate age, predictive probability of age from p1' \
+            ' where age < ?'
+        cursor0 = bdb.execute(query, (30,))
+        rows0 = cursor0.fetchall()
+        cursor1 = bdb.execute(query, (50,))
+        rows1 = cursor1.fetchall()
+        assert bdb.plan_cache_hits == hits + 1
+        assert 0 < len(rows0) < len(rows1)
+        assert all(age < 30 and p is not None for age, p in rows0)
+        assert all(age < 50 and p is not None for age, p in rows1)
+        del cursor0
+        del cursor1
+        assert bdb.execute(query, (30,)).fetchall() == rows0
+        assert bdb.plan_cache_hits == hits + 2
+
+def test_plan_cache_temp_table_lookalikes():
+    with test_core.t1() as (bdb, _population_id, _generator_id):
+        bayeslite.bayesdb_register_backend(bdb, CacheRecordingBackend())
+        bdb.execute('DROP GENERATOR p1_cc')
+        bdb.execute('CREATE GENERATOR p1_rec FOR p1 USING cache_recording()')
+        hits = bdb.plan_cache_hits
+        # A reused plan renames its temporary tables only where the
+        # compiler put them, not in literals or parameters that happen
+        # to look like them.
+        temptable = 'bayesdb_temp_%u' % (bdb.temptable,)
+        literal = '"%s"' % (temptable,)
+        query = "estimate '%s', ?, predictive probability of age from p1" \
+            " where age < ?" % (literal,)
+        created = []
+        def tracer(sql, _bindings):
+            if 'CREATE TEMP TABLE' in sql:
+                created.append(sql)
+        bdb.sql_trace(tracer)
+        try:
+            rows0 = bdb.execute(query, (temptable, 30)).fetchall()
+            rows1 = bdb.execute(query, (temptable, 50)).fetchall()
+        finally:
+            bdb.sql_untrace(tracer)
+        assert bdb.plan_cache_hits == hits + 1
+        assert literal in created[0]
+        assert literal not in created[1]
+        assert 0 < len(rows0) < len(rows1)
+        assert all(row[:2] == (literal, temptable) for row in rows0 + rows1)
 
 def test_create_table_ifnotexists_as_simulate():
     with test_csv.bayesdb_csv_file(test_csv.csv_data) as (bdb, fname):
@@ -2400,14 +2538,10 @@ def test_checkpoint__ci_slow():
     with test_core.t1() as (bdb, population_id, generator_id):
         bdb.execute('initialize 1 model for p1_cc')
         bdb.execute('analyze p1_cc for 10 iterations checkpoint 1 iteration')
-        # No checkpoint by seconds.
-        with pytest.raises(NotImplementedError):
-            bdb.execute('analyze p1_cc for 5 seconds checkpoint 1 second')
+        bdb.execute('analyze p1_cc for 5 seconds checkpoint 1 second')
         bdb.execute('drop models from p1_cc')
         bdb.execute('initialize 1 model for p1_cc')
-        # No checkpoint by seconds.
-        with pytest.raises(NotImplementedError):
-            bdb.execute('analyze p1_cc for 5 iterations checkpoint 1 second')
+        bdb.execute('analyze p1_cc for 5 iterations checkpoint 1 second')
         bdb.execute('drop models from p1_cc')
         bdb.execute('initialize 1 model for p1_cc')
         bdb.execute('analyze p1_cc for 1 iteration checkpoint 2 iterations')
@@ -2635,7 +2769,9 @@ def test_tracing_execution_error_smoke():
         bayeslite.bayesdb_register_backend(bdb, ErroneousBackend())
         bdb.execute('DROP GENERATOR p1_cc')
         bdb.execute('CREATE GENERATOR p1_err FOR p1 USING erroneous()')
-        q = 'ESTIMATE PREDICTIVE PROBABILITY OF age FROM p1'
+        # With LIMIT, predictive probabilities are computed row by row
+        # as the rows are fetched.
+        q = 'ESTIMATE PREDICTIVE PROBABILITY OF age FROM p1 LIMIT 1000'
         tracer = MockTracerOneQuery(q, 1)
         bdb.trace(tracer)
         cursor = bdb.execute(q)
@@ -2652,6 +2788,103 @@ def test_tracing_execution_error_smoke():
         assert tracer.finished_calls == 0
         assert tracer.abandoned_calls == 0
 
+def test_tracing_batch_error_smoke():
+    with test_core.t1() as (bdb, _population_id, _generator_id):
+        bayeslite.bayesdb_register_backend(bdb, ErroneousBackend())
+        bdb.execute('DROP GENERATOR p1_cc')
+        bdb.execute('CREATE GENERATOR p1_err FOR p1 USING erroneous()')
+        # Without LIMIT, predictive probabilities are computed in a
+        # batch before the query runs, so errors are raised by execute.
+        q = 'ESTIMATE PREDICTIVE PROBABILITY OF age FROM p1'
+        tracer = MockTracerOneQuery(q, 1)
+        bdb.trace(tracer)
+        with pytest.raises(Boom):
+            bdb.execute(q)
+        assert tracer.start_calls == 1
+        assert tracer.ready_calls == 0
+        assert tracer.error_calls == 1
+        assert tracer.finished_calls == 0
+        assert tracer.abandoned_calls == 0
+
+class CacheRecordingBackend(troll.TrollBackend):
+    def __init__(self):
+        self.lookups = 0
+    def name(self):
+        return 'cache_recording'
+    def logpdf_joint(self, bdb, *_args, **_kwargs):
+        # Memoize a lookup in the transaction cache, as CGPM does with
+        # engine stamps.
+        if 'cache_recording' not in bdb.cache:
+            self.lookups += 1
+            bdb.cache['cache_recording'] = True
+        return 0
+
+def test_row_by_row_caching():
+    with test_core.t1() as (bdb, _population_id, _generator_id):
+        backend = CacheRecordingBackend()
+        bayeslite.bayesdb_register_backend(bdb, backend)
+        bdb.execute('DROP GENERATOR p1_cc')
+        bdb.execute('CREATE GENERATOR p1_rec FOR p1 USING cache_recording()')
+        query = 'ESTIMATE PREDICTIVE PROBABILITY OF age FROM p1 LIMIT 5'
+        cursor = bdb.execute(query)
+        assert cursor.fetchone() is not None
+        rows = [row for row in cursor]
+        assert len(rows) == 4
+        # The rows fetched by execute, fetchone, and iteration share
+        # one cache for the statement.
+        assert backend.lookups == 1
+        # Another statement gets its own.
+        assert len(bdb.execute(query).fetchall()) == 5
+        assert backend.lookups == 2
+
+class PredictionRecordingBackend(troll.TrollBackend):
+    def __init__(self):
+        self.batches = []
+    def name(self):
+        return 'prediction_recording'
+    def predict_confidence(self, _bdb, _generator_id, _modelnos, rowid, colno,
+            numsamples=None):
+        return rowid*10 + colno, rowid/100.
+    def predict_confidence_batch(self, bdb, generator_id, modelnos, rowids,
+            colno, numsamples=None):
+        self.batches.append((colno, list(rowids)))
+        return super(PredictionRecordingBackend, self).predict_confidence_batch(
+            bdb, generator_id, modelnos, rowids, colno, numsamples=numsamples)
+
+def test_predict_batch():
+    with test_core.t1() as (bdb, _population_id, _generator_id):
+        backend = PredictionRecordingBackend()
+        bayeslite.bayesdb_register_backend(bdb, backend)
+        bdb.execute('DROP GENERATOR p1_cc')
+        bdb.execute('CREATE GENERATOR p1_rec FOR p1 USING'
+            ' prediction_recording()')
+        query = 'INFER EXPLICIT rowid, PREDICT age AS a CONFIDENCE c,' \
+            ' PREDICT age WITH CONFIDENCE 0.05 FROM p1 WHERE rowid < 8'
+        rows = bdb.execute(query).fetchall()
+        # Both predictions of age come from one batch over the rows
+        # satisfying the condition.
+        assert backend.batches == [(2, range(1, 8))]
+        assert rows == [
+            (rowid, rowid*10 + 2, rowid/100.,
+                rowid*10 + 2 if rowid >= 5 else None)
+            for rowid in range(1, 8)
+        ]
+        # With a limit, each row is predicted separately, to the same
+        # effect.
+        del backend.batches[:]
+        assert bdb.execute(query + ' LIMIT 100').fetchall() == rows
+        assert backend.batches == []
+        # INFER predicts only the missing values.
+        rows = bdb.execute('INFER rowid, age, weight FROM p1'
+            ' WHERE rowid < 8').fetchall()
+        assert backend.batches == [(2, [4]), (3, [5])]
+        assert rows == [
+            (rowid,) + tuple(
+                rowid*10 + colno if value is None else value
+                for colno, value in zip([2, 3], test_core.t1_rows[rowid-1][1:]))
+            for rowid in range(1, 8)
+        ]
+
 def test_pdf_var():
     with test_core.t1() as (bdb, population_id, _generator_id):
         bdb.execute('initialize 6 models for p1_cc;')
@@ -38,9 +38,12 @@ from bayeslite import bayesdb_read_csv
 from bayeslite import bayesdb_register_backend
 from bayeslite.core import bayesdb_get_generator
 from bayeslite.core import bayesdb_get_population
+from bayeslite.core import bayesdb_variable_number
 from bayeslite.exception import BQLError
 from bayeslite.backends.cgpm_backend import CGPM_Backend
+from bayeslite.backends.cgpm_backend import _upgrade_engine_json
 from bayeslite.util import cursor_value
+from bayeslite.util import json_dumps
 
 import test_csv
 
@@ -349,6 +352,33 @@ def test_cgpm_analysis_iteration_timed__ci_slow():
         ''')
         assert 0 < time.time() - start3 < 15
 
+def test_analyze_checkpoint_seconds():
+    with cgpm_dummy_satellites_bdb() as bdb:
+        backend = CGPM_Backend(dict(), multiprocess=0)
+        bayesdb_register_backend(bdb, backend)
+        bdb.execute('''
+            CREATE POPULATION p FOR satellites_ucs WITH SCHEMA(
+                GUESS STATTYPES OF (*);
+            )
+        ''')
+        bdb.execute('CREATE GENERATOR m FOR p (SUBSAMPLE 10);')
+        population_id = bayesdb_get_population(bdb, 'p')
+        generator_id = bayesdb_get_generator(bdb, population_id, 'm')
+        bdb.execute('INITIALIZE 2 MODELS FOR m')
+
+        # Analysis by iterations runs in slices of a growing number of
+        # iterations, saving the states after each.
+        stamp = backend._engine_stamp(bdb, generator_id)
+        bdb.execute('ANALYZE m FOR 3 ITERATIONS CHECKPOINT 1 SECOND (QUIET)')
+        assert 2 <= backend._engine_stamp(bdb, generator_id) - stamp <= 3
+
+        # Timed analysis runs in timed slices.
+        stamp = backend._engine_stamp(bdb, generator_id)
+        start = time.time()
+        bdb.execute('ANALYZE m FOR 2 SECONDS CHECKPOINT 1 SECOND (QUIET)')
+        assert 2 <= time.time() - start < 15
+        assert 2 <= backend._engine_stamp(bdb, generator_id) - stamp
+
 
 # Use dummy, quick version of Kepler's laws.  Allow an extra
 # distribution argument to make sure it gets passed through.
@@ -1136,6 +1166,444 @@ def test_add_drop_models():
         ''', (generator_id,))
         assert cursor_value(cursor) == 0
 
+def test_engine_state_storage():
+    with cgpm_dummy_satellites_bdb() as bdb:
+        backend = CGPM_Backend(dict(), multiprocess=0)
+        bayesdb_register_backend(bdb, backend)
+        bdb.execute('''
+            CREATE POPULATION p FOR satellites_ucs WITH SCHEMA(
+                GUESS STATTYPES OF (*);
+            )
+        ''')
+        bdb.execute('CREATE GENERATOR m FOR p (SUBSAMPLE 10);')
+        population_id = bayesdb_get_population(bdb, 'p')
+        generator_id = bayesdb_get_generator(bdb, population_id, 'm')
+
+        def count_states():
+            return cursor_value(bdb.sql_execute('''
+                SELECT COUNT(*) FROM bayesdb_cgpm_state
+                    WHERE generator_id = ?
+            ''', (generator_id,)))
+
+        # Each state has its own row, and no engine is stored as JSON.
+        bdb.execute('INITIALIZE 4 MODELS FOR m')
+        bdb.execute('ANALYZE m FOR 1 ITERATION (QUIET)')
+        assert count_states() == 4
+        assert cursor_value(bdb.sql_execute('''
+            SELECT COUNT(*) FROM bayesdb_cgpm_generator
+                WHERE engine_json IS NOT NULL
+        ''')) == 0
+
+        # Only the states analyzed or altered are written again.
+        def state_stamps():
+            return bdb.sql_execute('''
+                SELECT cgpm_modelno, state_stamp FROM bayesdb_cgpm_state
+                    WHERE generator_id = ?
+                    ORDER BY cgpm_modelno
+            ''', (generator_id,)).fetchall()
+        assert state_stamps() == [(0, 2), (1, 2), (2, 2), (3, 2)]
+        bdb.execute('ANALYZE m MODELS 1, 3 FOR 1 ITERATION (QUIET)')
+        assert state_stamps() == [(0, 2), (1, 3), (2, 2), (3, 3)]
+        bdb.execute('''
+            ALTER GENERATOR m MODELS (2)
+                SET VIEW CONCENTRATION PARAMETER TO 1
+        ''')
+        assert state_stamps() == [(0, 2), (1, 3), (2, 4), (3, 3)]
+
+        # Dropping models deletes their rows, and renumbers the rest
+        # without writing them again.
+        bdb.execute('DROP MODELS 1-2 FROM m')
+        assert count_states() == 2
+        assert state_stamps() == [(0, 2), (1, 3)]
+        bdb.execute('INITIALIZE 4 MODELS IF NOT EXISTS FOR m')
+        assert state_stamps() == [(0, 2), (1, 3), (2, 6), (3, 6)]
+
+        # An engine stored as JSON by CGPM schema version 3 is moved
+        # into the per-state encoding on upgrade.
+        query = 'ESTIMATE PROBABILITY DENSITY OF period = 1 BY p'
+        expected = bdb.execute(query).fetchvalue()
+        engine = backend._engine(bdb, generator_id)
+        bdb.sql_execute('''
+            UPDATE bayesdb_cgpm_generator
+                SET engine_json = ?, engine_blob = NULL
+                WHERE generator_id = ?
+        ''', (json_dumps(engine.to_metadata()), generator_id))
+        bdb.sql_execute('DELETE FROM bayesdb_cgpm_state')
+        _upgrade_engine_json(bdb)
+        assert count_states() == 4
+        backend._del_cache_entry(bdb, generator_id, None)
+        assert bdb.execute(query).fetchvalue() == expected
+
+        # Dropping all models deletes every state.
+        bdb.execute('DROP MODELS FROM m')
+        assert count_states() == 0
+
+def test_lazy_states():
+    with cgpm_dummy_satellites_bdb() as bdb:
+        backend = CGPM_Backend(dict(), multiprocess=0)
+        bayesdb_register_backend(bdb, backend)
+        bdb.execute('''
+            CREATE POPULATION p FOR satellites_ucs WITH SCHEMA(
+                GUESS STATTYPES OF (*);
+            )
+        ''')
+        bdb.execute('CREATE GENERATOR m FOR p (SUBSAMPLE 10);')
+        population_id = bayesdb_get_population(bdb, 'p')
+        generator_id = bayesdb_get_generator(bdb, population_id, 'm')
+        bdb.execute('INITIALIZE 4 MODELS FOR m')
+        bdb.execute('ANALYZE m FOR 1 ITERATION (QUIET)')
+        query = '''
+            ESTIMATE PROBABILITY DENSITY OF period = 1 BY p USING MODELS %s
+        '''
+        expected = {
+            models: bdb.execute(query % (models,)).fetchvalue()
+            for models in ['1-2', '0-3']
+        }
+
+        # Load the engine afresh: a query using some models decodes
+        # only their states.
+        backend._del_cache_entry(bdb, generator_id, None)
+        assert bdb.execute(query % ('1-2',)).fetchvalue() == expected['1-2']
+        engine = backend._engine(bdb, generator_id)
+        assert engine.num_states() == 4
+        assert [engine.states.is_decoded(i) for i in xrange(4)] == \
+            [False, True, True, False]
+
+        # The rest are decoded when needed.
+        assert bdb.execute(query % ('0-3',)).fetchvalue() == expected['0-3']
+        assert [engine.states.is_decoded(i) for i in xrange(4)] == \
+            [True, True, True, True]
+
+def test_state_pool():
+    with cgpm_dummy_satellites_bdb() as bdb:
+        backend = CGPM_Backend(dict(), multiprocess=0)
+        bayesdb_register_backend(bdb, backend)
+        bdb.execute('''
+            CREATE POPULATION p FOR satellites_ucs WITH SCHEMA(
+                GUESS STATTYPES OF (*);
+            )
+        ''')
+        bdb.execute('CREATE GENERATOR m FOR p (SUBSAMPLE 10);')
+        population_id = bayesdb_get_population(bdb, 'p')
+        generator_id = bayesdb_get_generator(bdb, population_id, 'm')
+        bdb.execute('INITIALIZE 4 MODELS FOR m')
+        bdb.execute('ANALYZE m FOR 1 ITERATION (QUIET)')
+        queries = [
+            '''
+                ESTIMATE PROBABILITY DENSITY OF period = 1 BY p
+                    USING MODELS 1-2
+            ''',
+            '''
+                ESTIMATE DEPENDENCE PROBABILITY OF apogee WITH perigee BY p
+            ''',
+            '''
+                ESTIMATE SIMILARITY TO (_rowid_ = 1)
+                    IN THE CONTEXT OF period
+                    FROM p WHERE _rowid_ < 5
+            ''',
+        ]
+        def results():
+            return [bdb.execute(query).fetchall() for query in queries]
+        expected = results()
+
+        # With multiprocessing on, the states are evaluated in the
+        # pool, and not decoded here.
+        backend._del_cache_entry(bdb, generator_id, None)
+        backend.set_multiprocess(True)
+        try:
+            assert results() == expected
+            engine = backend._engine(bdb, generator_id)
+            assert not any(engine.states.is_decoded(i) for i in xrange(4))
+            key = backend._get_cache_entry(bdb, generator_id, 'pooled')[2]
+            assert len(bdb.execute('''
+                SIMULATE period FROM p GIVEN apogee = 1 LIMIT 10
+            ''').fetchall()) == 10
+            assert backend._get_cache_entry(
+                bdb, generator_id, 'pooled')[2] == key
+
+            # Analysis reloads the states in the pool.
+            bdb.execute('ANALYZE m FOR 1 ITERATION (QUIET)')
+            expected = results()
+            assert backend._get_cache_entry(
+                bdb, generator_id, 'pooled')[2] != key
+        finally:
+            backend.set_multiprocess(False)
+        assert results() == expected
+
+def test_logpdf_joint_batch():
+    with cgpm_dummy_satellites_bdb() as bdb:
+        backend = CGPM_Backend(dict(), multiprocess=0)
+        bayesdb_register_backend(bdb, backend)
+        bdb.execute('''
+            CREATE POPULATION p FOR satellites_ucs WITH SCHEMA(
+                GUESS STATTYPES OF (*);
+            )
+        ''')
+        bdb.execute('CREATE GENERATOR m FOR p (SUBSAMPLE 10);')
+        population_id = bayesdb_get_population(bdb, 'p')
+        generator_id = bayesdb_get_generator(bdb, population_id, 'm')
+        bdb.execute('INITIALIZE 3 MODELS FOR m')
+        bdb.execute('ANALYZE m FOR 1 ITERATION (QUIET)')
+        def colno(var):
+            return bayesdb_variable_number(
+                bdb, population_id, generator_id, var)
+        rowids = [rowid for (rowid,) in bdb.sql_execute('''
+            SELECT table_rowid FROM bayesdb_cgpm_individual
+                WHERE generator_id = ? ORDER BY table_rowid LIMIT 3
+        ''', (generator_id,))] + [None]
+        rows = []
+        for rowid in rowids:
+            for constraints in [
+                    [],
+                    [(colno('apogee'), 1)],
+                    [(colno('apogee'), 1), (colno('launch_mass'), None)],
+                    [(colno('perigee'), 2)]]:
+                rows.append(
+                    (rowid, [(colno('period'), 2.5)], constraints))
+        rows += rows[:3]
+        expected = [
+            backend.logpdf_joint(bdb, generator_id, None, *row)
+            for row in rows
+        ]
+
+        # The batch evaluates the states over all rows in two calls,
+        # one for the targets and one for the constraints.
+        engine = backend._engine(bdb, generator_id)
+        calls = []
+        logpdf_bulk = engine.logpdf_bulk
+        def recording_logpdf_bulk(rowids, targets_list, *args, **kwargs):
+            calls.append(len(rowids))
+            return logpdf_bulk(rowids, targets_list, *args, **kwargs)
+        def failing_logpdf(*args, **kwargs):
+            assert False, 'logpdf called per row'
+        engine.logpdf_bulk = recording_logpdf_bulk
+        engine.logpdf = failing_logpdf
+        try:
+            actual = backend.logpdf_joint_batch(bdb, generator_id, None, rows)
+        finally:
+            del engine.logpdf_bulk
+            del engine.logpdf
+        assert np.allclose(actual, expected)
+        # The null launch mass is ignored, leaving 3 distinct constraint
+        # sets for each of 4 rowids, 2 of them not empty.
+        assert calls == [12, 8]
+        assert backend.logpdf_joint_batch(
+            bdb, generator_id, None, []) == []
+        assert np.allclose(
+            backend.logpdf_joint_batch(bdb, generator_id, [1], rows),
+            [backend.logpdf_joint(bdb, generator_id, [1], *row)
+                for row in rows])
+
+def test_category_codes():
+    with cgpm_dummy_satellites_bdb() as bdb:
+        backend = CGPM_Backend(dict(), multiprocess=0)
+        bayesdb_register_backend(bdb, backend)
+        bdb.execute('''
+            CREATE POPULATION p FOR satellites_ucs WITH SCHEMA(
+                GUESS STATTYPES OF (*);
+            )
+        ''')
+        bdb.execute('CREATE GENERATOR m FOR p (SUBSAMPLE 10);')
+        population_id = bayesdb_get_population(bdb, 'p')
+        generator_id = bayesdb_get_generator(bdb, population_id, 'm')
+        bdb.execute('INITIALIZE 1 MODEL FOR m')
+        colno = bayesdb_variable_number(
+            bdb, population_id, generator_id, 'country_of_operator')
+        values = ['US', 'Russia', 'China', 'Bulgaria', None, 'Atlantis', 1]
+        codes = backend._to_numeric_many(bdb, generator_id, colno, values)
+        expected = [
+            backend._to_numeric(bdb, generator_id, colno, v) for v in values
+        ]
+        assert np.allclose(codes, expected, equal_nan=True)
+        assert np.isnan(codes[4:]).all()
+        assert backend._from_numeric_many(bdb, generator_id, colno, codes) \
+            == values[:4] + [None, None, None]
+        with pytest.raises(BQLError):
+            backend._from_numeric_many(bdb, generator_id, colno, [100])
+
+        # Samples come back as values, not codes.
+        samples = bdb.execute('''
+            SIMULATE country_of_operator, apogee FROM p LIMIT 10
+        ''').fetchall()
+        assert all(country in values[:4] for country, _apogee in samples)
+
+def test_rowid_map():
+    with cgpm_dummy_satellites_bdb() as bdb:
+        backend = CGPM_Backend(dict(), multiprocess=0)
+        bayesdb_register_backend(bdb, backend)
+        bdb.execute('''
+            CREATE POPULATION p FOR satellites_ucs WITH SCHEMA(
+                GUESS STATTYPES OF (*);
+            )
+        ''')
+        bdb.execute('CREATE GENERATOR m FOR p (SUBSAMPLE 10);')
+        population_id = bayesdb_get_population(bdb, 'p')
+        generator_id = bayesdb_get_generator(bdb, population_id, 'm')
+        expected = dict(bdb.sql_execute('''
+            SELECT table_rowid, cgpm_rowid FROM bayesdb_cgpm_individual
+                WHERE generator_id = ?
+        ''', (generator_id,)))
+        assert len(expected) == 10
+        table_rowids = sorted(expected.keys(), reverse=True) + [0, -5, 10**6]
+        assert backend._cgpm_rowids(bdb, generator_id, table_rowids) == \
+            [expected[r] for r in table_rowids[:10]] + [-1, -1, -1]
+        rowid = table_rowids[0]
+        assert backend._cgpm_rowid(bdb, generator_id, float(rowid)) == \
+            expected[rowid]
+        assert backend._cgpm_rowid(bdb, generator_id, None) == -1
+        assert backend._cgpm_rowid(bdb, generator_id, 'x') == -1
+        with pytest.raises(ValueError):
+            backend._cgpm_rowid(bdb, generator_id, 10**6, nullok=False)
+
+        # The map is read again once the generator changes.
+        bdb.sql_execute('''
+            UPDATE bayesdb_cgpm_individual SET cgpm_rowid = cgpm_rowid + 100
+                WHERE generator_id = ?
+        ''', (generator_id,))
+        assert backend._cgpm_rowid(bdb, generator_id, rowid) == \
+            expected[rowid]
+        bdb.sql_execute('''
+            UPDATE bayesdb_cgpm_generator SET engine_stamp = engine_stamp + 1
+                WHERE generator_id = ?
+        ''', (generator_id,))
+        assert backend._cgpm_rowid(bdb, generator_id, rowid) == \
+            expected[rowid] + 100
+
+def test_data_matrix():
+    with cgpm_dummy_satellites_bdb() as bdb:
+        backend = CGPM_Backend(dict(), multiprocess=0)
+        bayesdb_register_backend(bdb, backend)
+        bdb.execute('''
+            CREATE POPULATION p FOR satellites_ucs WITH SCHEMA(
+                GUESS STATTYPES OF (*);
+            )
+        ''')
+        bdb.execute('CREATE GENERATOR m FOR p;')
+        population_id = bayesdb_get_population(bdb, 'p')
+        generator_id = bayesdb_get_generator(bdb, population_id, 'm')
+        names = ['apogee', 'class_of_orbit', 'country_of_operator', 'period']
+        colnos = [
+            bayesdb_variable_number(bdb, population_id, generator_id, name)
+            for name in names
+        ]
+        data = backend._data(bdb, generator_id, names)
+        assert data.dtype == np.float64
+        rows = bdb.sql_execute('''
+            SELECT apogee, class_of_orbit, country_of_operator, period
+                FROM satellites_ucs ORDER BY _rowid_ ASC
+        ''').fetchall()
+        expected = [
+            [
+                backend._to_numeric(bdb, generator_id, colno, value)
+                for colno, value in zip(colnos, row)
+            ]
+            for row in rows
+        ]
+        assert data.shape == (len(rows), len(names))
+        assert np.allclose(data, expected, equal_nan=True)
+
+def test_incorporate_new_rows():
+    with cgpm_dummy_satellites_bdb() as bdb:
+        backend = CGPM_Backend(dict(), multiprocess=0)
+        bayesdb_register_backend(bdb, backend)
+        bdb.execute('''
+            CREATE POPULATION p FOR satellites_ucs WITH SCHEMA(
+                GUESS STATTYPES OF (*);
+            )
+        ''')
+        bdb.execute('CREATE GENERATOR m FOR p;')
+        population_id = bayesdb_get_population(bdb, 'p')
+        generator_id = bayesdb_get_generator(bdb, population_id, 'm')
+        bdb.execute('INITIALIZE 2 MODELS FOR m')
+        bdb.execute('ANALYZE m FOR 1 ITERATION (QUIET)')
+
+        def individuals():
+            return bdb.sql_execute('''
+                SELECT table_rowid, cgpm_rowid FROM bayesdb_cgpm_individual
+                    WHERE generator_id = ?
+                    ORDER BY cgpm_rowid
+            ''', (generator_id,)).fetchall()
+        def engine_stamp():
+            return cursor_value(bdb.sql_execute('''
+                SELECT engine_stamp FROM bayesdb_cgpm_generator
+                    WHERE generator_id = ?
+            ''', (generator_id,)))
+        n = len(individuals())
+        assert n == 100
+
+        # With no new rows, only the stamp changes.
+        stamp = engine_stamp()
+        bdb.execute('ALTER GENERATOR m INCORPORATE NEW ROWS')
+        assert len(individuals()) == n
+        assert stamp < engine_stamp()
+
+        # New rows, all null ones aside, become individuals after the
+        # old ones.
+        bdb.sql_executemany('''
+            INSERT INTO satellites_ucs
+                (country_of_operator, class_of_orbit, apogee, period)
+                VALUES (?, ?, ?, ?)
+        ''', [
+            ('US', 'geo', 1, 2),
+            (None, None, None, None),
+            (None, 'leo', 3, 0.5),
+        ])
+        with pytest.raises(BQLError):
+            # New rows go into all models or none.
+            bdb.execute('ALTER GENERATOR m MODELS (1) INCORPORATE NEW ROWS')
+        stamp = engine_stamp()
+        bdb.execute('ALTER GENERATOR m INCORPORATE NEW ROWS')
+        assert individuals()[n:] == [(101, 100), (103, 101)]
+        assert stamp < engine_stamp()
+        for state in backend._engine(bdb, generator_id).states:
+            assert state.n_rows() == n + 2
+        assert bdb.execute('''
+            ESTIMATE PREDICTIVE PROBABILITY OF period FROM p
+                WHERE _rowid_ = 103
+        ''').fetchvalue() is not None
+
+        # The new individuals survive reloading and further analysis.
+        backend._del_cache_entry(bdb, generator_id, None)
+        for state in backend._engine(bdb, generator_id).states:
+            assert state.n_rows() == n + 2
+        bdb.execute('ANALYZE m FOR 1 ITERATION (QUIET)')
+
+        # The models have no code for a new category.
+        bdb.sql_execute('''
+            INSERT INTO satellites_ucs (country_of_operator, apogee)
+                VALUES ('Zambia', 4)
+        ''')
+        with pytest.raises(BQLError):
+            bdb.execute('ALTER GENERATOR m INCORPORATE NEW ROWS')
+        assert len(individuals()) == n + 2
+
+def test_incorporate_new_rows_subsample():
+    with cgpm_dummy_satellites_bdb() as bdb:
+        bayesdb_register_backend(bdb, CGPM_Backend(dict(), multiprocess=0))
+        bdb.execute('''
+            CREATE POPULATION p FOR satellites_ucs WITH SCHEMA(
+                GUESS STATTYPES OF (*);
+            )
+        ''')
+        bdb.execute('CREATE GENERATOR m FOR p (SUBSAMPLE 10);')
+        population_id = bayesdb_get_population(bdb, 'p')
+        generator_id = bayesdb_get_generator(bdb, population_id, 'm')
+        bdb.execute('INITIALIZE 2 MODELS FOR m')
+        # Only rows appended since the generator was created are new,
+        # not the rows left out of the subsample.
+        bdb.sql_execute('''
+            INSERT INTO satellites_ucs (country_of_operator, apogee)
+                VALUES ('US', 4)
+        ''')
+        bdb.execute('ALTER GENERATOR m INCORPORATE NEW ROWS')
+        individuals = bdb.sql_execute('''
+            SELECT table_rowid, cgpm_rowid FROM bayesdb_cgpm_individual
+                WHERE generator_id = ?
+                ORDER BY cgpm_rowid
+        ''', (generator_id,)).fetchall()
+        assert len(individuals) == 11
+        assert individuals[-1] == (101, 10)
+
 def test_using_modelnos():
     with cgpm_dummy_satellites_bdb() as bdb:
         bdb.execute('''
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import json
+import math
+import numpy
+
+from bayeslite.backends.cgpm_codec import decode_metadata
+from bayeslite.backends.cgpm_codec import encode_metadata
+
+def _json_round_trip(metadata):
+    return json.loads(json.dumps(metadata))
+
+def _assert_same(a, b):
+    # Compare values and types, treating NaN as equal to itself.
+    assert type(a) == type(b), (a, b)
+    if isinstance(a, dict):
+        assert sorted(a.keys()) == sorted(b.keys())
+        for k in a:
+            _assert_same(a[k], b[k])
+    elif isinstance(a, list):
+        assert len(a) == len(b)
+        for x, y in zip(a, b):
+            _assert_same(x, y)
+    elif isinstance(a, float) and math.isnan(a):
+        assert math.isnan(b)
+    else:
+        assert a == b
+
+def test_round_trip():
+    nan = float('nan')
+    metadata = {
+        'X': [[float(i), nan if i % 7 == 0 else 2.5*i] for i in xrange(40)],
+        'Zr': range(100),
+        'mixed': [0, 1.5] * 10,
+        'flags': [True, False] * 10,
+        'short': [1, 2, 3],
+        'ragged': [[1, 2]] * 10 + [[3]] * 10,
+        'names': ['a'] * 20,
+        'huge': [2**70] * 20,
+        'nested': {1: {'alpha': 1.5, 'counts': [[1, 2, 3]] * 20}},
+        'tuple': tuple(xrange(20)),
+        'empty': [[]] * 20,
+        'factory': ('cgpm.crosscat.state', 'State'),
+        'none': None,
+    }
+    blob = encode_metadata(metadata)
+    expected = _json_round_trip(metadata)
+    _assert_same(decode_metadata(blob), expected)
+    # SQLite hands blobs back as buffers.
+    _assert_same(decode_metadata(buffer(blob)), expected)
+
+def test_arrays_are_binary():
+    metadata = {
+        'X': [[i/7. + j/3. for j in xrange(100)] for i in xrange(100)],
+    }
+    blob = encode_metadata(metadata)
+    assert len(blob) < 100*100*8 + 200
+    assert len(blob) < len(json.dumps(metadata))
+
+def test_numpy_scalars():
+    metadata = {
+        'floats': [numpy.float64(i)/3 for i in xrange(20)],
+        'ints': [numpy.int64(i) for i in xrange(20)],
+    }
+    _assert_same(decode_metadata(encode_metadata(metadata)),
+        _json_round_trip(metadata))
@@ -16,8 +16,15 @@
 
 from StringIO import StringIO
 
+import apsw
 import bayeslite
+import pytest
 import tempfile
+import time
+
+from bayeslite.backends.cgpm_backend import CGPM_Backend
+from bayeslite.backends.cgpm_backend import _publish_states
+from bayeslite.backends.engine_cache import EngineCache
 
 import test_csv
 
@@ -65,6 +72,52 @@ def test_engine_increment_stamp():
             is not None
 
 
+
+def test_engine_stamp_memoized():
+    """Confirm the engine stamp is looked up once per statement."""
+    with bayeslite.bayesdb_open(':memory:') as bdb:
+        bayeslite.bayesdb_read_csv(bdb, 't', StringIO(test_csv.csv_data),
+            header=True, create=True)
+        bdb.execute('CREATE POPULATION p FOR t (GUESS STATTYPES OF (*))')
+        bdb.execute('CREATE GENERATOR m FOR p;')
+        bdb.execute('INITIALIZE 1 MODEL FOR m;')
+        bdb.execute('ANALYZE m FOR 1 ITERATION')
+        queries = []
+        def tracer(query, _bindings):
+            if 'SELECT engine_stamp FROM' in query:
+                queries.append(query)
+        def count(limit, fetch):
+            del queries[:]
+            bdb.sql_trace(tracer)
+            try:
+                rows = fetch(bdb.execute('''
+                    ESTIMATE PREDICTIVE PROBABILITY OF age FROM p LIMIT ?
+                ''', (limit,)))
+            finally:
+                bdb.sql_untrace(tracer)
+            assert len(rows) == limit
+            return len(queries)
+        def fetchall(cursor):
+            return cursor.fetchall()
+        def iterate(cursor):
+            return [row for row in cursor]
+        # Not once per row, whether fetched all at once or row by row.
+        assert count(2, fetchall) == count(7, fetchall) <= 2
+        assert count(2, iterate) == count(7, iterate) <= 2
+        # A rolled back analysis leaves the stamp as it was.
+        generator_id = bayeslite.core.bayesdb_get_generator(
+            bdb, bayeslite.core.bayesdb_get_population(bdb, 'p'), 'm')
+        cgpm_backend = bdb.backends['cgpm']
+        with bdb.transaction():
+            try:
+                with bdb.savepoint():
+                    bdb.execute('ANALYZE m FOR 1 ITERATION')
+                    assert cgpm_backend._engine_stamp(bdb, generator_id) == 3
+                    raise ValueError
+            except ValueError:
+                pass
+            assert cgpm_backend._engine_stamp(bdb, generator_id) == 2
+
 def test_engine_stamp_two_clients():
     """Confirm analysis by one worker makes cache in other worker stale."""
     with tempfile.NamedTemporaryFile(prefix='bayeslite') as f:
@@ -107,3 +160,162 @@ def test_engine_stamp_two_clients():
 
             # Engine in cache of bdb0 should be stale, since bdb2 analyzed.
             assert cgpm_backend._engine_latest(bdb0, generator_id) is None
+
+
+def test_analyze_in_background():
+    """Confirm background analysis publishes checkpoints to queries."""
+    with tempfile.NamedTemporaryFile(prefix='bayeslite') as f:
+        with bayeslite.bayesdb_open(f.name) as bdb:
+            bayeslite.bayesdb_read_csv(bdb, 't', StringIO(test_csv.csv_data),
+                header=True, create=True)
+            bdb.execute('''
+                CREATE POPULATION p FOR t (
+                    age NUMERICAL;
+                    gender NOMINAL;
+                    salary NUMERICAL;
+                    height IGNORE;
+                    division NOMINAL;
+                    rank NOMINAL;
+                )
+            ''')
+            bdb.execute('CREATE GENERATOR m FOR p;')
+            cgpm_backend = bdb.backends['cgpm']
+            population_id = bayeslite.core.bayesdb_get_population(bdb, 'p')
+            generator_id = bayeslite.core.bayesdb_get_generator(
+                bdb, population_id, 'm')
+            bdb.execute('INITIALIZE 2 MODELS FOR m;')
+            assert cgpm_backend.analysis_status(bdb, generator_id) is None
+            assert cgpm_backend._engine_stamp(bdb, generator_id) == 1
+
+            bdb.execute('''
+                ANALYZE m FOR 4 ITERATIONS CHECKPOINT 2 ITERATIONS
+                    IN BACKGROUND (QUIET)
+            ''')
+            # The database switches to a write-ahead log, so that the
+            # worker and our queries do not block one another.
+            assert bdb.sql_execute('PRAGMA journal_mode').fetchall() == \
+                [('wal',)]
+            # Queries are served meanwhile, but the models are not to be
+            # changed.
+            bdb.execute('SIMULATE age FROM p LIMIT 1;').fetchall()
+            with pytest.raises(bayeslite.BQLError):
+                bdb.execute('ANALYZE m FOR 1 ITERATION')
+            # A statement left unfinished does not hold up the worker's
+            # checkpoints.
+            cursor = bdb.sql_execute('SELECT * FROM t')
+            cursor.next()
+            deadline = time.time() + 60
+            while cgpm_backend.analysis_status(bdb, generator_id)['running']:
+                assert time.time() < deadline
+                time.sleep(0.1)
+            status = cgpm_backend.analysis_status(bdb, generator_id)
+            assert status['error'] is None
+            assert status['iterations'] == 4
+            assert sorted(status['logscores'].keys()) == [0, 1]
+            cursor.fetchall()
+
+            # Each checkpoint published a new engine stamp, which the
+            # queries pick up.
+            assert cgpm_backend._engine_stamp(bdb, generator_id) == 3
+            bdb.execute('SIMULATE age FROM p LIMIT 1;').fetchall()
+            assert cgpm_backend._get_cache_entry(
+                bdb, generator_id, 'stamp') == 3
+            bdb.execute('ANALYZE m FOR 1 ITERATION')
+            assert cgpm_backend._engine_stamp(bdb, generator_id) == 4
+
+    # The worker runs to the end even if no one asks how it is doing.
+    with tempfile.NamedTemporaryFile(prefix='bayeslite') as f:
+        with bayeslite.bayesdb_open(f.name) as bdb:
+            bayeslite.bayesdb_read_csv(bdb, 't', StringIO(test_csv.csv_data),
+                header=True, create=True)
+            bdb.execute('CREATE POPULATION p FOR t (GUESS STATTYPES OF (*))')
+            bdb.execute('CREATE GENERATOR m FOR p;')
+            bdb.execute('INITIALIZE 1 MODEL FOR m;')
+            cgpm_backend = bdb.backends['cgpm']
+            population_id = bayeslite.core.bayesdb_get_population(bdb, 'p')
+            generator_id = bayeslite.core.bayesdb_get_generator(
+                bdb, population_id, 'm')
+            bdb.execute('''
+                ANALYZE m FOR 2000 ITERATIONS IN BACKGROUND (QUIET)
+            ''')
+            analysis = cgpm_backend._get_cache_entry(
+                bdb, generator_id, 'analysis')
+            analysis._process.join(300)
+            assert not analysis._process.is_alive()
+            status = cgpm_backend.analysis_status(bdb, generator_id)
+            assert status['error'] is None
+            assert status['iterations'] == 2000
+
+    # A database in memory cannot be shared with the worker.
+    with bayeslite.bayesdb_open(':memory:') as bdb:
+        bayeslite.bayesdb_read_csv(bdb, 't', StringIO(test_csv.csv_data),
+            header=True, create=True)
+        bdb.execute('CREATE POPULATION p FOR t (GUESS STATTYPES OF (*))')
+        bdb.execute('CREATE GENERATOR m FOR p;')
+        bdb.execute('INITIALIZE 1 MODEL FOR m;')
+        with pytest.raises(bayeslite.BQLError):
+            bdb.execute('ANALYZE m FOR 1 ITERATION IN BACKGROUND')
+
+
+def test_publish_states_busy():
+    """Confirm a checkpoint gives up, rather than spins, while locked."""
+    with tempfile.NamedTemporaryFile(prefix='bayeslite') as f:
+        with bayeslite.bayesdb_open(f.name) as bdb:
+            bayeslite.bayesdb_read_csv(bdb, 't', StringIO(test_csv.csv_data),
+                header=True, create=True)
+            bdb.execute('CREATE POPULATION p FOR t (GUESS STATTYPES OF (*))')
+            bdb.execute('CREATE GENERATOR m FOR p;')
+            bdb.execute('INITIALIZE 1 MODEL FOR m;')
+            cgpm_backend = bdb.backends['cgpm']
+            population_id = bayeslite.core.bayesdb_get_population(bdb, 'p')
+            generator_id = bayeslite.core.bayesdb_get_generator(
+                bdb, population_id, 'm')
+            engine = cgpm_backend._engine(bdb, generator_id)
+            db = apsw.Connection(f.name)
+            db.setbusytimeout(10)
+            try:
+                with bdb.transaction():
+                    bdb.sql_execute('UPDATE t SET age = age')
+                    assert _publish_states(
+                        db, generator_id, 1, engine, [0]) is None
+                assert cgpm_backend._engine_stamp(bdb, generator_id) == 1
+                assert _publish_states(db, generator_id, 1, engine, [0]) == 2
+                assert cgpm_backend._engine_stamp(bdb, generator_id) == 2
+            finally:
+                db.close()
+
+
+def test_engine_cache_budget():
+    """Confirm engines are evicted, least recently used first."""
+    cache = EngineCache(max_bytes=1)
+    with bayeslite.bayesdb_open(':memory:', builtin_backends=False) as bdb:
+        cgpm_backend = CGPM_Backend({}, multiprocess=False,
+            engine_cache=cache)
+        bayeslite.bayesdb_register_backend(bdb, cgpm_backend)
+        bayeslite.bayesdb_read_csv(bdb, 't', StringIO(test_csv.csv_data),
+            header=True, create=True)
+        bdb.execute('CREATE POPULATION p FOR t (GUESS STATTYPES OF (*))')
+        population_id = bayeslite.core.bayesdb_get_population(bdb, 'p')
+        generator_ids = []
+        for name in ['m0', 'm1']:
+            bdb.execute('CREATE GENERATOR %s FOR p;' % (name,))
+            bdb.execute('INITIALIZE 1 MODEL FOR %s;' % (name,))
+            generator_ids.append(bayeslite.core.bayesdb_get_generator(
+                bdb, population_id, name))
+        def cached():
+            return [
+                cgpm_backend._get_cache_entry(bdb, generator_id, 'engine')
+                    is not None
+                for generator_id in generator_ids
+            ]
+        query = 'SIMULATE age FROM p MODELED BY %s LIMIT 1;'
+        bdb.execute(query % ('m0',)).fetchall()
+        assert cached() == [True, False]
+        bdb.execute(query % ('m1',)).fetchall()
+        assert cached() == [False, True]
+        assert cache.evictions >= 1
+        # Without a budget, both stay.
+        cache.max_bytes = None
+        bdb.execute(query % ('m0',)).fetchall()
+        assert cached() == [True, True]
+        assert cache.stats()['bytes'] > 1
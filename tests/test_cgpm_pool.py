@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import pytest
+
+from bayeslite.backends.cgpm_pool import StatePool
+
+class Counter(object):
+    def __init__(self, name, offset, seed):
+        self.name = name
+        self.offset = offset
+        self.seed = seed
+        self.calls = 0
+
+    def add(self, x):
+        self.calls += 1
+        return (self.name, self.offset + x, self.seed, self.calls)
+
+    def pid(self):
+        return os.getpid()
+
+    def fail(self):
+        raise ValueError(self.name)
+
+def test_state_pool():
+    pool = StatePool(Counter, nworkers=3)
+    try:
+        assert not pool.loaded('a')
+        pool.load('a', 100, ['a0', 'a1', 'a2', 'a3', 'a4'], [10, 11, 12, 13, 14])
+        pool.load('b', 200, ['b0', 'b1'], [20, 21])
+        assert pool.loaded('a') and pool.loaded('b')
+        assert pool.map('a', 'add', [4, 0, 2], (1,)) == [
+            ('a4', 101, 14, 1), ('a0', 101, 10, 1), ('a2', 101, 12, 1),
+        ]
+        # The states stay in the workers between calls.
+        assert pool.map('a', 'add', range(5), (2,)) == [
+            ('a0', 102, 10, 2), ('a1', 102, 11, 1), ('a2', 102, 12, 2),
+            ('a3', 102, 13, 1), ('a4', 102, 14, 2),
+        ]
+        assert pool.map('b', 'add', [1], (3,)) == [('b1', 203, 21, 1)]
+        pids = pool.map('a', 'pid', range(5), ())
+        assert len(set(pids)) == 3
+        assert os.getpid() not in pids
+        assert pool.map('a', 'pid', range(5), ()) == pids
+        # Errors in workers propagate, and leave the pool usable.
+        with pytest.raises(ValueError):
+            pool.map('a', 'fail', [1], ())
+        assert pool.map('a', 'add', [1], (0,)) == [('a1', 100, 11, 2)]
+        # Reloading replaces the states.
+        pool.load('a', 300, ['c0'], [30])
+        assert pool.map('a', 'add', [0], (0,)) == [('c0', 300, 30, 1)]
+        pool.drop('a')
+        assert not pool.loaded('a')
+        assert pool.loaded('b')
+    finally:
+        pool.close()
+    assert not pool.loaded('b')
+    # A closed pool starts afresh on the next load.
+    pool.load('a', 0, ['d0'], [40])
+    try:
+        assert pool.map('a', 'add', [0], (1,)) == [('d0', 1, 40, 1)]
+    finally:
+        pool.close()
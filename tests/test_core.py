@@ -682,3 +682,37 @@ def test_bayesdb_implicit_population_generator_rename():
         assert not core.bayesdb_has_generator(bdb, population_id, 't')
         assert core.bayesdb_has_generator(bdb, population_id2, 't2')
         assert generator_id2 == generator_id
+
+def test_catalog_cache():
+    with bayesdb() as bdb:
+        bdb.sql_execute('create table t (a real, b real)')
+        bdb.execute('create population p for t (a numerical; b numerical)')
+        population_id = core.bayesdb_get_population(bdb, 'p')
+        assert core.bayesdb_population_name(bdb, population_id) == 'p'
+        # Cached lookups issue no SQL.
+        queries = []
+        def trace(string, _bindings):
+            queries.append(string)
+        bdb.sql_trace(trace)
+        assert core.bayesdb_get_population(bdb, 'p') == population_id
+        assert core.bayesdb_population_name(bdb, population_id) == 'p'
+        bdb.sql_untrace(trace)
+        assert queries == []
+        # Commands invalidate the cache.
+        generation = core.bayesdb_catalog_generation(bdb)
+        bdb.execute('alter population p rename to q')
+        assert core.bayesdb_catalog_generation(bdb) != generation
+        assert core.bayesdb_population_name(bdb, population_id) == 'q'
+        assert not core.bayesdb_has_population(bdb, 'p')
+        # Rolling back invalidates the cache.
+        bdb.execute('begin')
+        bdb.execute('alter population q rename to r')
+        assert core.bayesdb_population_name(bdb, population_id) == 'r'
+        bdb.execute('rollback')
+        assert core.bayesdb_population_name(bdb, population_id) == 'q'
+        with pytest.raises(Exception):
+            with bdb.savepoint():
+                bdb.execute('drop population q')
+                assert not core.bayesdb_has_population(bdb, 'q')
+                raise Exception
+        assert core.bayesdb_has_population(bdb, 'q')
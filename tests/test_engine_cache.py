@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import gc
+
+from bayeslite.backends.engine_cache import EngineCache
+
+class Handle(object):
+    pass
+
+def test_lru_eviction():
+    released = []
+    cache = EngineCache(max_bytes=100)
+    ns = cache.namespace(
+        nbytes=lambda entries: entries.get('size', 0),
+        release=lambda entries: released.append(entries['name']),
+        pinned=lambda entries: entries.get('pinned', False))
+    bdb = Handle()
+    for generator_id, name in enumerate(['a', 'b', 'c']):
+        ns.set(bdb, generator_id, 'name', name)
+        ns.set(bdb, generator_id, 'size', 40)
+    # Setting c's size evicted a, the least recently used.
+    assert released == ['a']
+    assert ns.get(bdb, 0, 'name') is None
+    assert cache.stats() == {
+        'hits': 0,
+        'misses': 1,
+        'evictions': 1,
+        'generators': 2,
+        'bytes': 80,
+        'max_bytes': 100,
+    }
+    # Using b makes c the least recently used.
+    assert ns.get(bdb, 1, 'name') == 'b'
+    ns.set(bdb, 3, 'name', 'd')
+    ns.set(bdb, 3, 'size', 40)
+    assert released == ['a', 'c']
+    assert cache.hits == 1
+    # Pinned generators stay, however large.
+    ns.set(bdb, 1, 'pinned', True)
+    ns.set(bdb, 4, 'name', 'e')
+    ns.set(bdb, 4, 'size', 50)
+    assert released == ['a', 'c', 'd']
+    assert cache.nbytes() == 90
+    # The most recently set generator stays even if it alone is over.
+    ns.set(bdb, 4, 'size', 500)
+    assert released == ['a', 'c', 'd']
+    assert cache.evictions == 3
+    # Deleting does not release.
+    ns.delete(bdb, 4, 'size')
+    assert ns.get(bdb, 4, 'name') == 'e'
+    ns.delete(bdb, 4, None)
+    assert ns.get(bdb, 4, 'name') is None
+    assert released == ['a', 'c', 'd']
+    cache.clear()
+    assert released == ['a', 'c', 'd', 'b']
+    assert cache.stats()['generators'] == 0
+
+def test_namespaces_and_handles():
+    released = []
+    cache = EngineCache(max_bytes=None)
+    ns0 = cache.namespace(release=lambda entries: released.append(entries))
+    ns1 = cache.namespace()
+    bdb0 = Handle()
+    bdb1 = Handle()
+    ns0.set(bdb0, 1, 'x', 'ns0 bdb0')
+    ns0.set(bdb1, 1, 'x', 'ns0 bdb1')
+    ns1.set(bdb0, 1, 'x', 'ns1 bdb0')
+    assert ns0.get(bdb0, 1, 'x') == 'ns0 bdb0'
+    assert ns0.get(bdb1, 1, 'x') == 'ns0 bdb1'
+    assert ns1.get(bdb0, 1, 'x') == 'ns1 bdb0'
+    assert ns1.get(bdb1, 1, 'x') is None
+    # Objects of collected handles are released on the next use.
+    del bdb0
+    gc.collect()
+    assert ns0.get(bdb1, 1, 'x') == 'ns0 bdb1'
+    assert released == [{'x': 'ns0 bdb0'}]
+    assert cache.stats()['generators'] == 1
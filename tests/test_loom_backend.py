@@ -27,6 +27,7 @@ from bayeslite import bayesdb_register_backend
 from bayeslite.core import bayesdb_get_generator
 from bayeslite.core import bayesdb_get_population
 from bayeslite.exception import BQLError
+from bayeslite.backends.server_pool import ServerPool
 
 try:
     from bayeslite.backends.loom_backend import LoomBackend
@@ -360,3 +361,259 @@ def test_population_two_generators():
             bdb.execute('create population p for t (x numerical)')
             bdb.execute('create generator g0 for p using loom')
             bdb.execute('create generator g1 for p using loom')
+
+
+def test_kind_partition():
+    with tempdir('bayeslite-loom') as loom_store_path:
+        with bayesdb_open(':memory:') as bdb:
+            bayesdb_register_backend(bdb,
+                LoomBackend(loom_store_path=loom_store_path))
+            bdb.sql_execute('create table t (x, y)')
+            for x in xrange(10):
+                bdb.sql_execute('insert into t (x, y) values (?, ?)',
+                    (x, x % 3))
+            bdb.execute('create population p for t (x numerical; y nominal)')
+            bdb.execute('create generator g0 for p using loom')
+            bdb.execute('create generator g1 for p using loom')
+            bdb.execute('initialize 2 models for g0')
+            bdb.execute('initialize 3 models for g1')
+            bdb.execute('analyze g0 for 2 iterations')
+            bdb.execute('analyze g1 for 2 iterations')
+            population_id = bayesdb_get_population(bdb, 'p')
+            for name, num_models in [('g0', 2), ('g1', 3)]:
+                generator_id = bayesdb_get_generator(bdb, population_id, name)
+                for modelno in xrange(num_models):
+                    # Every variable is in exactly one kind.
+                    kinds = bdb.sql_execute('''
+                        SELECT colno, kind_id
+                            FROM bayesdb_loom_column_kind_partition
+                            WHERE generator_id = ? AND modelno = ?
+                    ''', (generator_id, modelno)).fetchall()
+                    assert sorted(colno for colno, _kind in kinds) == [0, 1]
+                    # Every row is in exactly one cluster of each kind,
+                    # and is matched with its own loom rowid.
+                    rows = bdb.sql_execute('''
+                        SELECT r.kind_id, r.table_rowid
+                            FROM bayesdb_loom_row_kind_partition AS r
+                                JOIN bayesdb_loom_rowid_mapping AS m
+                                    USING (generator_id, table_rowid,
+                                        loom_rowid)
+                            WHERE r.generator_id = ? AND r.modelno = ?
+                            ORDER BY r.kind_id, r.table_rowid
+                    ''', (generator_id, modelno)).fetchall()
+                    kind_ids = set(k for k, _r in rows)
+                    assert set(k for _c, k in kinds) <= kind_ids
+                    assert rows == [
+                        (kind_id, rowid)
+                        for kind_id in sorted(kind_ids)
+                        for rowid in xrange(1, 11)
+                    ]
+
+
+def test_predictive_relevance():
+    with tempdir('bayeslite-loom') as loom_store_path:
+        with bayesdb_open(':memory:') as bdb:
+            backend = LoomBackend(loom_store_path=loom_store_path)
+            bayesdb_register_backend(bdb, backend)
+            bdb.sql_execute('create table t (x, y)')
+            for x in xrange(20):
+                bdb.sql_execute('insert into t (x, y) values (?, ?)',
+                    (x, x % 3))
+            bdb.execute('create population p for t (x numerical; y nominal)')
+            bdb.execute('create generator g for p using loom')
+            bdb.execute('initialize 4 models for g')
+            bdb.execute('analyze g for 2 iterations')
+            population_id = bayesdb_get_population(bdb, 'p')
+            generator_id = bayesdb_get_generator(bdb, population_id, 'g')
+            partitions = {}
+            for modelno, rowid, partition_id in bdb.sql_execute('''
+                    SELECT r.modelno, r.table_rowid, r.partition_id
+                        FROM bayesdb_loom_row_kind_partition AS r
+                            JOIN bayesdb_loom_column_kind_partition AS c
+                                USING (generator_id, modelno, kind_id)
+                        WHERE r.generator_id = ? AND c.colno = 1
+                    ''', (generator_id,)):
+                partitions[modelno, rowid] = partition_id
+            # Relevance is the fraction of models in which a row is in
+            # the target's partition; rows not in the models never are.
+            rowids = [3, 1, 20, 3, 21]
+            for modelnos in [None, [1, 3]]:
+                models = range(4) if modelnos is None else modelnos
+                assert backend.predictive_relevance(
+                    bdb, generator_id, modelnos, 3, rowids, [], 1) == [
+                    sum(partitions.get((modelno, rowid)) ==
+                            partitions[modelno, 3]
+                        for modelno in models) / float(len(models))
+                    for rowid in rowids
+                ]
+
+
+def test_simulate_types():
+    with tempdir('bayeslite-loom') as loom_store_path:
+        with bayesdb_open(':memory:') as bdb:
+            bayesdb_register_backend(bdb,
+                LoomBackend(loom_store_path=loom_store_path))
+            bdb.sql_execute('create table t (x, y)')
+            for x in xrange(10):
+                bdb.sql_execute('insert into t (x, y) values (?, ?)',
+                    (x, 'abc'[x % 3]))
+            bdb.execute('create population p for t (x numerical; y nominal)')
+            bdb.execute('create generator g for p using loom')
+            bdb.execute('initialize 2 models for g')
+            bdb.execute('analyze g for 2 iterations')
+            samples = bdb.execute('''
+                simulate y from p given x = 4 limit 20
+            ''').fetchall()
+            assert len(samples) == 20
+            assert all(y in ['a', 'b', 'c'] for (y,) in samples)
+            samples = bdb.execute('''
+                simulate y, x from p limit 20
+            ''').fetchall()
+            for y, x in samples:
+                assert isinstance(x, float)
+                assert y in ['a', 'b', 'c']
+            # Nominal constraints are encoded as loom codes.
+            samples = bdb.execute('''
+                simulate x from p given y = 'b' limit 5
+            ''').fetchall()
+            assert all(isinstance(x, float) for (x,) in samples)
+
+
+def test_logpdf_joint_batch():
+    with tempdir('bayeslite-loom') as loom_store_path:
+        with bayesdb_open(':memory:') as bdb:
+            backend = LoomBackend(loom_store_path=loom_store_path)
+            bayesdb_register_backend(bdb, backend)
+            bdb.sql_execute('create table t (x, y)')
+            for x in xrange(10):
+                bdb.sql_execute('insert into t (x, y) values (?, ?)',
+                    (x, 'abc'[x % 3]))
+            bdb.execute('create population p for t (x numerical; y nominal)')
+            bdb.execute('create generator g for p using loom')
+            bdb.execute('initialize 2 models for g')
+            bdb.execute('analyze g for 2 iterations')
+            population_id = bayesdb_get_population(bdb, 'p')
+            generator_id = bayesdb_get_generator(bdb, population_id, 'g')
+            rows = [
+                (11, [(0, 1.5)], []),
+                (11, [(0, 1.5)], [(1, 'a')]),
+                (11, [(1, 'b')], [(0, 3)]),
+                (11, [(0, 7), (1, 'c')], []),
+                (11, [(0, 1.5)], [(1, 'a')]),
+            ]
+            logpdfs = backend.logpdf_joint_batch(
+                bdb, generator_id, None, rows)
+            assert len(logpdfs) == len(rows)
+            for logpdf, (rowid, targets, constraints) in zip(logpdfs, rows):
+                assert logpdf == backend.logpdf_joint(
+                    bdb, generator_id, None, rowid, targets, constraints)
+            assert logpdfs[1] == logpdfs[4]
+            assert len(backend.logpdf_joint_batch(
+                bdb, generator_id, None, [])) == 0
+
+
+def test_simulate_joint_batch():
+    with tempdir('bayeslite-loom') as loom_store_path:
+        with bayesdb_open(':memory:') as bdb:
+            backend = LoomBackend(loom_store_path=loom_store_path)
+            bayesdb_register_backend(bdb, backend)
+            bdb.sql_execute('create table t (x, y)')
+            for x in xrange(10):
+                bdb.sql_execute('insert into t (x, y) values (?, ?)',
+                    (x, 'abc'[x % 3]))
+            bdb.execute('create population p for t (x numerical; y nominal)')
+            bdb.execute('create generator g for p using loom')
+            bdb.execute('initialize 2 models for g')
+            bdb.execute('analyze g for 2 iterations')
+            population_id = bayesdb_get_population(bdb, 'p')
+            generator_id = bayesdb_get_generator(bdb, population_id, 'g')
+            # More rows than are kept in flight at once.
+            rows = [(11, [1, 0], []), (1, [0], []), (11, [1], [(0, 3)])] * 30
+            samples = backend.simulate_joint_batch(
+                bdb, generator_id, None, rows, num_samples=3)
+            assert len(samples) == len(rows)
+            for row_samples, (_rowid, targets, _constraints) in \
+                    zip(samples, rows):
+                assert len(row_samples) == 3
+                for sample in row_samples:
+                    assert len(sample) == len(targets)
+                    for colno, value in zip(targets, sample):
+                        if colno == 0:
+                            assert isinstance(value, float)
+                        else:
+                            assert value in ['a', 'b', 'c']
+            # Predictions are imputed from a batch of samples per row.
+            predictions = backend.predict_confidence_batch(
+                bdb, generator_id, None, range(1, 11), 1)
+            assert len(predictions) == 10
+            assert all(value in ['a', 'b', 'c']
+                for value, _confidence in predictions)
+            assert len(backend.simulate_joint_batch(
+                bdb, generator_id, None, [])) == 0
+
+
+def test_server_pool():
+    with tempdir('bayeslite-loom') as loom_store_path:
+        pathname = os.path.join(loom_store_path, 'test.bdb')
+        pool = ServerPool(max_servers=1)
+        with bayesdb_open(pathname) as bdb:
+            bayesdb_register_backend(bdb,
+                LoomBackend(loom_store_path=loom_store_path, server_pool=pool))
+            bdb.sql_execute('create table t (x)')
+            for x in xrange(10):
+                bdb.sql_execute('insert into t (x) values (?)', (x,))
+            bdb.execute('create population p for t (x numerical)')
+            bdb.execute('create generator g for p using loom')
+            bdb.execute('initialize 1 models for g')
+            bdb.execute('analyze g for 2 iterations')
+            bdb.execute('estimate probability density of x = 5 from p')
+            bdb.execute('estimate probability density of x = 6 from p')
+            assert pool.starts == 1
+            assert pool.reuses == 1
+            # Only one server may run, so simulating evicts the other.
+            bdb.execute('simulate x from p limit 1').fetchall()
+            assert pool.starts == 2
+            assert pool.evictions == 1
+            # Analysis closes the servers.
+            bdb.execute('analyze g for 1 iteration')
+            assert pool.stats()['servers'] == 0
+        # Servers for the named generators start with the backend.
+        pool.max_servers = None
+        with bayesdb_open(pathname) as bdb:
+            bayesdb_register_backend(bdb,
+                LoomBackend(loom_store_path=loom_store_path, server_pool=pool,
+                    prewarm=['g', 'h']))
+            assert pool.stats()['servers'] == 2
+            starts = pool.starts
+            bdb.execute('estimate probability density of x = 5 from p')
+            bdb.execute('simulate x from p limit 1').fetchall()
+            assert pool.starts == starts
+        pool.close_all()
+
+
+def test_ingest_text():
+    values = [u'caf\xe9', u'na\xefve', u'back\\slash', u'plain']
+    with tempdir('bayeslite-loom') as loom_store_path:
+        with bayesdb_open(':memory:') as bdb:
+            bayesdb_register_backend(bdb,
+                LoomBackend(loom_store_path=loom_store_path))
+            bdb.sql_execute('create table t (x, y)')
+            for x in xrange(12):
+                bdb.sql_execute('insert into t (x, y) values (?, ?)',
+                    (x, values[x % 4]))
+            bdb.execute('create population p for t (x numerical; y nominal)')
+            bdb.execute('create generator g for p using loom')
+            # No scratch files are left behind.
+            assert not [
+                name for name in os.listdir(loom_store_path)
+                if name.startswith('bayeslite-loom-')
+            ]
+            bdb.execute('initialize 1 model for g')
+            bdb.execute('analyze g for 2 iterations')
+            # Text values survive the trip through loom intact.
+            samples = bdb.execute('simulate y from p limit 20').fetchall()
+            assert all(y in values for (y,) in samples)
+            density = bdb.execute(u'''
+                estimate probability density of y = 'caf\xe9' from p
+            ''').fetchvalue()
+            assert 0 < density < 1
@@ -535,3 +535,80 @@ def test_nig_normal_latent_2var2lat_conditional_smoke():
         bdb.execute('drop generator g1')
         bdb.execute('drop population p')
         bdb.execute('drop table t')
+
+def test_nig_normal_predprob_batch():
+    with bayesdb_open(':memory:') as bdb:
+        bayesdb_register_backend(bdb, NIGNormalBackend())
+        bdb.sql_execute('create table t(x, y)')
+        for x in xrange(50):
+            bdb.sql_execute('insert into t(x, y) values(?, ?)', (x, x % 7))
+        bdb.execute('create population p for t(x numerical; y numerical)')
+        bdb.execute('create generator g0 for p using nig_normal')
+        bdb.execute('create generator g1 for p using nig_normal')
+        bdb.execute('initialize 2 models for g0')
+        bdb.execute('initialize 3 models for g1')
+        bdb.execute('analyze g0 for 1 iteration')
+        bdb.execute('analyze g1 for 1 iteration')
+        # Without LIMIT, all rows are computed in one batch; with it,
+        # each row is computed separately.
+        query = '''
+            estimate rowid, predictive probability of x,
+                predictive probability of x given (y)
+            from p where y < 5 order by predictive probability of y
+        '''
+        batched = bdb.execute(query).fetchall()
+        rowwise = bdb.execute(query + ' limit 50').fetchall()
+        assert len(batched) == len([x for x in xrange(50) if x % 7 < 5])
+        assert batched == rowwise
+        # The backend batch agrees with one row at a time.
+        backend = core.bayesdb_generator_backend(bdb, 1)
+        rows = [(51, [(0, x), (1, 3)], []) for x in xrange(5)]
+        assert backend.logpdf_joint_batch(bdb, 1, None, rows) == [
+            backend.logpdf_joint(bdb, 1, None, rowid, targets, constraints)
+            for rowid, targets, constraints in rows
+        ]
+
+def test_nig_normal_pairwise_depprob():
+    with bayesdb_open(':memory:') as bdb:
+        bayesdb_register_backend(bdb, NIGNormalBackend())
+        bdb.sql_execute('create table t(x, y, z)')
+        for x in xrange(10):
+            bdb.sql_execute('insert into t(x, y, z) values(?, ?, ?)',
+                (x, x + 1, x * x))
+        bdb.execute('create population p for t(set stattypes of x, y, z'
+            ' to numerical)')
+        bdb.execute('create generator g for p using nig_normal')
+        bdb.execute('initialize 2 models for g')
+        # The NIG-Normal model has all variables independent.
+        depprobs = bdb.execute('''
+            estimate dependence probability as depprob
+            from pairwise variables of p
+            where depprob = 0 order by depprob
+        ''').fetchall()
+        assert len(depprobs) == 9
+        assert all(depprob == 0 for _p, _n0, _n1, depprob in depprobs)
+        # The temporary table is gone afterward.
+        assert bdb.sql_execute('''
+            SELECT COUNT(*) FROM sqlite_temp_master WHERE type = 'table'
+                AND name LIKE 'bayesdb_temp_%'
+        ''').fetchall() == [(0,)]
+
+def test_nig_normal_pairwise_similarity():
+    with bayesdb_open(':memory:') as bdb:
+        bayesdb_register_backend(bdb, NIGNormalBackend())
+        bdb.sql_execute('create table t(x, y)')
+        for x in xrange(10):
+            bdb.sql_execute('insert into t(x, y) values(?, ?)', (x, x % 3))
+        bdb.execute('create population p for t(x numerical; y numerical)')
+        bdb.execute('create generator g for p using nig_normal')
+        bdb.execute('initialize 2 models for g')
+        # Without LIMIT, all pairs are computed in one batch; with it,
+        # each pair is computed separately.
+        query = '''
+            estimate similarity in the context of x from pairwise p
+                where r0.y < r1.y order by rowid0, rowid1
+        '''
+        batched = bdb.execute(query).fetchall()
+        pairwise = bdb.execute(query + ' limit 100').fetchall()
+        assert len(batched) == 33
+        assert batched == pairwise
@@ -124,3 +124,16 @@ def test_basic():
     ''') == [
         cgpm_alter_parser.SetRowClusterConc('eland', 12)
     ]
+
+def test_incorporate_new_rows():
+    assert parse_alter_cmds('incorporate new rows') == [
+        cgpm_alter_parser.IncorporateNewRows()
+    ]
+    assert parse_alter_cmds('''
+        incorporate new rows, set view concentration parameter to 2
+    ''') == [
+        cgpm_alter_parser.IncorporateNewRows(),
+        cgpm_alter_parser.SetVarClusterConc(2),
+    ]
+    with pytest.raises(bayeslite.BQLParseError):
+        parse_alter_cmds('incorporate rows')
@@ -142,3 +142,35 @@ def test_read_csv():
             with pytest.raises(IOError):
                 bayeslite.bayesdb_read_csv_file(
                     bdb, 't3', temp.name, header=True, create=True)
+
+def test_read_csv_batches():
+    with bayeslite.bayesdb_open(builtin_backends=False) as bdb:
+        bdb.sql_execute('CREATE TABLE t(x NUMERIC, y NUMERIC)')
+        bdb.sql_execute('CREATE INDEX t_y ON t(y)')
+        index_sql = cursor_value(bdb.sql_execute('SELECT sql FROM sqlite_master'
+            ' WHERE name = ?', ('t_y',)))
+        csv = 'x,y\n' + ''.join('%d,%d\n' % (i, i % 3) for i in xrange(10))
+
+        with pytest.raises(ValueError):
+            bayeslite.bayesdb_read_csv(bdb, 't', StringIO.StringIO(csv),
+                header=True, batch_size=0)
+
+        nrows = bayeslite.bayesdb_read_csv(bdb, 't', StringIO.StringIO(csv),
+            header=True, batch_size=3)
+        assert nrows == 10
+        assert bdb.sql_execute('SELECT x, y FROM t').fetchall() == \
+            [(i, i % 3) for i in xrange(10)]
+        # The index was dropped for the load and created again.
+        assert cursor_value(bdb.sql_execute('SELECT sql FROM sqlite_master'
+            ' WHERE name = ?', ('t_y',))) == index_sql
+
+        # Errors are reported with the line of the offending row, and
+        # roll back every batch read before them.
+        bad = 'x,y\n1,2\n3,4\n5,6\n7\n'
+        with pytest.raises(IOError) as exc:
+            bayeslite.bayesdb_read_csv(bdb, 't', StringIO.StringIO(bad),
+                header=True, batch_size=2)
+        assert 'Line 5:' in str(exc.value)
+        assert cursor_value(bdb.sql_execute('SELECT COUNT(*) FROM t')) == 10
+        assert cursor_value(bdb.sql_execute('SELECT COUNT(*) FROM sqlite_master'
+            ' WHERE name = ?', ('t_y',))) == 1
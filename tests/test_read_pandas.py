@@ -69,3 +69,34 @@ def test_nonintegral_index():
         df = pandas.DataFrame([(1,2,'foo'),(4,5,6),(7,8,9),(10,11,12)],
             index=[42, 78, 62, 43])
         do_test(bdb, 't', df, index='eland')
+
+def test_null_chunks():
+    with bayesdb_open() as bdb:
+        df = pandas.DataFrame([(1,2.5,'foo'),(4,float('nan'),None),(7,8,9)],
+            index=[42, 78, 62], columns=['a', 'b', 'c'])
+        bayesdb_read_pandas_df(bdb, 't', df, create=True, chunksize=2)
+        assert bdb.sql_execute('select _rowid_, a, b, c from t'
+                ' order by _rowid_').fetchall() == [
+            (42, 1, 2.5, 'foo'),
+            (62, 7, 8, 9),
+            (78, 4, None, None),
+        ]
+        with pytest.raises(ValueError):
+            bayesdb_read_pandas_df(bdb, 'u', df, create=True, chunksize=0)
+        assert not bayesdb_has_table(bdb, 'u')
+
+def test_chunk_iterator():
+    with bayesdb_open() as bdb:
+        df = pandas.DataFrame([(1,2),(4,5),(7,8),(10,11),(13,14)],
+            columns=['a', 'b'])
+        chunks = (df.iloc[i:i + 2] for i in xrange(0, len(df.index), 2))
+        bayesdb_read_pandas_df(bdb, 't', chunks, create=True)
+        assert bdb.sql_execute('select _rowid_, a, b from t'
+                ' order by _rowid_').fetchall() == [
+            (0, 1, 2), (1, 4, 5), (2, 7, 8), (3, 10, 11), (4, 13, 14),
+        ]
+        # Chunks must all have the same columns, or nothing is read.
+        chunks = [df[['a', 'b']], df[['b', 'a']]]
+        with pytest.raises(ValueError):
+            bayesdb_read_pandas_df(bdb, 'u', chunks, create=True)
+        assert not bayesdb_has_table(bdb, 'u')
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from bayeslite.backends.server_pool import ServerPool
+
+class Server(object):
+    def __init__(self, name, closed):
+        self.name = name
+        self._closed = closed
+
+    def close(self):
+        self._closed.append(self.name)
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+def test_max_servers():
+    closed = []
+    pool = ServerPool(max_servers=2)
+    start = lambda name: lambda: Server(name, closed)
+    a = pool.get('a', start('a'))
+    assert pool.get('a', start('a2')) is a
+    pool.get('b', start('b'))
+    # Using a makes b the least recently used.
+    pool.get('a', start('a3'))
+    pool.get('c', start('c'))
+    assert closed == ['b']
+    assert pool.running('a') and pool.running('c')
+    assert not pool.running('b')
+    assert pool.stats() == {
+        'starts': 3,
+        'reuses': 2,
+        'evictions': 1,
+        'servers': 2,
+        'max_servers': 2,
+        'idle_seconds': None,
+    }
+    # Closing a server is not an eviction, and restarts it next time.
+    pool.close('a')
+    assert closed == ['b', 'a']
+    assert pool.get('a', start('a4')).name == 'a4'
+    assert pool.evictions == 1
+    pool.close_all()
+    assert sorted(closed) == ['a', 'a4', 'b', 'c']
+    assert pool.stats()['servers'] == 0
+
+def test_idle_seconds():
+    closed = []
+    clock = Clock()
+    pool = ServerPool(max_servers=None, idle_seconds=10, clock=clock)
+    start = lambda name: lambda: Server(name, closed)
+    pool.get('a', start('a'))
+    clock.now = 5
+    pool.get('b', start('b'))
+    clock.now = 10
+    pool.close_idle()
+    assert closed == []
+    # Servers left idle too long are closed on the next use.
+    clock.now = 11
+    pool.get('b', start('b2'))
+    assert closed == ['a']
+    assert pool.evictions == 1
+    clock.now = 30
+    pool.close_idle()
+    assert closed == ['a', 'b']
+    assert pool.stats()['servers'] == 0